@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import functools
+import gc
+import json
+import logging
+import os
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import fakes
+import main as bridge
+import memory
+
+
+def rss_bytes():
+    """Current resident set size, Linux only"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def bridge_config(accounts: int, port: int, domain: str = 'bench.invalid'):
+    """A config like register.py would write, pointing at the fake homeserver on port+1"""
+    return {
+        'matrix_baseurl': f"http://127.0.0.1:{port + 1}",
+        'as_token': 'bench_as_token',
+        'hs_token': 'bench_hs_token',
+        'sender_localpart': 'fbchat_bot',
+        'matrix_domain': domain,
+        'url': f"http://127.0.0.1:{port}",
+        'namespaces': {
+            'users': [{'exclusive': True, 'regex': "@fbchat_.*"},
+                      {'exclusive': False, 'regex': f"@bench.*:{domain}"}],
+            'aliases': [{'exclusive': True, 'regex': "#fbchat_.*"}],
+            'rooms': [],
+        },
+        'accounts': [{
+            'fbchat_username': f"bench{i}",
+            'fbchat_uid': str(i + 1),
+            'fbchat_session': {'c_user': str(i + 1)},
+            'matrix_user_localpart': f"bench{i}",
+        } for i in range(accounts)],
+    }
+
+
+async def start(config, client_class, verbose: int = 0):
+    """Start the fake homeserver and the bridge against it, returns (homeserver, bridge task)"""
+    homeserver = fakes.FakeHomeserver(domain=config['matrix_domain'], bot_localpart=config['sender_localpart'],
+                                      appservice_url=config['url'], hs_token=config['hs_token'])
+    await homeserver.start('127.0.0.1', int(config['matrix_baseurl'].rsplit(':', 1)[1]))
+    bridge_task = asyncio.ensure_future(bridge.main(**config, verbose=verbose, client_class=client_class))
+    return homeserver, bridge_task
+
+
+async def stop(homeserver, bridge_task):
+    bridge_task.cancel()
+    try:
+        await bridge_task
+    except asyncio.CancelledError:
+        pass
+    await homeserver.stop()
+
+
+async def run(scenario, accounts: int, port: int, timeout: float, trace_memory: bool, verbose: int):
+    if trace_memory:
+        tracemalloc.start()
+    rss_before = rss_bytes()
+
+    homeserver, bridge_task = await start(
+        bridge_config(accounts, port),
+        client_class=functools.partial(fakes.FakeFacebookClient, scenario=scenario),
+        verbose=verbose)
+    expected = scenario.messages * accounts
+    completed = await homeserver.wait_for_messages(expected, timeout)
+    await stop(homeserver, bridge_task)
+
+    latencies = fakes.message_latencies(homeserver)
+    arrivals = [arrived for arrived, room_id, sender, content in homeserver.received
+                if content.get('body', '').startswith('bench:')]
+    first_sent = min((arrived - latency for arrived, latency in zip(arrivals, latencies)), default=0)
+    duration = max(arrivals, default=first_sent) - first_sent
+
+    results = {
+        'completed': completed,
+        'messages_expected': expected,
+        'messages_received': len(latencies),
+        'duration_s': duration,
+        'messages_per_s': len(latencies) / duration if duration else None,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p99_s': percentile(latencies, 99),
+        'latency_max_s': max(latencies, default=None),
+        'latency_mean_s': statistics.mean(latencies) if latencies else None,
+        'homeserver_requests': homeserver.requests,
+        'rss_growth_bytes': rss_bytes() - rss_before,
+        'rss_peak_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    if trace_memory:
+        results['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def _measure_objects(client, count: int):
+    """Bytes allocated for each Person & Room, as if every one of them had been active at some point"""
+    import fbchat_bridge
+    gc.collect()
+    objects_before = memory.count_bridge_objects()
+    tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    people = []
+    for i in range(count):
+        fbid = str(3 * 10 ** 14 + i)
+        person = fbchat_bridge.Person(fb_client=client, fbid=fbid,
+                                      mxid=f"@fbchat_{client.uid}_{fbid}:{client.mx.domain}")
+        person.mx.mxid  # Like they'd just sent a message
+        people.append(person)
+    after_people = tracemalloc.get_traced_memory()[0]
+
+    rooms = []
+    for i in range(count):
+        fbid = str(4 * 10 ** 14 + i)
+        rooms.append(fbchat_bridge.Room(fb_client=client, fbid=fbid))
+    after_rooms = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+    gc.collect()
+    objects_after = memory.count_bridge_objects()
+    return {
+        'objects': count,
+        'bytes_per_person': (after_people - before) / count,
+        'bytes_per_room': (after_rooms - after_people) / count,
+        'intents_kept': objects_after['IntentAPI'] - objects_before['IntentAPI'],
+    }
+
+
+async def run_objects(count: int, group_size: int, port: int, timeout: float, verbose: int):
+    """
+    How much memory each known contact & thread costs, with count of each made in a running (but idle) bridge.
+    Run it before and after changing Person or Room to see what difference it made.
+    """
+    # No traffic, the groups are only there so each Room has a realistic participant list
+    scenario = fakes.Scenario(threads=0, messages=0, group_size=group_size)
+    homeserver, bridge_task = await start(
+        bridge_config(1, port),
+        client_class=functools.partial(fakes.FakeFacebookClient, scenario=scenario),
+        verbose=verbose)
+
+    deadline = time.monotonic() + timeout
+    clients = []
+    while not clients:
+        if time.monotonic() > deadline:
+            raise TimeoutError("The fake Facebook account never logged in")
+        await asyncio.sleep(0.1)
+        clients = [o for o in gc.get_objects() if isinstance(o, fakes.FakeFacebookClient)]
+
+    results = _measure_objects(clients[0], count)
+    await stop(homeserver, bridge_task)
+    return results
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Measure the bridge's throughput & latency against a fake homeserver and fake Facebook accounts")
+    argparser.add_argument('-a', '--accounts', type=int, default=1, help="Number of Facebook accounts")
+    argparser.add_argument('-t', '--threads', type=int, default=10, help="Facebook threads per account")
+    argparser.add_argument('-m', '--messages', type=int, default=1000, help="Messages per account")
+    argparser.add_argument('-b', '--burst', type=int, default=10, help="Messages per doOneListen() call")
+    argparser.add_argument('-i', '--interval', type=float, default=0, help="Seconds between each burst")
+    argparser.add_argument('-g', '--group-size', type=int, default=0,
+                           help="Make the threads group chats with this many participants")
+    argparser.add_argument('--typing', type=float, default=0, help="Chance of a typing event with each message")
+    argparser.add_argument('--presence', type=float, default=0, help="Chance of a presence event with each message")
+    argparser.add_argument('--port', type=int, default=29330, help="Appservice port, the homeserver uses the next one")
+    argparser.add_argument('--timeout', type=float, default=300, help="Give up waiting for messages after this long")
+    argparser.add_argument('--tracemalloc', action='store_true', help="Also trace Python allocations (slow)")
+    argparser.add_argument('--objects', type=int, metavar='N',
+                           help="Instead of passing messages, measure the memory used by N known contacts & threads")
+    argparser.add_argument('--json', type=argparse.FileType('w'), help="Write the results to this file as JSON")
+    argparser.add_argument('-v', '--verbose', default=0, action='count', help="Print debug output")
+    args = argparser.parse_args()
+
+    # The bridge writes its state & profile files into the working directory, keep them out of the way
+    os.chdir(tempfile.mkdtemp(prefix='fbchat-bench-'))
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+
+    if args.objects:
+        results = asyncio.run(run_objects(args.objects, group_size=args.group_size or 5, port=args.port,
+                                          timeout=args.timeout, verbose=args.verbose))
+    else:
+        results = asyncio.run(run(
+            fakes.Scenario(threads=args.threads, messages=args.messages, burst=args.burst, interval=args.interval,
+                           typing_ratio=args.typing, presence_ratio=args.presence, group_size=args.group_size),
+            accounts=args.accounts, port=args.port, timeout=args.timeout,
+            trace_memory=args.tracemalloc, verbose=args.verbose))
+
+    for key, value in results.items():
+        print(f"{key:>24}: {value:.4f}" if isinstance(value, float) else f"{key:>24}: {value}")
+    if args.json:
+        json.dump(results, args.json, indent=2)
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+import gzip
+import json
+import threading
+import time
+
+
+class CaptureWriter(object):
+    """
+    Append every raw payload the Facebook listener receives to a gzipped file of JSON lines.
+
+    Each time the file is opened a new gzip member is appended, starting with a header line saying whose payloads follow,
+    so restarting the bridge never rewrites what was already captured.
+    """
+    def __init__(self, filename: str, fbchat_uid: str, flush_every: int = 100, flush_interval: float = 5):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+        self.file = gzip.open(filename, 'at')
+        self.file.write(json.dumps({'header': True, 'uid': str(fbchat_uid), 'started': time.time()}) + '\n')
+
+    def write(self, topic, content):
+        with self._lock:
+            self.file.write(json.dumps({'t': time.time(), 'topic': topic, 'content': content}) + '\n')
+            self._unflushed += 1
+            # Flushing a gzip stream hurts the compression, so don't do it for every single payload
+            if self._unflushed >= self.flush_every or time.monotonic() - self._last_flush > self.flush_interval:
+                self.file.flush()
+                self._unflushed = 0
+                self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def read(filename: str):
+    """
+    Yield (uid, timestamp, topic, content) for every payload in a capture file, in the order they were received.
+    Captures from before fbchat listened over MQTT have no topic, they were all pull API payloads.
+    """
+    uid = None
+    with gzip.open(filename, 'rt') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line might have been cut off if the bridge died mid-write
+                continue
+            if record.get('header'):
+                uid = record['uid']
+            else:
+                yield uid, record['t'], record.get('topic'), record['content']
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class Checkpoints(object):
+    """
+    Remember the newest Facebook message bridged in each thread (and the last few message IDs),
+    so after a restart or listener error the bridge knows exactly what it missed, and never bridges anything twice.
+    """
+    def __init__(self, filename: str, remember: int = 50, save_interval: float = 5):
+        self.filename = filename
+        self.remember = remember
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        # Held for the whole save, so two threads saving at once can't put an older copy in place after a newer one
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0
+
+        self.high_water = {}  # thread_id -> timestamp (ms) of the newest message bridged
+        self.recent_mids = {}  # thread_id -> the last few message IDs bridged
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.high_water = {k: int(v) for k, v in data.get('high_water', {}).items()}
+        self.recent_mids = {k: collections.deque(v, maxlen=self.remember)
+                            for k, v in data.get('recent_mids', {}).items()}
+
+    def save(self, force: bool = True):
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty or (not force and time.monotonic() - self._last_save < self.save_interval):
+                    return
+                data = json.dumps({'high_water': self.high_water,
+                                   'recent_mids': {k: list(v) for k, v in self.recent_mids.items()}})
+                self._dirty = False
+                self._last_save = time.monotonic()
+            fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename) or '.',
+                                                prefix=f".{os.path.basename(self.filename)}.")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_filename, self.filename)
+            except BaseException:
+                os.unlink(tmp_filename)
+                raise
+
+    @property
+    def last_seen(self):
+        """Timestamp of the newest message bridged in any thread, None if nothing has ever been bridged"""
+        with self._lock:
+            return max(self.high_water.values(), default=None)
+
+    def since(self, thread_id: str):
+        with self._lock:
+            return self.high_water.get(thread_id)
+
+    def seen(self, thread_id: str, mid: str):
+        with self._lock:
+            return mid in self.recent_mids.get(thread_id, ())
+
+    def advance(self, thread_id: str, timestamp, mid: str):
+        with self._lock:
+            if timestamp:
+                self.high_water[thread_id] = max(int(timestamp), self.high_water.get(thread_id, 0))
+            if mid:
+                self.recent_mids.setdefault(thread_id, collections.deque(maxlen=self.remember)).append(mid)
+            self._dirty = True
+        self.save(force=False)
@@ -1,34 +1,310 @@
 #!/usr/bin/python3
+"""
+Commands the real user can send in their protocol room, to look at (and poke at) a running bridge.
+
+Each command is just an async function registered with @command, its arguments come from the message split up
+like a shell would, and are converted & validated using the function's signature and annotations.
+"""
+import asyncio
+import inspect
 import logging
-import mautrix.types
+import os
+import shlex
+import threading
+import time
+import tracemalloc
+
+import memory
+import metrics
+import profiler
+
+
+class CommandError(Exception):
+    """Something wrong with how a command was used, the message is sent back to the user as is"""
+
+
+_registry = {}
+
+
+def command(*words, help: str):
+    """Register a command under one or more words, e.g. @command('cache', 'flush', help="...")"""
+    def decorator(func):
+        _registry[words] = (func, help)
+        return func
+    return decorator
+
+
+def _usage(words, func):
+    params = list(inspect.signature(func).parameters.values())[1:]  # Skip the handler itself
+    parts = list(words)
+    for p in params:
+        if p.kind == p.VAR_POSITIONAL:
+            parts.append(f"[{p.name}...]")
+        elif p.default is p.empty:
+            parts.append(f"<{p.name}>")
+        else:
+            parts.append(f"[{p.name}]")
+    return ' '.join(parts)
+
+
+def _convert(func, args):
+    """Check the arguments against the function's signature, and convert them to the annotated types"""
+    signature = inspect.signature(func)
+    try:
+        bound = signature.bind(None, *args)
+    except TypeError:
+        raise CommandError("Wrong number of arguments")
+
+    converted = []
+    for name, value in list(bound.arguments.items())[1:]:
+        param = signature.parameters[name]
+        annotation = param.annotation if param.annotation is not param.empty else str
+        values = value if param.kind == param.VAR_POSITIONAL else (value,)
+        try:
+            values = [annotation(v) for v in values]
+        except ValueError:
+            raise CommandError(f"{name} must be {'an' if annotation is int else 'a'} {annotation.__name__}")
+        converted.extend(values)
+    return converted
 
 
-class _commands:
-    def echo(*args):
-        return ' '.join(args)
+def _format_seconds(seconds: float):
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    elif seconds < 2 * 60 * 60:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 60 / 60:.1f}h"
 
 
 class command_handler(object):
-    def __init__(self, matrix_bot, matrix_user_localpart: str, protocol_roomid: str):
+    def __init__(self, matrix_bot, matrix_user_localpart: str, protocol_roomid: str, account: dict = None,
+                 request_executor=None, sender=None):
         self.mx_bot = matrix_bot
+        # The rate limited sender from ratelimit.py, if there is one
+        self.sender = sender
         self.roomid = protocol_roomid
         self.username = f"@{matrix_user_localpart}:{matrix_bot.domain}"
+        # The running account from main.py, with the Facebook client, watchdog, etc. in it
+        self.account = account or {}
+        self.request_executor = request_executor
 
-    async def handle_event(self, mx_ev):
-        if not isinstance(mx_ev, mautrix.types.MessageEvent):
-            # Not a message, bail out
-            return
-        if mx_ev.room_id != self.roomid or mx_ev.sender != self.username:
-            # Message not in the protocol room and/or not from the real user
-            return
+    @property
+    def client(self):
+        if 'client' not in self.account:
+            raise CommandError("Facebook isn't logged in yet")
+        return self.account['client']
+
+    def find(self, body: str):
+        """Return the function & arguments for a command, longest matching name wins"""
+        try:
+            tokens = shlex.split(body)
+        except ValueError as e:
+            raise CommandError(f"Couldn't parse command: {e}")
+        for length in range(len(tokens), 0, -1):
+            words = tuple(tokens[:length])
+            if words in _registry:
+                func, _ = _registry[words]
+                try:
+                    return func, _convert(func, tokens[length:])
+                except CommandError as e:
+                    raise CommandError(f"{e}, usage: {_usage(words, func)}")
+        # Might just be the first word of a multi-word command
+        candidates = [_usage(words, func) for words, (func, _) in _registry.items() if tokens and words[0] == tokens[0]]
+        if candidates:
+            raise CommandError("Usage: " + ' | '.join(candidates))
+        raise CommandError("Unknown command, try 'help'")
 
+    async def handle_event(self, mx_ev):
+        # main.py only routes the real user's messages in the protocol room here
         logging.info(f"Running command {mx_ev.content.body}")
-        await self.mx_bot.send_text(
-            self.roomid,
-            # FIXME: How safe have I made eval?
-            str(eval(
-                mx_ev.content.body,
-                {'__builtins__': None},
-                vars(_commands)
-            ))
-        )
+        try:
+            func, args = self.find(mx_ev.content.body)
+            reply = await func(self, *args)
+        except CommandError as e:
+            reply = str(e)
+        except Exception as e:
+            logging.exception(f"Command {mx_ev.content.body} failed")
+            reply = f"Command failed: {e!r}"
+        if reply:
+            if self.sender:
+                await self.sender.send_text(self.mx_bot, self.roomid, str(reply))
+            else:
+                await self.mx_bot.send_text(self.roomid, str(reply))
+
+
+@command('help', help="List the available commands")
+async def _help(handler):
+    return '\n'.join(f"{_usage(words, func)} - {help}" for words, (func, help) in sorted(_registry.items()))
+
+
+@command('echo', help="Say it back")
+async def _echo(handler, *words):
+    return ' '.join(words)
+
+
+@command('stats', help="Overall numbers for this account")
+async def _stats(handler):
+    client = handler.client
+    latency = metrics.fb_to_mx_latency.means().get(())
+    return '\n'.join([
+        f"Up for {_format_seconds(time.time() - metrics.started.get())}",
+        f"Messages from Facebook: {metrics.handler_events.get(handler='facebook.onMessage')}",
+        f"Mean Facebook to Matrix latency: {f'{latency:.3f}s' if latency is not None else 'n/a'}",
+        f"Listener: {client.listener_phase} for {_format_seconds(time.monotonic() - client.listener_phase_since)}, "
+        f"restarted {metrics.listener_restarts.get(account=client.uid)} time(s)",
+        f"Handler errors: {metrics.handler_errors.get()}",
+        f"Matrix errors: {metrics.matrix_errors.get()} ({metrics.matrix_rate_limited.get()} rate limited, "
+        f"{metrics.matrix_timeouts.get()} timed out)",
+    ])
+
+
+@command('queues', help="What's waiting to be done")
+async def _queues(handler):
+    client = handler.client
+    lines = [client.listen_executor.summary()]
+    if handler.request_executor and handler.request_executor is not client.request_executor:
+        lines.append(handler.request_executor.summary())
+    lines.append(client.request_executor.summary())
+    if 'log_handler' in handler.account:
+        lines.append(f"Protocol room log queue: {handler.account['log_handler'].queue.qsize()}")
+    lines.append(f"Unfinished journal entries: {len(client.journal.pending())}")
+    return '\n'.join(lines)
+
+
+_caches = ('people', 'rooms', 'profiles')
+
+
+@command('cache', 'info', help="Size of each of the in-memory caches")
+async def _cache_info(handler):
+    client = handler.client
+    return '\n'.join([
+        f"people: {len(client._fb_people_cache)} by fbid, {len(client._mx_people_cache)} by mxid",
+        f"rooms: {len(client._fb_rooms_cache)} by fbid, {len(client._mx_rooms_cache)} by mxid",
+        f"profiles: {len(client.profiles.hashes)} profile hashes, {len(client.profiles.mxc_cache)} uploaded avatars",
+        f"intents: {len(client.intents)} of {client.intents.maxsize}, shared by all the accounts",
+    ])
+
+
+@command('cache', 'flush', help=f"Empty one of the caches ({', '.join(_caches)}), or all of them")
+async def _cache_flush(handler, which: str = 'all'):
+    if which not in _caches + ('all',):
+        raise CommandError(f"Unknown cache {which}, must be one of {', '.join(_caches)} or all")
+    client = handler.client
+    if which in ('people', 'all'):
+        client._fb_people_cache.clear()
+        client._mx_people_cache.clear()
+    if which in ('rooms', 'all'):
+        client._fb_rooms_cache.clear()
+        client._mx_rooms_cache.clear()
+    if which in ('profiles', 'all'):
+        # Forces every profile to be checked against Facebook again, but keeps the uploaded avatars
+        client.profiles.clear()
+        client.profiles.save()
+    return f"Flushed {which}"
+
+
+@command('rooms', 'resync', help="Refetch a Facebook thread's details and everyone's profiles in it")
+async def _rooms_resync(handler, fbid: str):
+    import fbchat_bridge  # Not imported at the top because fbchat is slow to import
+    client = handler.client
+
+    def resync():
+        room = fbchat_bridge.Room.get_from_fbid(fb_client=client, fbid=fbid)
+        room._update_fb_info()
+        room.sync_members()
+        people = [fbchat_bridge.Person.get_from_fbid(fb_client=client, fbid=uid, sync_profile=False)
+                  for uid in room.fb_participants]
+        client.profiles.sync(people, force=True)
+        return room, people
+    room, people = await client.run_blocking(resync)
+    return f"Resynced {room.mxid} with {len(people)} participant(s)"
+
+
+@command('backfill', help="Bridge a Facebook thread's most recent messages, skipping any already bridged")
+async def _backfill(handler, fbid: str, count: int = 50):
+    if not 0 < count <= 1000:
+        raise CommandError("count must be between 1 and 1000")
+    client = handler.client
+
+    def backfill():
+        messages = client.fetchThreadMessages(fbid, limit=count)
+        # The checkpoints only remember the last few message IDs, anything older than the newest one went in already
+        since = client.checkpoints.since(fbid)
+        bridged = 0
+        for message in sorted(messages, key=lambda m: int(m.timestamp)):
+            if since is not None and int(message.timestamp) <= since:
+                continue
+            if not client.checkpoints.seen(fbid, message.uid):
+                client._bridge_message(mid=message.uid, thread_id=fbid, message_object=message, ts=message.timestamp)
+                bridged += 1
+        return len(messages), bridged
+    # Behind anything else that's waiting to be bridged in the same thread, so nothing goes in out of order
+    fetched, bridged = await asyncio.wrap_future(client.message_queues.submit(fbid, backfill, wait=False))
+    return f"Fetched {fetched} message(s) from {fbid}, bridged {bridged} that hadn't been already"
+
+
+@command('listener', 'restart', help="Restart the Facebook listener")
+async def _listener_restart(handler):
+    if 'watchdog' not in handler.account:
+        raise CommandError("The listener isn't running yet")
+    handler.account['watchdog'].restart("restart requested from the protocol room")
+    return None  # The watchdog says so itself when it restarts
+
+
+@command('profile', help="Sample where the event loop & Facebook listener spend their time, for flamegraph.pl")
+async def _profile(handler, seconds: float = 10):
+    if not 0 < seconds <= 300:
+        raise CommandError("seconds must be between 0 and 300")
+    client = handler.client
+
+    sampler = profiler.Sampler({
+        # This is running in the event loop, so this thread is the loop's thread
+        'loop': threading.get_ident(),
+        # The watchdog might swap the listener's thread out while this runs
+        'listener': lambda: client._listen_thread,
+    })
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+
+    filename = os.path.abspath(f"profile_{client.uid}_{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+    await client.run_blocking(sampler.write_collapsed, filename)
+    return f"Wrote {filename}\n{sampler.summary()}"
+
+
+# tracemalloc is process wide, so there's only one of these no matter how many accounts there are
+_memory = memory.SnapshotTracker()
+
+
+@command('memory', 'snapshot', help="Show what's grown since the last snapshot, and how many bridge objects there are")
+async def _memory_snapshot(handler, top: int = 10):
+    client = handler.client
+    first = not _memory.tracing
+    growth = await client.run_blocking(_memory.snapshot, top)
+    objects = await client.run_blocking(memory.count_bridge_objects)
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced {current / 1024 / 1024:.1f}MB (peak {peak / 1024 / 1024:.1f}MB)",
+             "Objects: " + ', '.join(f"{name} {count}" for name, count in objects.items())]
+    state_store = getattr(handler.mx_bot, 'state_store', None)
+    if hasattr(state_store, 'summary'):
+        lines.append("State store: " + ', '.join(f"{k} {v}" for k, v in state_store.summary().items()))
+    if 'log_handler' in handler.account:
+        lines.append(f"Queued log records: {handler.account['log_handler'].queue.qsize()}")
+
+    if first:
+        lines.append("Started tracing, this is the baseline. Send this again later to see what's grown since.")
+    elif growth is not None:
+        lines.append(f"Top {len(growth)} growth since the last snapshot:")
+        lines.extend(str(stat) for stat in growth)
+    return '\n'.join(lines)
+
+
+@command('memory', 'stop', help="Stop tracing memory allocations, it slows everything down")
+async def _memory_stop(handler):
+    if not _memory.tracing:
+        return "Wasn't tracing"
+    _memory.stop()
+    return "Stopped tracing"
@@ -0,0 +1,16 @@
+#!/usr/bin/python3
+import yaml
+
+
+def get_accounts(config):
+    """Older config files only had a single Facebook account in the top level, newer ones have a list of them"""
+    if 'accounts' in config:
+        return config['accounts']
+    return [{key: config[key] for key in (
+        'fbchat_username', 'fbchat_uid', 'fbchat_session', 'matrix_user_localpart')}]
+
+
+def load(yaml_file):
+    config = yaml.load(yaml_file)
+    config['accounts'] = get_accounts(config)
+    return config
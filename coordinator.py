@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+import asyncio
+import logging
+import signal
+import sys
+import urllib.parse
+import zlib
+
+import aiohttp
+import aiohttp.web
+
+import config
+
+
+def shard_of(fbchat_uid, shards: int):
+    """Which worker a Facebook account belongs to. Needs to be stable across restarts, so no hash()"""
+    return zlib.crc32(str(fbchat_uid).encode()) % shards
+
+
+class Worker(object):
+    """A single main.py process running the shard of Facebook accounts it's been given"""
+    def __init__(self, index: int, shards: int, port: int, config_filename: str, verbose: int, log):
+        self.index = index
+        self.shards = shards
+        self.port = port
+        self.config_filename = config_filename
+        self.verbose = verbose
+        self.log = log
+
+        self.accounts = []
+        self.process = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def owns_user(self, user_id: str, domain: str):
+        for account in self.accounts:
+            if user_id.startswith(f"@fbchat_{account['fbchat_uid']}_"):
+                return True
+            if user_id == f"@{account['matrix_user_localpart']}:{domain}":
+                return True
+        return False
+
+    async def start(self):
+        self.log.info(f"Starting worker {self.index}/{self.shards} on port {self.port} for {len(self.accounts)} account(s)")
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, sys.argv[0], self.config_filename,
+            '--shard', f"{self.index}/{self.shards}",
+            '--port', str(self.port),
+            *(['-' + 'v' * self.verbose] if self.verbose else []),
+        )
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+    async def supervise(self):
+        # Keep the worker running forever, restarting it whenever it dies or gets stopped for a rebalance
+        while True:
+            await self.start()
+            returncode = await self.process.wait()
+            self.log.warning(f"Worker {self.index} exited with {returncode}, restarting")
+            await asyncio.sleep(1)
+
+
+class Coordinator(object):
+    """
+    Own the appservice's HTTP endpoint and hand the Matrix transactions out to worker processes,
+    each of which is a normal main.py running just a shard of the Facebook accounts.
+
+    The workers listen on loopback ports and get the transactions in exactly the same form Synapse would send them,
+    so they don't need to know they're behind a coordinator at all.
+
+    Each account's worker comes from a hash of its uid, modulo the number of workers, and each worker works out
+    its own accounts the same way. So a rebalance only moves added or removed accounts in or out of their workers,
+    it never changes how many workers there are or evens out a lopsided split. That needs a restart with a new -w.
+    """
+    def __init__(self, config_filename: str, workers: int, verbose: int, log):
+        self.config_filename = config_filename
+        self.verbose = verbose
+        self.log = log
+
+        self.config = self._load_config()
+        base_port = urllib.parse.urlsplit(self.config['url']).port
+        self.workers = [Worker(index=i, shards=workers, port=base_port + 1 + i,
+                               config_filename=config_filename, verbose=verbose, log=log)
+                        for i in range(workers)]
+        self._assign_accounts()
+
+        self.app = aiohttp.web.Application()
+        for prefix in ('', '/_matrix/app/v1'):
+            self.app.router.add_put(prefix + '/transactions/{transaction_id}', self.handle_transaction)
+            self.app.router.add_get(prefix + '/users/{user_id}', self.handle_query)
+            self.app.router.add_get(prefix + '/rooms/{alias}', self.handle_query)
+
+    def _load_config(self):
+        with open(self.config_filename, 'r') as f:
+            return config.load(f)
+
+    def _assign_accounts(self):
+        """Returns the workers whose set of accounts has changed"""
+        changed = []
+        for worker in self.workers:
+            accounts = [a for a in self.config['accounts'] if shard_of(a['fbchat_uid'], len(self.workers)) == worker.index]
+            if [a['fbchat_uid'] for a in accounts] != [a['fbchat_uid'] for a in worker.accounts]:
+                changed.append(worker)
+            worker.accounts = accounts
+        return changed
+
+    async def rebalance(self):
+        """Reread the config and restart only the workers whose accounts have changed"""
+        self.log.info("Rebalancing workers")
+        self.config = self._load_config()
+        for worker in self._assign_accounts():
+            # The supervisor will start it again with the new accounts
+            await worker.stop()
+        # The number of workers is fixed, so make it obvious if the hash has left them unevenly loaded
+        self.log.info("Accounts per worker: " + ', '.join(f"{w.index}: {len(w.accounts)}" for w in self.workers))
+
+    def _route(self, event):
+        user_ids = [event.get('sender'), event.get('state_key')]
+        user_ids = [u for u in user_ids if u and u.startswith('@')]
+        matches = [w for w in self.workers if any(w.owns_user(u, self.config['matrix_domain']) for u in user_ids)]
+        # If it can't be worked out who it's for, send it everywhere and let the workers ignore it
+        return matches or self.workers
+
+    def _check_token(self, request):
+        if request.query.get('access_token') != self.config['hs_token']:
+            raise aiohttp.web.HTTPForbidden()
+
+    async def _forward_transaction(self, session, worker, transaction_id, events):
+        async with session.put(f"{worker.url}/transactions/{transaction_id}",
+                               params={'access_token': self.config['hs_token']},
+                               json={'events': events}) as response:
+            return response.status
+
+    async def handle_transaction(self, request):
+        self._check_token(request)
+        transaction_id = request.match_info['transaction_id']
+        events = (await request.json()).get('events', [])
+
+        shards = {}
+        for event in events:
+            for worker in self._route(event):
+                shards.setdefault(worker, []).append(event)
+
+        async with aiohttp.ClientSession() as session:
+            responses = await asyncio.gather(*(
+                self._forward_transaction(session, worker, transaction_id, worker_events)
+                for worker, worker_events in shards.items()), return_exceptions=True)
+
+        failed = [r for r in responses if isinstance(r, Exception) or r >= 300]
+        if failed:
+            # Let the homeserver retry the transaction, the workers will skip the ones they've already seen
+            self.log.warning(f"Transaction {transaction_id} failed on {len(failed)} worker(s): {failed}")
+            raise aiohttp.web.HTTPServiceUnavailable()
+        return aiohttp.web.json_response({})
+
+    async def handle_query(self, request):
+        self._check_token(request)
+        # Whichever worker knows about the user/alias gets to answer, they'll all 404 otherwise
+        path = request.path.replace('/_matrix/app/v1', '', 1)
+        async with aiohttp.ClientSession() as session:
+            for worker in self.workers:
+                try:
+                    async with session.get(f"{worker.url}{path}", params=request.query) as response:
+                        if response.status == 200:
+                            return aiohttp.web.json_response(await response.json())
+                except aiohttp.ClientError:
+                    continue
+        raise aiohttp.web.HTTPNotFound()
+
+    async def run(self):
+        url_parsed = urllib.parse.urlsplit(self.config['url'])
+        runner = aiohttp.web.AppRunner(self.app)
+        await runner.setup()
+        await aiohttp.web.TCPSite(runner, url_parsed.hostname, url_parsed.port).start()
+
+        # SIGHUP to pick up accounts added with register.py without restarting everything
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rebalance()))
+        # SIGTERM stops the workers (which drain and checkpoint themselves) before exiting
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        self.log.info(f"Coordinating {len(self.config['accounts'])} account(s) across {len(self.workers)} worker(s)")
+        try:
+            await asyncio.gather(*(worker.supervise() for worker in self.workers))
+        except asyncio.CancelledError:
+            self.log.info("Stopping all workers")
+        finally:
+            await asyncio.gather(*(worker.stop() for worker in self.workers))
+            await runner.cleanup()
+
+
+def run(config_filename: str, workers: int, verbose: int):
+    logging.basicConfig(format='%(levelname)s:%(name)s:%(funcName)s:%(message)s')
+    log = logging.getLogger(__name__)
+    log.setLevel(max(30 - (10 * verbose), logging.DEBUG))
+
+    asyncio.run(Coordinator(config_filename=config_filename, workers=workers, verbose=verbose, log=log).run())
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+import asyncio
+import threading
+
+import metrics
+
+
+class Debouncer(object):
+    """
+    Hold on to updates for a short window, and only apply the latest one for each key.
+
+    Used for room state, so a rename war in a Facebook group (or someone changing everyone's nicknames one by one)
+    ends up as one state event per thing changed instead of dozens.
+
+    submit() can be called from any thread, the updates themselves are applied in the event loop.
+    """
+    def __init__(self, loop, window: float = 2, log=None):
+        self.loop = loop
+        self.window = window
+        self.log = log
+        self._lock = threading.Lock()
+        self._latest = {}  # key -> (coroutine function, args)
+        self._timers = {}
+        self._running = set()
+
+    def submit(self, key, func, *args):
+        """Schedule func(*args) to run in window seconds, replacing anything already scheduled for the same key"""
+        with self._lock:
+            replaced = key in self._latest
+            self._latest[key] = (func, args)
+        if replaced:
+            metrics.state_updates.inc(result='coalesced')
+        else:
+            self.loop.call_soon_threadsafe(self._schedule, key)
+
+    def _schedule(self, key):
+        with self._lock:
+            if key not in self._latest:
+                return  # Already flushed before this got a chance to run
+        self._timers[key] = self.loop.call_later(self.window, self._fire, key)
+
+    def _fire(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        with self._lock:
+            if key not in self._latest:
+                return
+            func, args = self._latest.pop(key)
+        task = asyncio.ensure_future(self._apply(key, func, args))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _apply(self, key, func, args):
+        try:
+            await func(*args)
+            metrics.state_updates.inc(result='sent')
+        except Exception:
+            metrics.state_updates.inc(result='failed')
+            if self.log:
+                self.log.exception(f"Failed to update {key}")
+
+    async def flush(self):
+        """Apply everything that's waiting right now, instead of at the end of its window"""
+        # Going by what's been submitted rather than the timers, some of those might not have been scheduled yet
+        with self._lock:
+            keys = list(self._latest)
+        for key in keys:
+            self._fire(key)
+        if self._running:
+            await asyncio.wait(list(self._running))
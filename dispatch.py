@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+import asyncio
+import collections
+import logging
+
+
+def _type_name(event_type):
+    # mautrix's EventType keeps the actual "m.room.message" string in .t
+    return getattr(event_type, 't', None) or str(event_type)
+
+
+def _matches(value, wanted):
+    if wanted is None:
+        return True
+    elif callable(wanted):
+        return wanted(value)
+    return value in wanted
+
+
+class Dispatcher(object):
+    """
+    Route each Matrix event only to the handlers that want it, by event type, room and sender.
+
+    mautrix hands every event to every registered handler, which then all had to work out for themselves
+    whether it was any of their business. Instead this is the only handler mautrix knows about,
+    and it does those checks once, up front, with just a dict lookup and some set membership tests.
+
+    rooms & senders can each be None (anything), a collection of IDs, or a callable for IDs that aren't known yet.
+
+    Each room gets its own queue, so events in one room are always handled in the order they arrived,
+    but a room that's waiting on a slow request doesn't hold up any of the others.
+    At most max_concurrent events are handled at once across all the rooms.
+
+    A route can also have a ready future, e.g. for an account that's still logging in.
+    Its events wait for that without taking up any of the max_concurrent slots, so they can't hold up anyone else.
+    """
+    # The state store keeps track of these, so they're always let through even if nothing's routed for them
+    STATE_STORE_TYPES = frozenset(('m.room.member', 'm.room.power_levels'))
+
+    def __init__(self, log=None, max_concurrent: int = 16):
+        self.log = log or logging.getLogger(__name__)
+        self.max_concurrent = max_concurrent
+        # event type (None for any type) -> [(handler, rooms, senders, ready)]
+        self._routes = collections.defaultdict(list)
+
+        # room ID -> events waiting to be handled, only exists while that room's worker is running
+        self._rooms = {}
+        self._workers = set()
+        self._semaphore = None  # Created on first use, so it's made inside the running event loop
+
+    def add(self, handler, event_types=None, rooms=None, senders=None, ready=None):
+        if isinstance(rooms, str):
+            rooms = {rooms}
+        if isinstance(senders, str):
+            senders = {senders}
+        for event_type in (event_types or (None,)):
+            self._routes[_type_name(event_type) if event_type else None].append((handler, rooms, senders, ready))
+
+    def _routes_for(self, event_type, room_id: str, sender: str):
+        return [(handler, ready)
+                for handler, rooms, senders, ready in self._routes.get(event_type, []) + self._routes.get(None, [])
+                if _matches(room_id, rooms) and _matches(sender, senders)]
+
+    def handlers_for(self, event_type, room_id: str, sender: str):
+        return [handler for handler, ready in self._routes_for(event_type, room_id, sender)]
+
+    def _wants(self, event_type, room_id: str, sender: str):
+        return event_type in self.STATE_STORE_TYPES or bool(self._routes_for(event_type, room_id, sender))
+
+    def wants_raw(self, raw_event: dict):
+        """Cheap check on an event straight out of the transaction JSON"""
+        return self._wants(raw_event.get('type'), raw_event.get('room_id'), raw_event.get('sender'))
+
+    def wants(self, event):
+        """Same as wants_raw(), for either raw or parsed events"""
+        if isinstance(event, dict):
+            return self.wants_raw(event)
+        return self._wants(_type_name(event.type), event.room_id, event.sender)
+
+    def filter_transactions(self, matrix_appservice):
+        """
+        Drop events nothing wants as soon as mautrix takes them out of a transaction,
+        before it makes a task for each of its handlers (the state store's and dispatch()) to pick them over.
+        Older mautrix versions hand over the raw JSON, newer ones have already parsed it by then.
+        """
+        handle_matrix_event = matrix_appservice.handle_matrix_event
+
+        def filtered_handle_matrix_event(event):
+            if self.wants(event):
+                return handle_matrix_event(event)
+        # mautrix's transaction handler looks this up on the instance every time, so the route doesn't need changing
+        matrix_appservice.handle_matrix_event = filtered_handle_matrix_event
+
+    @property
+    def queued(self):
+        """Events waiting to be handled (or being handled right now)"""
+        return sum(len(queue) for queue in self._rooms.values())
+
+    async def _run_room(self, room_id, queue):
+        try:
+            while queue:
+                mx_ev, routes = queue[0]
+                not_ready = [ready for handler, ready in routes if ready is not None and not ready.done()]
+                if not_ready:
+                    # Whether it worked or not is up to the handler to deal with, this only waits for it
+                    await asyncio.wait(not_ready)
+                async with self._semaphore:
+                    for handler, ready in routes:
+                        try:
+                            await handler(mx_ev)
+                        except Exception:
+                            self.log.exception(f"Failed to handle {_type_name(mx_ev.type)} event in {room_id}")
+                queue.popleft()
+        finally:
+            # Nothing can be added between the queue running dry and this, there's no await in between
+            del self._rooms[room_id]
+
+    async def dispatch(self, mx_ev):
+        routes = self._routes_for(_type_name(mx_ev.type), mx_ev.room_id, mx_ev.sender)
+        if not routes:
+            return
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        queue = self._rooms.get(mx_ev.room_id)
+        if queue is None:
+            queue = self._rooms[mx_ev.room_id] = collections.deque()
+            worker = asyncio.ensure_future(self._run_room(mx_ev.room_id, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        queue.append((mx_ev, routes))
+
+    async def drain(self):
+        """Wait until every queued event has been handled"""
+        while self._workers:
+            await asyncio.wait(list(self._workers))
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class InstrumentedExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that keeps track of how long jobs wait for a thread, and how long they then take to run.
+
+    Used for all the blocking fbchat calls so they don't have to fight over the event loop's small default executor.
+    """
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.name = thread_name_prefix
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'queued': 0,
+            'cancelled': 0,
+            'completed': 0,
+            'failed': 0,
+            'running': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'run_total': 0.0,
+            'run_max': 0.0,
+        }
+
+    def _timed(self, submitted_at, fn, *args, **kwargs):
+        started_at = time.monotonic()
+        wait = started_at - submitted_at
+        with self._stats_lock:
+            self.stats['queued'] -= 1
+            self.stats['running'] += 1
+            self.stats['wait_total'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+        failed = False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            run = time.monotonic() - started_at
+            with self._stats_lock:
+                self.stats['running'] -= 1
+                self.stats['completed'] += 1
+                self.stats['failed'] += failed
+                self.stats['run_total'] += run
+                self.stats['run_max'] = max(self.stats['run_max'], run)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.stats['submitted'] += 1
+            self.stats['queued'] += 1
+        future = super().submit(self._timed, time.monotonic(), fn, *args, **kwargs)
+        future.add_done_callback(self._check_cancelled)
+        return future
+
+    def _check_cancelled(self, future):
+        # A job can only be cancelled before it's started, so it'll never get to _timed() to leave the queue
+        if future.cancelled():
+            with self._stats_lock:
+                self.stats['queued'] -= 1
+                self.stats['cancelled'] += 1
+
+    @property
+    def queued(self):
+        """Jobs submitted but not yet picked up by a thread"""
+        with self._stats_lock:
+            return self.stats['queued']
+
+    @property
+    def saturation(self):
+        """Fraction of the threads that are currently busy"""
+        with self._stats_lock:
+            return self.stats['running'] / self._max_workers
+
+    def summary(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        completed = stats['completed'] or 1
+        return (f"{self.name}: {stats['running']}/{self._max_workers} busy, "
+                f"{stats['queued']} queued, "
+                f"{stats['completed']} done ({stats['failed']} failed, {stats['cancelled']} cancelled), "
+                f"wait avg {stats['wait_total'] / completed:.3f}s max {stats['wait_max']:.3f}s, "
+                f"run avg {stats['run_total'] / completed:.3f}s max {stats['run_max']:.3f}s")
+
+
+
+class SerialQueues(object):
+    """
+    Run jobs in an executor one at a time, in order, for each key, while different keys run concurrently.
+
+    Used to get each Facebook thread's messages into Matrix in the order they were sent,
+    without the listener having to sit and wait for them before it can poll again.
+    Each job is resubmitted to the executor on its own, so one busy key can't hog a thread.
+
+    Once max_queued jobs are waiting, submit() blocks until there's room again, unless told not to wait.
+    """
+    def __init__(self, executor, max_queued: int = 1000):
+        self.executor = executor
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._queues = {}  # key -> deque of (future, fn, args), only exists while the key has jobs
+        self._queued = 0
+
+    @property
+    def queued(self):
+        with self._cond:
+            return self._queued
+
+    def submit(self, key, fn, *args, wait: bool = True):
+        """Returns a concurrent.futures.Future for the result of fn(*args)"""
+        future = concurrent.futures.Future()
+        with self._cond:
+            while wait and self._queued >= self.max_queued:
+                self._cond.wait()
+            self._queued += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((future, fn, args))
+                return future
+            queue = self._queues[key] = collections.deque([(future, fn, args)])
+        self.executor.submit(self._run_next, key, queue)
+        return future
+
+    def _run_next(self, key, queue):
+        future, fn, args = queue[0]
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        with self._cond:
+            queue.popleft()
+            self._queued -= 1
+            self._cond.notify_all()
+            if not queue:
+                del self._queues[key]
+                return
+        self.executor.submit(self._run_next, key, queue)
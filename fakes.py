@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+"""
+Stand-ins for Synapse and Facebook, so the bridge can be driven as hard as we like without either of them.
+Used by benchmark.py, replay.py and soak.py.
+"""
+import asyncio
+import itertools
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+import aiohttp.web
+import fbchat
+
+import fbchat_bridge
+
+
+class FakeHomeserver(object):
+    """
+    Just enough of the client-server & appservice APIs for the bridge to run against.
+
+    Rooms, aliases, state and membership are tracked so the bridge's lookups behave like they would with Synapse,
+    and invites are pushed back to the appservice as transactions so the invite autoaccepter gets exercised too.
+    Every message sent into a room is recorded along with when it arrived.
+    """
+    def __init__(self, domain: str, bot_localpart: str, appservice_url: str, hs_token: str):
+        self.domain = domain
+        self.bot_mxid = f"@{bot_localpart}:{domain}"
+        self.appservice_url = appservice_url
+        self.hs_token = hs_token
+
+        self.aliases = {}
+        self.room_state = {}  # room_id -> {(type, state_key): content}
+        self.received = []  # (arrival time, room_id, sender, content) of every message event
+        self.received_event = asyncio.Event()
+        self.bench_received = 0  # Only the messages made up by FakeFacebookClient, not protocol room logging
+        self.requests = 0
+
+        self._ids = itertools.count()
+        self._transaction_ids = itertools.count()
+
+        self.app = aiohttp.web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_route('*', '/{path:.*}', self.handle)
+        self._runner = None
+        self._session = None
+
+    def _new_id(self, sigil: str):
+        return f"{sigil}{next(self._ids)}:{self.domain}"
+
+    async def start(self, host: str, port: int):
+        self._runner = aiohttp.web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, host, port).start()
+        self._session = aiohttp.ClientSession()
+
+    async def stop(self):
+        await self._session.close()
+        await self._runner.cleanup()
+
+    async def push_transaction(self, events):
+        """Send events to the appservice like Synapse would"""
+        async with self._session.put(f"{self.appservice_url}/transactions/{next(self._transaction_ids)}",
+                                     params={'access_token': self.hs_token}, json={'events': events}) as response:
+            return response.status
+
+    def _push_later(self, events):
+        asyncio.ensure_future(self.push_transaction(events))
+
+    def _member_event(self, room_id, sender, state_key, membership):
+        content = {'membership': membership}
+        self.room_state.setdefault(room_id, {})[('m.room.member', state_key)] = content
+        return {'type': 'm.room.member', 'room_id': room_id, 'sender': sender, 'state_key': state_key,
+                'content': content, 'event_id': self._new_id('$'), 'origin_server_ts': int(time.time() * 1000)}
+
+    async def handle(self, request):
+        self.requests += 1
+        path = '/' + request.match_info['path']
+        user_id = request.query.get('user_id', self.bot_mxid)
+        body = await request.json() if request.can_read_body and request.content_type == 'application/json' else {}
+
+        if path.startswith('/_matrix/media/'):
+            await request.read()
+            return aiohttp.web.json_response({'content_uri': f"mxc://{self.domain}/{next(self._ids)}"})
+
+        path = re.sub(r'^/_matrix/client/(r0|v3|unstable)', '', path)
+        parts = [urllib.parse.unquote(p) for p in path.strip('/').split('/')]
+
+        if parts[0] == 'account' and parts[1:] == ['whoami']:
+            return aiohttp.web.json_response({'user_id': user_id})
+
+        if parts[0] == 'register':
+            return aiohttp.web.json_response({'user_id': f"@{body.get('username')}:{self.domain}"})
+
+        if parts[0] == 'directory' and parts[1] == 'room':
+            if request.method == 'GET':
+                if parts[2] not in self.aliases:
+                    return aiohttp.web.json_response({'errcode': 'M_NOT_FOUND', 'error': "Room alias not found"},
+                                                     status=404)
+                return aiohttp.web.json_response({'room_id': self.aliases[parts[2]], 'servers': [self.domain]})
+            self.aliases[parts[2]] = body.get('room_id')
+            return aiohttp.web.json_response({})
+
+        if parts[0] == 'createRoom':
+            room_id = self._new_id('!')
+            self.room_state[room_id] = {}
+            events = [self._member_event(room_id, user_id, user_id, 'join')]
+            if body.get('room_alias_name'):
+                alias = f"#{body['room_alias_name']}:{self.domain}"
+                self.aliases[alias] = room_id
+                self.room_state[room_id][('m.room.canonical_alias', '')] = {'alias': alias}
+            if body.get('name'):
+                self.room_state[room_id][('m.room.name', '')] = {'name': body['name']}
+            for event in body.get('initial_state', []):
+                self.room_state[room_id][(event['type'], event.get('state_key', ''))] = event['content']
+            events += [self._member_event(room_id, user_id, invitee, 'invite') for invitee in body.get('invite', [])]
+            self._push_later(events)
+            return aiohttp.web.json_response({'room_id': room_id})
+
+        if parts[0] == 'join':
+            room_id = self.aliases.get(parts[1], parts[1])
+            self._member_event(room_id, user_id, user_id, 'join')
+            return aiohttp.web.json_response({'room_id': room_id})
+
+        if parts[0] == 'rooms':
+            room_id = parts[1]
+            action = parts[2] if len(parts) > 2 else None
+            state = self.room_state.setdefault(room_id, {})
+
+            if action == 'send':
+                self.received.append((time.time(), room_id, user_id, body))
+                if body.get('body', '').startswith('bench:'):
+                    self.bench_received += 1
+                self.received_event.set()
+                return aiohttp.web.json_response({'event_id': self._new_id('$')})
+            if action == 'state':
+                key = (parts[3], parts[4] if len(parts) > 4 else '')
+                if request.method == 'GET':
+                    if key not in state:
+                        return aiohttp.web.json_response({'errcode': 'M_NOT_FOUND', 'error': "Event not found"},
+                                                         status=404)
+                    content = dict(state[key])
+                    if key[0] == 'm.room.canonical_alias':
+                        # The bridge reads it back both ways
+                        content.setdefault('canonical_alias', content.get('alias'))
+                    return aiohttp.web.json_response(content)
+                state[key] = body
+                return aiohttp.web.json_response({'event_id': self._new_id('$')})
+            if action in ('join', 'leave'):
+                self._member_event(room_id, user_id, user_id, action)
+                return aiohttp.web.json_response({'room_id': room_id})
+            if action in ('invite', 'kick', 'ban'):
+                membership = {'invite': 'invite', 'kick': 'leave', 'ban': 'ban'}[action]
+                event = self._member_event(room_id, user_id, body['user_id'], membership)
+                if action == 'invite':
+                    self._push_later([event])
+                return aiohttp.web.json_response({})
+            if action == 'joined_members':
+                return aiohttp.web.json_response({'joined': {
+                    state_key: {} for (event_type, state_key), content in state.items()
+                    if event_type == 'm.room.member' and content.get('membership') == 'join'}})
+
+        # Profiles, typing, receipts, presence, etc. Nothing the bridge reads back.
+        return aiohttp.web.json_response({})
+
+    async def wait_for_messages(self, count: int, timeout: float):
+        """Wait until count benchmark messages have arrived, False if it timed out first"""
+        deadline = time.monotonic() + timeout
+        while self.bench_received < count:
+            self.received_event.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.received_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+class _NoLogin(fbchat.Client):
+    """Sits between fbchat_bridge.Client and fbchat.Client in the MRO so nothing ever talks to Facebook"""
+    def __init__(self, email, password, session_cookies=None, max_tries=None, **kwargs):
+        self.email = email
+        self.uid = str(session_cookies.get('c_user', email)) if session_cookies else str(email)
+        self.listening = False
+
+    def isLoggedIn(self):
+        return True
+
+    def getSession(self):
+        return {'c_user': self.uid}
+
+    def setActiveStatus(self, markAlive):
+        pass
+
+    def startListening(self):
+        self.listening = True
+
+    def stopListening(self):
+        self.listening = False
+
+    def onListening(self):
+        pass
+
+
+class Scenario(object):
+    """What the fake Facebook accounts should do, shared by all of them"""
+    def __init__(self, threads: int = 10, messages: int = 1000, burst: int = 10, interval: float = 0,
+                 typing_ratio: float = 0, presence_ratio: float = 0, group_size: int = 0,
+                 new_contact_ratio: float = 0, seed: int = 0):
+        self.threads = threads
+        self.messages = messages  # None for no limit
+        self.new_contact_ratio = new_contact_ratio  # Chance of each message coming from a never before seen contact
+        self.burst = burst
+        self.interval = interval
+        self.typing_ratio = typing_ratio
+        self.presence_ratio = presence_ratio
+        self.group_size = group_size
+        self.random = random.Random(seed)
+
+
+class FakeFacebookClient(fbchat_bridge.Client, _NoLogin):
+    """
+    fbchat_bridge.Client with a doOneListen() that makes up traffic instead of long-polling Facebook.
+
+    Each poll emits a burst of onMessage events (plus typing & presence noise) spread across the scenario's threads.
+    Message text carries the time it was "sent" on Facebook, so the fake homeserver can work out the latency.
+    """
+    def __init__(self, *args, scenario: Scenario, **kwargs):
+        self.scenario = scenario
+        self.sent = 0
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+        self.contacts = [str(10 ** 14 + i) for i in range(max(scenario.threads, scenario.group_size))]
+
+    def _thread_id(self, index):
+        # Threads with a group_size are group chats with made up ids, the rest are 1:1 chats with a contact
+        return str(2 * 10 ** 14 + index) if self.scenario.group_size else self.contacts[index]
+
+    def fetchThreadInfo(self, *thread_ids):
+        threads = {}
+        for thread_id in thread_ids:
+            if thread_id in self.contacts:
+                threads[thread_id] = fbchat.User(thread_id, name=f"Contact {thread_id}", is_friend=True)
+            else:
+                threads[thread_id] = fbchat.Group(thread_id, name=f"Group {thread_id}",
+                                                  participants=set(self.contacts[:self.scenario.group_size]))
+        return threads
+
+    def fetchThreadList(self, *args, **kwargs):
+        # Fake Facebook has no history, so there's never anything to catch up on
+        return []
+
+    def fetchUserInfo(self, *user_ids):
+        return {uid: fbchat.User(uid, name=f"Contact {uid}", is_friend=True) for uid in user_ids}
+
+    def _author(self, thread_index):
+        if self.scenario.group_size:
+            return self.scenario.random.choice(self.contacts[:self.scenario.group_size])
+        return self.contacts[thread_index]
+
+    def doOneListen(self):
+        if self.scenario.interval:
+            time.sleep(self.scenario.interval)
+
+        for _ in range(self.scenario.burst):
+            with self._lock:
+                if self.scenario.messages is not None and self.sent >= self.scenario.messages:
+                    self.listening = False
+                    return
+                self.sent += 1
+                seq = self.sent
+
+            if not self.scenario.group_size and self.scenario.random.random() < self.scenario.new_contact_ratio:
+                # A brand new 1:1 chat, so the bridge has to keep growing its caches
+                self.contacts.append(str(10 ** 14 + len(self.contacts)))
+                thread_index = len(self.contacts) - 1
+            else:
+                thread_index = self.scenario.random.randrange(self.scenario.threads)
+            thread_id = self._thread_id(thread_index)
+            author = self._author(thread_index)
+            thread_type = fbchat.ThreadType.GROUP if self.scenario.group_size else fbchat.ThreadType.USER
+
+            if self.scenario.random.random() < self.scenario.typing_ratio:
+                self.onTyping(author_id=author, status=fbchat.TypingStatus.TYPING,
+                              thread_id=thread_id, thread_type=thread_type, msg={})
+            if self.scenario.random.random() < self.scenario.presence_ratio:
+                self.onBuddylistOverlay(statuses={author: None}, msg={})
+
+            ts = int(time.time() * 1000)
+            message = fbchat.Message(text=f"bench:{self.uid}:{seq}:{ts}")
+            message.author = author
+            message.uid = f"mid.{self.uid}.{seq}"
+            message.timestamp = ts
+            self.onMessage(mid=message.uid, author_id=author, message=message.text, message_object=message,
+                           thread_id=thread_id, thread_type=thread_type, ts=ts, metadata={}, msg={})
+
+
+def message_latencies(homeserver):
+    """Latency of every benchmark message the homeserver received, worked out from the timestamp in its text"""
+    latencies = []
+    for arrived, room_id, sender, content in homeserver.received:
+        body = content.get('body', '')
+        if body.startswith('bench:'):
+            latencies.append(arrived - int(body.rsplit(':', 1)[1]) / 1000)
+    return latencies
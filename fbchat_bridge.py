@@ -1,20 +1,35 @@
 #!/usr/bin/python3
 import logging
 import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import sys
+import threading
+import time
 
 import mautrix.errors
 import mautrix.client.api.types
 import fbchat
 fbchat.log.setLevel(logging.WARNING)
 
+import capture
+import checkpoints
+import debounce
+import executors
+import intents
+import journal
+import metrics
+import profiles
+import ratelimit
+import tracing
 
-_fb_rooms_cache = {}
-_mx_rooms_cache = {}
-_fb_people_cache = {}
-_mx_people_cache = {}
 
+# Nothing the listener asks of Matrix should take anywhere near this long, if it does then something's stuck
+MX_CORO_TIMEOUT = 120
 
-def mx_coro(mx, coro):
+
+def mx_coro(mx, coro, timeout: float = MX_CORO_TIMEOUT):
     """
     Because the Facebook listener runs in an executor, it's not easy to directly inject into mautrix's event loop.
     I've created this function just so it can be done a little less verbosely
@@ -35,34 +50,63 @@ def mx_coro(mx, coro):
             coro=coro,
             loop=mx.loop,
         )
-        return future.result()  # FIXME: Should I include a timeout?
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            metrics.matrix_timeouts.inc()
+            raise
+        except mautrix.errors.MatrixRequestError as e:
+            metrics.count_matrix_error(e)
+            raise
+
+
+# Facebook thread settings with no Matrix equivalent are kept in these
+THREAD_COLOR_EVENT = mautrix.client.api.types.EventType.find('fbchat.thread.color')
+THREAD_EMOJI_EVENT = mautrix.client.api.types.EventType.find('fbchat.thread.emoji')
+
+
+def txn_id(mid: str):
+    """
+    Matrix transaction ID for a Facebook message.
+    The homeserver ignores a repeated transaction ID from the same user, but only for a while (about 30 minutes on
+    Synapse), so this only covers a quick redelivery. Anything older has to be caught by the checkpoints instead.
+    """
+    return f"fbchat_{hashlib.sha256(mid.encode()).hexdigest()[:32]}"
 
 
 class Person():
     # FIXME: Add a useful __str__ function
+    # There's one of these for every contact ever seen, so no per-instance __dict__
+    __slots__ = ('parent_fb', 'fbid', 'mxid')
+
     @classmethod
-    def _check_cache(cls, fbid: str = None, mxid: str = None):
+    def _check_cache(cls, fb_client, fbid: str = None, mxid: str = None):
         # Check the running in-memory cache of people to avoid reinstating duplicate objects all over the place
+        # Each Facebook account has it's own cache, because each account has it's own set of puppets.
         if not fbid and not mxid:
             raise Exception("Must have at least one of fbid or mxid")
 
-        if fbid and fbid in _fb_people_cache:
-            return _fb_people_cache[fbid]
-        elif mxid and mxid in _mx_people_cache:
-            return _mx_people_cache[mxid]
+        if fbid and fbid in fb_client._fb_people_cache:
+            metrics.cache_lookups.inc(cache='people', result='hit')
+            return fb_client._fb_people_cache[fbid]
+        elif mxid and mxid in fb_client._mx_people_cache:
+            metrics.cache_lookups.inc(cache='people', result='hit')
+            return fb_client._mx_people_cache[mxid]
         else:
+            metrics.cache_lookups.inc(cache='people', result='miss')
             return None
 
     def _update_cache(self):
         # Update the in-memory cache of people
         if self.fbid:
-            _fb_people_cache[self.fbid] = self
+            self.parent_fb._fb_people_cache[self.fbid] = self
         if self.mxid:
-            _mx_people_cache[self.mxid] = self
+            self.parent_fb._mx_people_cache[self.mxid] = self
 
     @classmethod
     async def async_get_from_mxid(cls, fb_client, mxid: str):
-        p = cls._check_cache(mxid=mxid) or cls(
+        p = cls._check_cache(fb_client, mxid=mxid) or cls(
             fb_client=fb_client,
             fbid=(fb_client.uid if mxid == fb_client.mx_puppet_id
                   else mxid.rsplit(':', 1)[0].rsplit('_', 1)[1]),
@@ -73,40 +117,62 @@ class Person():
         return p
 
     @classmethod
-    def get_from_fbid(cls, fb_client, fbid: str):
+    def get_from_fbid(cls, fb_client, fbid: str, sync_profile: bool = True):
         # Will never be called from Mautrix events, so doesn't need an awaitable version
-        p = cls._check_cache(mxid=fbid) or cls(
-            fb_client=fb_client,
-            fbid=fbid,
-            mxid=(fb_client.mx_puppet_id if fbid == fb_client.uid
-                  else f"@fbchat_{fb_client.uid}_{fbid}:{fb_client.mx.domain}"),
-        )
-        mx_coro(fb_client.mx, fb_client.mx.ensure_registered())
+        p = cls._check_cache(fb_client, fbid=fbid)
+        if not p:
+            p = cls(
+                fb_client=fb_client,
+                fbid=fbid,
+                mxid=(fb_client.mx_puppet_id if fbid == fb_client.uid
+                      else f"@fbchat_{fb_client.uid}_{fbid}:{fb_client.mx.domain}"),
+            )
+            with tracing.span('register_puppet'):
+                mx_coro(p.mx, p.mx.ensure_registered())
+            if sync_profile:
+                # When getting a lot of people at once, call sync_profiles() on them all instead
+                with tracing.span('sync_profiles'):
+                    fb_client.profiles.sync([p])
 
         return p
 
     def __init__(self, fb_client, fbid: str, mxid: str):
         self.parent_fb = fb_client
-        self.fbid = fbid
-        self.mxid = mxid
-
-        self.mx = fb_client.mx.user(self.mxid)
+        # The same IDs turn up in the caches, participant lists, profile hashes, etc. so only keep one copy of each
+        self.fbid = sys.intern(fbid) if fbid else fbid
+        self.mxid = sys.intern(mxid) if mxid else mxid
 
         self._update_cache()
 
-        ## FIXME: Get Facebook name, photo, nicknames, etc.
+        ## FIXME: Get Facebook nicknames, etc.
+        ##        Name & photo are handled by profiles.ProfileSync
+
+    @property
+    def mx(self):
+        # Only the recently active puppets keep an intent around, everyone else gets one made again when needed
+        return self.parent_fb.intents.get(self.mxid)
 
     def facebook_message(
         self,
         fb_thread_id: str,
         message_object,
         timestamp: str = None,
+        mid: str = None,
     ):
-        # Looks like I'll have to use some non-printable text in messages sent into Matrix as a deduplication tag
-        room = Room.get_from_fbid(fb_client=self.parent_fb, fbid=fb_thread_id)
+        with tracing.span('resolve_room'):
+            room = Room.get_from_fbid(fb_client=self.parent_fb, fbid=fb_thread_id)
         # Need to make sure the room has been joined just in case the invite autoaccepter hasn't had enough time.
-        mx_coro(self.mx, self.mx.ensure_joined(room.mxid))
-        mx_coro(self.mx, self.mx.send_text(room.mxid, message_object.text))
+        with tracing.span('ensure_joined'):
+            mx_coro(self.mx, self.mx.ensure_joined(room.mxid))
+        with tracing.span('send_text'):
+            content = mautrix.client.api.types.TextMessageEventContent(
+                msgtype=mautrix.client.api.types.MessageType.TEXT, body=message_object.text)
+            # With a transaction ID tied to the Facebook message, the homeserver ignores a redelivery soon after a crash
+            mx_coro(self.mx, self.parent_fb.sender.send(self.mx, room.mxid,
+                                                        mautrix.client.api.types.EventType.ROOM_MESSAGE,
+                                                        content, txn_id=txn_id(mid) if mid else None))
+        if timestamp:
+            metrics.fb_to_mx_latency.observe(time.time() - int(timestamp) / 1000)
 
     async def matrix_event(self, mx_ev):
         # FIXME: Don't send messages to Facebook that were sent to Matrix as this bridge, and vice versa
@@ -119,34 +185,39 @@ class Person():
 
 class Room():
     # FIXME: Add a useful __str__ function
+    # Like Person, there's one of these for every thread ever seen
+    __slots__ = ('fb', 'fbid', 'mxid', 'mx_members', 'name', 'is_direct', 'fb_participants', 'topic')
+
     @classmethod
-    def _check_cache(cls, fbid: str = None, mxid: str = None):
+    def _check_cache(cls, fb_client, fbid: str = None, mxid: str = None):
         # Check the running in-memory cache of rooms to avoid reinstating duplicate objects all over the place
         if not fbid and not mxid:
             raise Exception("Must have at least one of fbid or mxid")
 
-        if fbid and fbid in _fb_rooms_cache:
-            return _fb_rooms_cache[fbid]
-        elif mxid and mxid in _mx_rooms_cache:
-            return _mx_rooms_cache[mxid]
+        if fbid and fbid in fb_client._fb_rooms_cache:
+            metrics.cache_lookups.inc(cache='rooms', result='hit')
+            return fb_client._fb_rooms_cache[fbid]
+        elif mxid and mxid in fb_client._mx_rooms_cache:
+            metrics.cache_lookups.inc(cache='rooms', result='hit')
+            return fb_client._mx_rooms_cache[mxid]
         else:
+            metrics.cache_lookups.inc(cache='rooms', result='miss')
             return None
 
     def _update_cache(self):
         # Update the in-memory cache of rooms
         if self.fbid:
-            _fb_rooms_cache[self.fbid] = self
+            self.fb._fb_rooms_cache[self.fbid] = self
         if self.mxid:
-            _mx_rooms_cache[self.mxid] = self
+            self.fb._mx_rooms_cache[self.mxid] = self
 
     @classmethod
     async def async_get_from_mxid(cls, fb_client, mxid: str):
-        alias_response = await fb_client.mx.user(fb_client.mx_puppet_id).get_state_event(
+        alias_response = await fb_client.intents.get(fb_client.mx_puppet_id).get_state_event(
             mxid, mautrix.client.api.types.EventType.ROOM_CANONICAL_ALIAS)
-        r = cls._check_cache(mxid=mxid) or cls(
+        r = cls._check_cache(fb_client, mxid=mxid) or cls(
             fb_client=fb_client,
             fbid=alias_response['canonical_alias'].rsplit(':', 1)[0].rsplit('_', 1)[1],
-            mxalias=alias_response['canonical_alias'],
             mxid=mxid,
         )
         return r
@@ -154,32 +225,65 @@ class Room():
     @classmethod
     def get_from_fbid(cls, fb_client, fbid: str):
         # Will never be called from Mautrix events, so doesn't need an awaitable version
-        r = cls._check_cache(mxid=fbid) or cls(
-            fb_client=fb_client,
-            fbid=fbid,
-            mxalias=f"#fbchat_{fb_client.uid}_{fbid}:{fb_client.mx.domain}",
-        )
+        r = cls._check_cache(fb_client, fbid=fbid)
+        if not r:
+            with tracing.span('fetch_thread_info'):
+                r = cls(
+                    fb_client=fb_client,
+                    fbid=fbid,
+                )
         if not r.mxid:
             try:
-                r.mxid = mx_coro(fb_client.mx,
-                                 fb_client.mx.get_room_alias(r.mxalias)
-                                 )['room_id']
+                with tracing.span('get_room_alias'):
+                    r.mxid = mx_coro(fb_client.mx,
+                                     fb_client.mx.get_room_alias(r.mxalias)
+                                     )['room_id']
             except mautrix.errors.request.MNotFound:
-                r.mxid = mx_coro(fb_client.mx, r._create_in_mx())
+                with tracing.span('create_room'):
+                    r.mxid = mx_coro(fb_client.mx, r._create_in_mx())
+                # Everyone was invited when the room was created
+                r.mx_members = set(r.fb_participants) - {fb_client.uid}
+            r._update_cache()
+
+            if r.mx_members is None:
+                # The room's been around since before this run, people might have come or gone since then
+                with tracing.span('sync_members'):
+                    r.sync_members()
+                # And it might be from before the puppet was given power to follow the name, avatar, etc.
+                with tracing.span('grant_power'):
+                    try:
+                        mx_coro(fb_client.mx, r._grant_puppet_power())
+                    except Exception:
+                        fb_client.log.warning(f"Couldn't give {fb_client.mx_puppet_id} power in {r.mxid}, "
+                                              f"its name, avatar, etc. won't follow Facebook", exc_info=True)
+
+            # Make sure all the participants have a profile before they start talking,
+            # this is done in one go so it only needs one request to Facebook
+            with tracing.span('sync_profiles'):
+                fb_client.profiles.sync([Person.get_from_fbid(fb_client=fb_client, fbid=uid, sync_profile=False)
+                                         for uid in r.fb_participants])
 
         return r
 
-    def __init__(self, fb_client, fbid: str, mxalias: str, mxid: str = None):
+    def __init__(self, fb_client, fbid: str, mxid: str = None):
         self.fb = fb_client
-        self.fbid = fbid
-        self.mxalias = mxalias
+        self.fbid = sys.intern(fbid) if fbid else fbid
         self.mxid = mxid
+        # fbids of the puppets in the Matrix room, None until that's been worked out
+        self.mx_members = None
+        self.name = None
+        self.topic = None
 
         if not self.mxid and not self.fbid:
             raise Exception("Must initialise Room with at least one of fbid or mxid")
 
         self._update_fb_info()
 
+    @property
+    def mxalias(self):
+        # Always made from the fbid, so there's no need to keep a copy in every Room
+        return f"#fbchat_{self.fb.uid}_{self.fbid}:{self.fb.mx.domain}"
+
     def _update_fb_info(self):
         t = self.fb.fetchThreadInfo(self.fbid)
         assert len(t) == 1
@@ -188,13 +292,13 @@ class Room():
             self.name = thread_info.name
         if isinstance(thread_info, fbchat.User):
             self.is_direct = True
-            self.fb_participants = [thread_info.uid]
+            self.fb_participants = (sys.intern(thread_info.uid),)
             if thread_info.nickname:
                 self.name = thread_info.nickname
-            self.topic = f"Facebook {'friend' if thread_info.is_friend else 'correspondent'}"
+            self.topic = sys.intern(f"Facebook {'friend' if thread_info.is_friend else 'correspondent'}")
         elif isinstance(thread_info, fbchat.Group):
             self.is_direct = False
-            self.fb_participants = list(thread_info.participants)
+            self.fb_participants = tuple(map(sys.intern, thread_info.participants))
             if not self.topic:
                 self.topic = f"Facebook group chat"
         else:
@@ -202,6 +306,97 @@ class Room():
 
         self._update_cache()
 
+    def _fbid_from_mxid(self, mxid: str):
+        prefix, suffix = f"@fbchat_{self.fb.uid}_", f":{self.fb.mx.domain}"
+        if mxid == self.fb.mx_puppet_id:
+            return self.fb.uid
+        elif mxid.startswith(prefix) and mxid.endswith(suffix):
+            return mxid[len(prefix):-len(suffix)]
+        return None
+
+    def sync_members(self):
+        """Find out who's actually in the Matrix room, then bring it in line with the Facebook thread. Blocking."""
+        joined = mx_coro(self.fb.mx, self.fb.intents.get(self.fb.mx_puppet_id).get_joined_members(self.mxid))
+        self.mx_members = {fbid for fbid in map(self._fbid_from_mxid, joined) if fbid} - {self.fb.uid}
+        self.update_members(self.fb_participants)
+
+    def update_members(self, participants):
+        """
+        Make the Matrix room's members match the given Facebook participants, only inviting & removing the difference.
+        Blocking.
+        """
+        if self.mx_members is None:
+            # Need to know who's in the Matrix room first, sync_members() then comes back here with these participants
+            self.fb_participants = tuple(map(sys.intern, set(participants) | {self.fb.uid}))
+            return self.sync_members()
+        participants = set(participants) - {self.fb.uid}
+        added = participants - self.mx_members
+        removed = self.mx_members - participants
+        self.fb_participants = tuple(map(sys.intern, participants | {self.fb.uid}))
+        if not added and not removed:
+            return
+
+        self.fb.log.info(f"Updating members of {self.mxid}: adding {sorted(added)}, removing {sorted(removed)}")
+        joining = [Person.get_from_fbid(fb_client=self.fb, fbid=fbid, sync_profile=False) for fbid in added]
+        leaving = [Person.get_from_fbid(fb_client=self.fb, fbid=fbid, sync_profile=False) for fbid in removed]
+        # Make sure anyone new has a profile before they turn up in the room
+        self.fb.profiles.sync(joining)
+        failed = mx_coro(self.fb.mx, self._apply_member_changes(joining, leaving))
+        self.mx_members = (self.mx_members | added) - removed - failed
+
+    async def _apply_member_changes(self, joining, leaving, concurrency: int = 8):
+        """Returns the fbids of anyone that couldn't be added"""
+        # The real user's puppet is always in the room, unlike the appservice bot, so it does the inviting
+        inviter = self.fb.intents.get(self.fb.mx_puppet_id)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        # A big group's worth of these all at once is exactly what the rate limiter's for
+        sender = self.fb.sender
+
+        async def join(person):
+            async with semaphore:
+                await sender.call(inviter, self.mxid, inviter.invite_user, self.mxid, person.mxid)
+                await sender.call(person.mx, self.mxid, person.mx.ensure_joined, self.mxid)
+
+        async def leave(person):
+            # Leaving needs no power level, unlike kicking. The puppet was only there because of Facebook anyway
+            async with semaphore:
+                await sender.call(person.mx, self.mxid, person.mx.leave_room, self.mxid)
+
+        people = joining + leaving
+        results = await asyncio.gather(*map(join, joining), *map(leave, leaving), return_exceptions=True)
+        failed = set()
+        for person, result in zip(people, results):
+            if isinstance(result, Exception):
+                self.fb.log.warning(f"Failed to {'add' if person in joining else 'remove'} {person.mxid} "
+                                    f"in {self.mxid}: {result!r}")
+                if person in joining:
+                    failed.add(person.fbid)
+        return failed
+
+    async def set_state(self, event_type, content: dict, state_key: str = ''):
+        # The real user's puppet is given power in the rooms the bridge creates, so it makes the state changes
+        puppet = self.fb.intents.get(self.fb.mx_puppet_id)
+        await self.fb.sender.call(puppet, self.mxid, puppet.send_state_event, self.mxid, event_type, content,
+                                  state_key=state_key)
+
+    async def _grant_puppet_power(self):
+        """
+        Give the real user's puppet power in a room created before _create_in_mx() started doing that.
+        The bot left the room straight after creating it, so it has to be invited back in to do it.
+        """
+        puppet = self.fb.intents.get(self.fb.mx_puppet_id)
+        levels = await puppet.get_power_levels(self.mxid)
+        if levels.users.get(self.fb.mx_puppet_id, 0) >= 100:
+            return
+        await puppet.invite_user(self.mxid, self.fb.mx.mxid)
+        await self.fb.mx.ensure_joined(self.mxid)
+        try:
+            levels.users[self.fb.mx_puppet_id] = 100
+            await self.fb.mx.set_power_levels(self.mxid, levels)
+        finally:
+            await self.fb.mx.leave_room(self.mxid)
+
     async def _create_in_mx(self):
         # GOTCHAS:
         # * is_direct doesn't set the m.direct values for the room's creator, only the invitees
@@ -211,9 +406,8 @@ class Room():
         # invite all the attendees including the real user,
         # then remove the bot from the room immediately.
 
-        # FIXME: Should also update the room info such that a new group name in Facebook changes the Matrix room name
-        # FIXME: What if the room already exists but the relevant user is not in the room?
-        #        Such as when there's new participants in a group chat.
+        # Later name/avatar changes are handled by the Client's on*Change handlers through set_state()
+        # New participants in a group chat are handled by update_members(), after the room's been created
 
         local_mxalias = self.mxalias.rsplit(':', 1)[0].lstrip('#')
         invitees = ([self.fb.mx_puppet_id] +
@@ -226,8 +420,13 @@ class Room():
             name=self.name,
             topic=self.topic,
             is_direct=self.is_direct,
-            invitees=invitees
-            # initial_state=,
+            invitees=invitees,
+            # Let the real user's puppet change the name, avatar, etc. to follow Facebook, after the bot has left
+            initial_state=[{
+                'type': 'm.room.power_levels',
+                'state_key': '',
+                'content': {'users': {self.fb.mx.mxid: 100, self.fb.mx_puppet_id: 100}},
+            }],
             # room_version=,
             # creation_content=,
         )
@@ -241,21 +440,207 @@ class Room():
 
 
 class Client(fbchat.Client):
-    def __init__(self, *args, matrix_bot, matrix_user_localpart, log, **kwargs):
+    def __init__(self, *args, matrix_bot, matrix_user_localpart, log, http_adapter=None, request_executor=None,
+                 matrix_sender=None, intent_pool=None, capture_file=None, **kwargs):
+        # These need to exist before logging in, because fbchat will happily start calling the event handlers
+        self._fb_rooms_cache = {}
+        self._mx_rooms_cache = {}
+        self._fb_people_cache = {}
+        self._mx_people_cache = {}
+        # The puppets' intents, normally shared with the other accounts
+        self.intents = intent_pool or intents.IntentPool(matrix_bot)
+
+        # Count every Facebook event that comes through, whether it's bridged or just logged.
+        # Before logging in, since fbchat calls onLoggingIn/onLoggedIn from inside its __init__
+        for name in dir(self):
+            if name.startswith('on') and callable(getattr(self, name)):
+                setattr(self, name, metrics.counted(f"facebook.{name}", getattr(self, name)))
+
         super().__init__(*args, **kwargs)
         self.mx = matrix_bot
         self.mx_puppet_id = f"@{matrix_user_localpart}:{matrix_bot.domain}"
         self.log = log
+        # Everything the puppets send goes through here, normally shared with the other accounts & the protocol rooms
+        self.sender = matrix_sender or ratelimit.Sender()
+
+        if http_adapter:
+            # Share one connection pool to Facebook between all the accounts in this process,
+            # instead of every account keeping it's own set of sockets open.
+            # fbchat moved the requests session into a State object at some point, so check for both
+            session = getattr(getattr(self, '_state', None), '_session', None) or getattr(self, '_session', None)
+            if session:
+                session.mount('https://', http_adapter)
+                session.mount('http://', http_adapter)
+
+        # The listener gets a thread all to itself, so it can never be starved by bulk fetches or sends.
+        # Everything else goes through the request executor, which is normally shared between all the accounts.
+        self.listen_executor = executors.InstrumentedExecutor(
+            max_workers=1, thread_name_prefix=f"fbchat-listen-{self.uid}")
+        # What the listener's doing right now and since when, so watchdog.py can tell when it's got stuck
+        self.listener_phase = 'stopped'
+        self.listener_phase_since = time.monotonic()
+        self._listen_thread = None
+        self.stopped = False
+        self.request_executor = request_executor or executors.InstrumentedExecutor(
+            max_workers=4, thread_name_prefix=f"fbchat-request-{self.uid}")
+        # Messages are bridged in the request executor, in order within each Facebook thread,
+        # so the listener can get straight back to polling instead of waiting on room creation, profiles, etc.
+        self.message_queues = executors.SerialQueues(self.request_executor)
+
+        # Raw listener payloads can be recorded for replay.py to play back later
+        self.capture = capture.CaptureWriter(capture_file, fbchat_uid=self.uid) if capture_file else None
+
+        self.checkpoints = checkpoints.Checkpoints(f"fb-checkpoints_{self.uid}.json")
+        # Every message is written here before it's bridged, so a crash part way through can't lose it
+        self.journal = journal.Journal(f"fb-journal_{self.uid}.log")
+        self._needs_catch_up = False
+
+        self.profiles = profiles.ProfileSync(fb_client=self, autosave_file=f"fb-profiles_{self.uid}.p")
+
+        # Room names, avatars, nicknames, etc. only get sent into Matrix once they've stopped changing for a moment
+        self.state_debouncer = debounce.Debouncer(loop=self.mx.loop, log=self.log)
 
     async def handle_matrix_event(self, mx_ev):
-        if isinstance(mx_ev, mautrix.types.MessageEvent):
-            if not mx_ev.sender == self.mx_puppet_id:
-                # Messages recieved in Matrix by anyone who is not the real user can be ignored
-                return
-
-            self.log.debug("Recieved Matrix MessageEvent from puppet id, processing")
-            sender = await Person.async_get_from_mxid(fb_client=self, mxid=mx_ev.sender)
-            await sender.matrix_event(mx_ev)
+        # main.py only routes the real user's messages here, messages from anyone else can be ignored
+        self.log.debug("Recieved Matrix MessageEvent from puppet id, processing")
+        sender = await Person.async_get_from_mxid(fb_client=self, mxid=mx_ev.sender)
+        await sender.matrix_event(mx_ev)
+        metrics.mx_to_fb_latency.observe(time.time() - mx_ev.timestamp / 1000)
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """Run a blocking fbchat call (fetching, sending, etc) from the event loop without blocking it"""
+        return await asyncio.get_event_loop().run_in_executor(
+            self.request_executor, functools.partial(fn, *args, **kwargs))
+
+    def _bridge_message(self, mid, thread_id, message_object, ts):
+        """Send a Facebook message into Matrix, unless it's already been bridged. Used for both live & missed messages"""
+        if mid and self.checkpoints.seen(thread_id, mid):
+            self.log.debug(f"Already bridged {mid}, skipping")
+            self.journal.done(mid)
+            return
+        if mid:
+            with tracing.span('journal'):
+                self.journal.append(mid, thread_id=thread_id, author=message_object.author,
+                                    text=message_object.text, ts=ts)
+        with tracing.span('resolve_person'):
+            sender = Person.get_from_fbid(fb_client=self, fbid=message_object.author)
+        sender.facebook_message(fb_thread_id=thread_id, message_object=message_object, timestamp=ts, mid=mid)
+        self.checkpoints.advance(thread_id, ts, mid)
+        if mid:
+            self.journal.done(mid)
+
+    def replay_journal(self):
+        """Redeliver anything that was journaled but never made it into Matrix, probably because of a crash. Blocking."""
+        pending = self.journal.pending()
+        if not pending:
+            return
+        self.log.info(f"Replaying {len(pending)} message(s) left unfinished in the journal")
+        for record in pending:
+            # The homeserver's transaction ID dedup won't remember anything from before a long outage,
+            # but each thread's messages are bridged in order, so anything older than the checkpoint already went
+            since = self.checkpoints.since(record['thread_id'])
+            if since is not None and int(record['ts']) <= since:
+                self.log.debug(f"{record['id']} is older than the checkpoint, not replaying it")
+                self.journal.done(record['id'])
+                continue
+            message_object = fbchat.Message(text=record['text'])
+            message_object.uid = record['id']
+            message_object.author = record['author']
+            message_object.timestamp = record['ts']
+            try:
+                self._bridge_message(mid=record['id'], thread_id=record['thread_id'],
+                                     message_object=message_object, ts=record['ts'])
+            except Exception:
+                # Leave it in the journal to try again next time
+                self.log.exception(f"Failed to replay {record['id']} from the journal")
+
+    def _catch_up_thread(self, thread_id: str, since: int, page_size: int = 50):
+        """Fetch and bridge everything in a thread newer than since, oldest first. Blocking."""
+        missed = {}
+        before = None
+        while True:
+            page = self.fetchThreadMessages(thread_id, limit=page_size, before=before)
+            newer = [m for m in page if int(m.timestamp) > since]
+            missed.update((m.uid, m) for m in newer)
+            if len(newer) < len(page) or len(page) < page_size:
+                break
+            # Pages overlap by one message, that's fine since they're deduplicated by ID
+            before = int(page[-1].timestamp)
+
+        for message in sorted(missed.values(), key=lambda m: int(m.timestamp)):
+            self._bridge_message(mid=message.uid, thread_id=thread_id, message_object=message, ts=message.timestamp)
+        return len(missed)
+
+    async def catch_up(self, page_size: int = 20):
+        """
+        Bridge any messages that were sent while the listener wasn't running.
+        Threads are fetched concurrently in the request executor, but each thread's messages are bridged in order.
+        """
+        last_seen = self.checkpoints.last_seen
+        if last_seen is None:
+            # Never bridged anything before, so there's nothing to catch up on. Don't go backfilling all of history.
+            return
+
+        # The thread list is newest first, so keep paging back until it gets to threads nothing's happened in since
+        behind = {}
+        before = None
+        while True:
+            threads = await self.run_blocking(self.fetchThreadList, limit=page_size, before=before)
+            for thread in threads:
+                since = self.checkpoints.since(thread.uid) or last_seen
+                if thread.last_message_timestamp and int(thread.last_message_timestamp) > since:
+                    behind[thread.uid] = since
+            oldest = min((int(t.last_message_timestamp) for t in threads if t.last_message_timestamp), default=None)
+            if len(threads) < page_size or oldest is None or oldest <= last_seen or oldest == before:
+                break
+            # Threads with the same timestamp as the last one show up again, they're keyed by ID so that's fine
+            before = oldest
+        if not behind:
+            return
+
+        self.log.info(f"Catching up on {len(behind)} thread(s) with missed messages")
+        # Queued behind anything the listener already handed over for the same thread, so nothing overtakes anything
+        results = await asyncio.gather(*(
+            asyncio.wrap_future(self.message_queues.submit(thread_id, self._catch_up_thread, thread_id, since,
+                                                           wait=False))
+            for thread_id, since in behind.items()), return_exceptions=True)
+        for thread_id, result in zip(behind, results):
+            if isinstance(result, Exception):
+                self.log.error(f"Failed to catch up on thread {thread_id}: {result!r}")
+            elif result:
+                self.log.info(f"Bridged {result} missed message(s) in thread {thread_id}")
+        self.checkpoints.save()
+
+    def _set_listener_phase(self, phase: str):
+        # A listener thread the watchdog has given up on might still come back to life, just ignore it if it does
+        if threading.get_ident() == self._listen_thread:
+            self.listener_phase = phase
+            self.listener_phase_since = time.monotonic()
+
+    def _listen_once(self):
+        self._listen_thread = threading.get_ident()
+        self._set_listener_phase('poll')
+        started = time.monotonic()
+        try:
+            return self.doOneListen()
+        finally:
+            metrics.listener_poll_duration.observe(time.monotonic() - started)
+            self._set_listener_phase('idle')
+
+    def reset_listener(self):
+        """
+        Swap in a fresh listen thread & MQTT connection, a stuck thread is left to finish (or not) on its own.
+        Anything it still receives is thrown away by _parse_message() and caught up on instead,
+        rather than the two of them racing each other through the same events.
+        """
+        stale_mqtt, self._mqtt = getattr(self, '_mqtt', None), None
+        if stale_mqtt:
+            # Disconnecting it from here would pull it out from under the stuck thread, so that thread does it itself
+            self.listen_executor.submit(stale_mqtt.disconnect)
+        self.listen_executor.shutdown(wait=False)
+        self._listen_thread = None
+        self.listen_executor = executors.InstrumentedExecutor(
+            max_workers=1, thread_name_prefix=f"fbchat-listen-{self.uid}")
 
     async def listen(self, markAlive=None):
         """
@@ -268,10 +653,81 @@ class Client(fbchat.Client):
         self.startListening()
         self.onListening()
 
+        # Picking up where the last run left off, before any new messages come in and get ahead of the missed ones
+        self.listener_phase, self.listener_phase_since = 'catch_up', time.monotonic()
+        await asyncio.get_event_loop().run_in_executor(self.listen_executor, self.replay_journal)
+        self._needs_catch_up = True
         while self.listening:
-            await asyncio.get_event_loop().run_in_executor(None, self.doOneListen)
-
-        self.stopListening()
+            if self._needs_catch_up:
+                self._needs_catch_up = False
+                self.listener_phase, self.listener_phase_since = 'catch_up', time.monotonic()
+                try:
+                    await self.catch_up()
+                except Exception:
+                    # Not worth stopping the listener over, live messages are still more important
+                    self.log.exception("Failed to catch up on missed messages")
+            await asyncio.get_event_loop().run_in_executor(self.listen_executor, self._listen_once)
+
+        # On the listener's own thread, so the connection can't be pulled out from under a poll
+        await asyncio.get_event_loop().run_in_executor(self.listen_executor, self.stopListening)
+        self.listener_phase, self.listener_phase_since = 'stopped', time.monotonic()
+        self.checkpoints.save()
+
+    def stop(self):
+        """Ask the listener to finish up, it stops after the poll that's currently running"""
+        self.stopped = True
+        # Not stopListening(), that disconnects there and then, even if the listener is in the middle of a poll
+        self.listening = False
+
+    def flush(self):
+        """Write everything that's only held in memory out to disk, so the next run can start warm"""
+        self.checkpoints.save()
+        self.profiles.save()
+        self.journal.close()
+        if self.capture:
+            self.capture.close()
+
+    def _bridged_room(self, thread_id):
+        """
+        The Room for a thread, if it's already been bridged.
+        Rooms that haven't been yet get the latest name, participants, etc. when they are, so they can be left alone.
+        """
+        room = Room._check_cache(self, fbid=thread_id)
+        return room if room and room.mxid else None
+
+    async def _set_room_image(self, room, image_id):
+        photo_url = await self.run_blocking(self.fetchImageUrl, image_id)
+        mxc = await self.run_blocking(self.profiles.mxc_for, self.mx, photo_url)
+        await room.set_state(mautrix.client.api.types.EventType.ROOM_AVATAR, {'url': mxc})
+
+    async def _set_nickname(self, room, person, nickname):
+        if not nickname:
+            # Nickname was cleared, so back to their real name
+            nickname = (await self.run_blocking(self.fetchUserInfo, person.fbid))[person.fbid].name
+        # The member event replaces the whole profile in this room, so keep whatever avatar they already had
+        member = self.mx.state_store.get_member(room.mxid, person.mxid)
+        content = {'membership': 'join', 'displayname': nickname}
+        if getattr(member, 'avatar_url', None):
+            content['avatar_url'] = member.avatar_url
+        await self.sender.call(person.mx, room.mxid, person.mx.send_state_event, room.mxid,
+                               mautrix.client.api.types.EventType.ROOM_MEMBER, content, state_key=person.mxid)
+
+    def _parse_message(self, topic, data):
+        # This is where fbchat hands each payload it got over MQTT to the on* handlers
+        if threading.get_ident() != self._listen_thread:
+            # fbchat's already moved its sequence ID past this, so the new listener won't get it again
+            self.log.warning("Dropped a payload received by an abandoned listener thread, catching up instead")
+            self._needs_catch_up = True
+            return
+        if self.capture:
+            self.capture.write(topic, data)
+        self._set_listener_phase('callback')
+        started = time.monotonic()
+        try:
+            return super()._parse_message(topic, data)
+        finally:
+            metrics.listener_callback_duration.observe(time.monotonic() - started)
+            self._set_listener_phase('poll')
 
 #    def doOneListen(self, *args, **kwargs):
 #        self.log.critical('start')
@@ -304,15 +760,17 @@ class Client(fbchat.Client):
 #        """Called when the client is listening"""
 #        self.log.info("Listening...")
 #
-#    def onListenError(self, exception=None):
-#        """
-#        Called when an error was encountered while listening
-#
-#        :param exception: The exception that was encountered
-#        :return: Whether the loop should keep running
-#        """
-#        self.log.exception("Got exception while listening")
-#        return True
+    def onListenError(self, exception=None):
+        """
+        Called when an error was encountered while listening
+
+        :param exception: The exception that was encountered
+        :return: Whether the loop should keep running
+        """
+        self.log.exception("Got exception while listening")
+        # Anything sent while the listener was broken will never turn up, so go and look for it
+        self._needs_catch_up = True
+        return True
 
     def onMessage(
         self,
@@ -341,10 +799,30 @@ class Client(fbchat.Client):
         :type message_object: models.Message
         :type thread_type: models.fbchat.models.ThreadType
         """
-        sender = Person.get_from_fbid(fb_client=self, fbid=message_object.author)
+        received = time.time()
         self.log.info(f"Extra message metadata from Faceboook: {metadata}")
         self.log.info(f"All message info from Faceboook: {msg}")
-        sender.facebook_message(fb_thread_id=thread_id, message_object=message_object, timestamp=ts)
+        # Safely on disk before fbchat moves on, then the rest happens off the listener thread
+        if mid and not self.checkpoints.seen(thread_id, mid):
+            self.journal.append(mid, thread_id=thread_id, author=message_object.author,
+                                text=message_object.text, ts=ts)
+        journaled = time.time()
+        self.message_queues.submit(thread_id, self._handle_message,
+                                   mid, thread_id, message_object, ts, received, journaled)
+
+    def _handle_message(self, mid, thread_id, message_object, ts, received, journaled):
+        # ts is Facebook's server timestamp, so the trace starts from when Facebook got the message, not when we did
+        with tracing.Trace('facebook.message', start=int(ts) / 1000 if ts else received,
+                           mid=mid, thread_id=thread_id, account=self.uid) as trace:
+            if ts:
+                trace.add_span('facebook.delivery', start=int(ts) / 1000, end=received)
+            trace.add_span('journal', start=received, end=journaled)
+            trace.add_span('queued', start=journaled, end=time.time())
+            try:
+                self._bridge_message(mid=mid, thread_id=thread_id, message_object=message_object, ts=ts)
+            except Exception:
+                # Still in the journal, so it'll be tried again next time the bridge starts
+                self.log.exception(f"Failed to bridge message {mid} in thread {thread_id}")
 
     def onColorChange(
         self,
@@ -376,6 +854,11 @@ class Client(fbchat.Client):
                 author_id, thread_id, thread_type.name, new_color
             )
         )
+        # Matrix has nothing like this, so it's just kept in a custom state event
+        room = self._bridged_room(thread_id)
+        if room:
+            self.state_debouncer.submit((thread_id, 'color'), room.set_state, THREAD_COLOR_EVENT,
+                                        {'color': getattr(new_color, 'value', new_color)})
 
     def onEmojiChange(
         self,
@@ -406,6 +889,10 @@ class Client(fbchat.Client):
                 author_id, thread_id, thread_type.name, new_emoji
             )
         )
+        # Matrix has nothing like this either
+        room = self._bridged_room(thread_id)
+        if room:
+            self.state_debouncer.submit((thread_id, 'emoji'), room.set_state, THREAD_EMOJI_EVENT, {'emoji': new_emoji})
 
     def onTitleChange(
         self,
@@ -436,6 +923,11 @@ class Client(fbchat.Client):
                 author_id, thread_id, thread_type.name, new_title
             )
         )
+        room = self._bridged_room(thread_id)
+        if room:
+            room.name = new_title
+            self.state_debouncer.submit((thread_id, 'm.room.name'), room.set_state,
+                                        mautrix.client.api.types.EventType.ROOM_NAME, {'name': new_title})
 
     def onImageChange(
         self,
@@ -460,6 +952,9 @@ class Client(fbchat.Client):
         :type thread_type: models.fbchat.models.ThreadType
         """
         self.log.info("{} changed thread image in {}".format(author_id, thread_id))
+        room = self._bridged_room(thread_id)
+        if room:
+            self.state_debouncer.submit((thread_id, 'm.room.avatar'), self._set_room_image, room, new_image)
 
     def onNicknameChange(
         self,
@@ -492,6 +987,12 @@ class Client(fbchat.Client):
                 author_id, thread_id, thread_type.name, changed_for, new_nickname
             )
         )
+        room = self._bridged_room(thread_id)
+        # The real user's displayname is their own business, not Facebook's
+        if room and changed_for != self.uid:
+            person = Person.get_from_fbid(fb_client=self, fbid=changed_for)
+            self.state_debouncer.submit((thread_id, 'nickname', changed_for), self._set_nickname,
+                                        room, person, new_nickname)
 
     def onAdminAdded(
         self,
@@ -684,6 +1185,9 @@ class Client(fbchat.Client):
         self.log.info(
             "{} added: {} in {}".format(author_id, ", ".join(added_ids), thread_id)
         )
+        room = self._bridged_room(thread_id)
+        if room:
+            room.update_members(set(room.fb_participants) | set(added_ids))
 
     def onPersonRemoved(
         self,
@@ -705,6 +1209,9 @@ class Client(fbchat.Client):
         :param msg: A full set of the data recieved
         """
         self.log.info("{} removed: {} in {}".format(author_id, removed_id, thread_id))
+        room = self._bridged_room(thread_id)
+        if room:
+            room.update_members(set(room.fb_participants) - {removed_id})
 
     def onFriendRequest(self, from_id=None, msg=None):
         """
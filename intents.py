@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+import collections
+import threading
+
+import metrics
+
+
+class IntentPool(object):
+    """
+    The puppets' IntentAPI objects, made when they're first needed and kept for the most recently used maxsize of them.
+
+    Every Person used to hold on to its own intent forever, even for contacts that haven't said anything in months.
+    An intent is cheap to make again, so there's no point keeping one around for everyone the bridge has ever seen.
+    Shared between all the accounts, and safe to use from the listener threads.
+    """
+    def __init__(self, matrix_bot, maxsize: int = 1024):
+        self.mx = matrix_bot
+        self.maxsize = maxsize
+        self._intents = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._intents)
+
+    def get(self, mxid: str):
+        with self._lock:
+            intent = self._intents.get(mxid)
+            if intent is not None:
+                self._intents.move_to_end(mxid)
+                metrics.cache_lookups.inc(cache='intents', result='hit')
+                return intent
+            metrics.cache_lookups.inc(cache='intents', result='miss')
+            intent = self._intents[mxid] = self.mx.user(mxid)
+            while len(self._intents) > self.maxsize:
+                evicted, _ = self._intents.popitem(last=False)
+                # mautrix keeps its own child API object for every user it's ever made an intent for,
+                # let that go too or the pool isn't actually bounding anything
+                children = getattr(getattr(self.mx, 'api', None), 'children', None)
+                if isinstance(children, dict):
+                    children.pop(evicted, None)
+            return intent
+
+    def clear(self):
+        with self._lock:
+            self._intents.clear()
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """
+    Write-ahead journal of inbound Facebook events.
+
+    Each event is appended (and fsynced) before the bridge starts working on it, then marked done once it's in Matrix.
+    Anything not marked done when the bridge starts up again is handed back by pending() to be redelivered.
+
+    fsyncs are batched: whichever threads are waiting on a durable write all get released by the same fsync,
+    so a burst of messages costs one disk flush rather than one each.
+    """
+    def __init__(self, filename: str, sync_interval: float = 0.01, compact_every: int = 10000):
+        self.filename = filename
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._since_compaction = 0
+        self._pending = {}
+        self._closed = False
+
+        self._load()
+        self._compact()
+
+        self._syncer = threading.Thread(target=self._sync_loop, name=f"journal-{os.path.basename(filename)}",
+                                        daemon=True)
+        self._syncer.start()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn write from a crash, the event it belonged to was never acted on
+                    if record['op'] == 'event':
+                        self._pending[record['id']] = record
+                    elif record['op'] == 'done':
+                        self._pending.pop(record['id'], None)
+        except FileNotFoundError:
+            pass
+
+    def _compact(self):
+        """Rewrite the journal with only the events that haven't been done yet. Caller must hold the lock, or be __init__"""
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as f:
+            for record in self._pending.values():
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        self.file = open(self.filename, 'a')
+        self._since_compaction = 0
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                while self._synced == self._written and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                target = self._written
+                self.file.flush()
+                fileno = self.file.fileno()
+            # Writers can keep appending while this runs, they'll just be in the next batch
+            try:
+                os.fsync(fileno)
+            except OSError:
+                with self._cond:
+                    if self._closed:
+                        return  # close() got in first, and it's already fsynced everything
+                raise
+            with self._cond:
+                self._synced = max(self._synced, target)
+                self._cond.notify_all()
+            time.sleep(self.sync_interval)
+
+    def _write(self, record, durable: bool):
+        with self._cond:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            self.file.write(json.dumps(record) + '\n')
+            self._written += 1
+            sequence = self._written
+            self._since_compaction += 1
+            self._cond.notify_all()
+            if durable:
+                while self._synced < sequence:
+                    self._cond.wait()
+
+    def append(self, event_id: str, **event):
+        """Record an event before processing it, doesn't return until it's safely on disk"""
+        record = {'op': 'event', 'id': event_id, **event}
+        with self._cond:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            if event_id in self._pending:
+                return  # Already journaled, this is a replay
+            self._pending[event_id] = record
+        self._write(record, durable=True)
+
+    def done(self, event_id: str):
+        """Mark an event as finished with. Not worth waiting on, the worst case is a redelivery the checkpoints skip"""
+        with self._cond:
+            if self._closed:
+                return  # Same as not getting this far before a crash
+            if self._pending.pop(event_id, None) is None:
+                return
+        try:
+            self._write({'op': 'done', 'id': event_id}, durable=False)
+        except ValueError:
+            return  # Closed in the meantime
+
+        with self._cond:
+            if self._since_compaction >= self.compact_every:
+                # Let the syncer finish with the old file before it's swapped out from under it
+                while self._synced < self._written:
+                    self._cond.wait()
+                self.file.close()
+                self._compact()
+
+    def pending(self):
+        """Events that were journaled but never marked done, oldest first"""
+        with self._cond:
+            return list(self._pending.values())
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            # Everything's on disk now, let anyone still waiting go, and the syncer finish up
+            self._synced = self._written
+            self._cond.notify_all()
+        if self._syncer is not threading.current_thread():
+            self._syncer.join()
@@ -3,21 +3,32 @@ import argparse
 import asyncio
 import datetime
 import logging
+import os
 import queue
 import re
+import signal
 import sys
 import threading
 import time
 import urllib
 
-import yaml
+import requests.adapters
 
 import mautrix
 import mautrix.client.api.types
-from mautrix.appservice.state_store.pickle import PickleStateStore
 
-import fbchat_bridge
 import commands
+import config
+import coordinator
+import dispatch
+import executors
+import intents
+import metrics
+import ratelimit
+import sessions
+import state_store
+import tracing
+import watchdog
 
 
 # GOTCHAS:
@@ -36,10 +47,14 @@ class asyncLogger(logging.Handler):
 
         self.queue = asyncio.Queue()
 
-    async def log_to_matrix(self, matrix_intent, matrix_roomid):
+    async def log_to_matrix(self, matrix_intent, matrix_roomid, sender):
         while True:
             log_msg = self.format(await self.queue.get())
-            await matrix_intent.send_text(matrix_roomid, log_msg)
+            try:
+                await sender.send_text(matrix_intent, matrix_roomid, log_msg)
+            except mautrix.errors.MatrixRequestError as e:
+                metrics.count_matrix_error(e)
+                raise
             self.queue.task_done()
 
     def emit(self, record):
@@ -61,10 +76,8 @@ class invite_acceptor(object):
         self.room_regexes = [re.compile(r) for r in room_regexes]
 
     async def handle_event(self, mx_ev):
-        if (
-            not isinstance(mx_ev.content, mautrix.types.MemberStateEventContent) or
-            not mx_ev.content.membership == mautrix.types.Membership.INVITE
-        ):
+        # Only ever given m.room.member events, see dispatch.py
+        if mx_ev.content.membership != mautrix.types.Membership.INVITE:
             return  # This is not an invite event
 
         self.log.info(f'{mx_ev.state_key} was invited to join {mx_ev.room_id} by {mx_ev.sender}')
@@ -92,34 +105,308 @@ class invite_acceptor(object):
         return await self.mx.user(mx_ev.state_key).ensure_joined(mx_ev.room_id)
 
 
+LOG_FORMAT = '%(levelname)s:%(name)s:%(funcName)s:%(message)s'
+
+
+def route_account(dispatcher, matrix_appservice, matrix_sender, logger, running_accounts, fbchat_uid,
+                  matrix_user_localpart, **kwargs):
+    """
+    Route a Facebook account's Matrix events, before the appservice starts taking transactions.
+    They wait in the dispatcher until start_account() has the account logged in, and are dropped if it never does.
+    """
+    matrix_bot = matrix_appservice.intent
+    account_logger = logger.getChild(str(fbchat_uid))
+
+    # Resolves to the Facebook client once it's logged in, or fails if it never manages to
+    logged_in = asyncio.get_event_loop().create_future()
+    account = running_accounts[fbchat_uid] = {'logged_in': logged_in}
+
+    # Only the real user's messages are any of this account's business, commands in the protocol room, the rest bridged
+    matrix_user_id = f"@{matrix_user_localpart}:{matrix_appservice.domain}"
+
+    async def handle_matrix_event(client, mx_ev):
+        await client.handle_matrix_event(mx_ev)
+    handle_matrix_event = metrics.counted('matrix.handle_matrix_event', handle_matrix_event)
+
+    async def handle_command(mx_ev):
+        await account['command_handler'].handle_event(mx_ev)
+    handle_command = metrics.counted('matrix.command_handler', handle_command)
+
+    async def handle_message(mx_ev):
+        # There's no telling commands apart from messages to bridge until the protocol room's known,
+        # and that's only once the account's started, so they share a route until then
+        try:
+            client = await asyncio.shield(logged_in)
+        except RuntimeError:
+            if mx_ev.room_id == account.get('protocol_roomid'):
+                await matrix_sender.send_text(
+                    matrix_bot, mx_ev.room_id, "Not logged in to Facebook, run register.py again then restart the bridge")
+            else:
+                account_logger.warning(f"Dropped Matrix event {mx_ev.event_id}, not logged in to Facebook")
+            return
+        if mx_ev.room_id == account['protocol_roomid']:
+            await handle_command(mx_ev)
+        else:
+            await handle_matrix_event(client, mx_ev)
+
+    dispatcher.add(handle_message, event_types=(mautrix.types.EventType.ROOM_MESSAGE,), senders=matrix_user_id,
+                   ready=logged_in)
+
+
+async def start_account(
+        matrix_appservice,
+        matrix_sender,
+        intent_pool,
+        logger,
+        http_adapter,
+        request_executor,
+        running_accounts,
+        client_class,
+        capture_dir,
+        session_store,
+        session_save_interval,
+        fbchat_username,
+        fbchat_uid,
+        fbchat_session,
+        matrix_user_localpart,
+        **kwargs):
+    """
+    Set up everything for a single Facebook account, and return the awaitables that need to run forever.
+    Everything in here is per-account, the appservice, its bot intent, and the Facebook connection pool are shared.
+    route_account() has to have been called for it first.
+    """
+    matrix_bot = matrix_appservice.intent
+    awaitables = []
+
+    # Each account logs into its own protocol room, so one user doesn't see another user's messages
+    account_logger = logger.getChild(str(fbchat_uid))
+    log_handler = asyncLogger()
+    log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    account_logger.addHandler(log_handler)
+
+    account = running_accounts[fbchat_uid]
+    account['log_handler'] = log_handler
+    logged_in = account['logged_in']
+
+    def login_failed():
+        logged_in.set_exception(RuntimeError("Not logged in to Facebook"))
+        logged_in.exception()  # Nobody might ever be waiting on it, so don't let asyncio complain about that
+
+    async def resolve_protocol_room():
+        protocol_room_alias = f"fbchat_{fbchat_uid}_protocol"
+
+        # Make sure the protocol room exists and the bot is a member, for debugging/etc
+        try:
+            # A lot of functions (such as send_text) don't support room aliases, so save the room ID
+            protocol_roomid = (await matrix_bot.get_room_alias(
+                f"#{protocol_room_alias}:{matrix_appservice.domain}")).room_id
+        except mautrix.errors.request.MNotFound:
+            protocol_roomid = await matrix_bot.create_room(
+                alias_localpart=protocol_room_alias,
+                visibility=mautrix.client.api.types.RoomDirectoryVisibility.PRIVATE,
+                name="Facebook",
+                topic="Protocol & debug info for fbchat appservice",
+                is_direct=False,
+                invitees=[f"@{matrix_user_localpart}:{matrix_appservice.domain}"],
+                # initial_state=,
+                # room_version=,
+                # creation_content=,
+            )
+        ## Don't need to join the rooms manually because they'll be joined by the autoaccepter in main()
+        account['protocol_roomid'] = protocol_roomid
+
+        # Start logging into the room right away, so any errors from the Facebook login still end up in there
+        awaitables.append(asyncio.ensure_future(
+            log_handler.log_to_matrix(matrix_intent=matrix_bot, matrix_roomid=protocol_roomid, sender=matrix_sender)))
+        return protocol_roomid
+
+    def login():
+        # This runs in the request executor so the event loop can keep going while fbchat logs in.
+        # fbchat is slow to import, so that's left until now too.
+        # Prefer the cookies saved by the last run over the (probably stale) ones register.py saved,
+        # but if Facebook's expired them then fall back to register.py's, they might have been refreshed since.
+        saved_session = session_store.load(fbchat_uid, config_session=fbchat_session)
+        if saved_session:
+            try:
+                client = new_client(saved_session)
+                if client.isLoggedIn():
+                    return client
+                client.flush()
+            except Exception as e:
+                account_logger.debug(f"Saved session failed to log in: {e!r}")
+            account_logger.warning("Facebook rejected the saved session, trying the cookies from register.py")
+            session_store.delete(fbchat_uid)
+        return new_client(fbchat_session)
+
+    def new_client(session_cookies):
+        import fbchat_bridge
+        return (client_class or fbchat_bridge.Client)(
+            email=fbchat_username,
+            password='?',
+            session_cookies=session_cookies,
+            max_tries=2,
+            matrix_bot=matrix_bot,
+            matrix_user_localpart=matrix_user_localpart,
+            log=account_logger,
+            http_adapter=http_adapter,
+            request_executor=request_executor,
+            matrix_sender=matrix_sender,
+            intent_pool=intent_pool,
+            capture_file=os.path.join(capture_dir, f"fbchat_{fbchat_uid}.capture.gz") if capture_dir else None,
+        )
+
+    # One account failing to start (expired cookies, Facebook checkpoints, etc) mustn't take the others down with it
+    protocol_roomid, facebook_puppet = await asyncio.gather(
+        resolve_protocol_room(),
+        asyncio.get_event_loop().run_in_executor(request_executor, login),
+        return_exceptions=True,
+    )
+    if isinstance(protocol_roomid, Exception):
+        account_logger.error("Failed to set up the protocol room", exc_info=protocol_roomid)
+        if not isinstance(facebook_puppet, Exception):
+            facebook_puppet.flush()
+        login_failed()
+        return awaitables
+    if isinstance(facebook_puppet, Exception) or not facebook_puppet.isLoggedIn():
+        # This still ends up in the protocol room, the log handler's already running
+        account_logger.error("Failed to log in to Facebook, run register.py again to refresh the session cookies",
+                             exc_info=facebook_puppet if isinstance(facebook_puppet, Exception) else None)
+        login_failed()
+        return awaitables
+
+    # Set up an event handler for custom commands
+    # FIXME: Should this be done earlier to handle Facebook 2FA/etc?
+    account['command_handler'] = commands.command_handler(
+        protocol_roomid=protocol_roomid,
+        matrix_bot=matrix_bot,
+        matrix_user_localpart=matrix_user_localpart,
+        account=account,
+        request_executor=request_executor,
+        sender=matrix_sender,
+    )
+    account['client'] = facebook_puppet
+    logged_in.set_result(facebook_puppet)
+
+    # The watchdog runs the listener, and restarts it whenever it gets stuck
+    account['watchdog'] = watchdog.ListenerWatchdog(facebook_puppet)
+    account['listen_task'] = asyncio.ensure_future(account['watchdog'].run())
+    awaitables.append(account['listen_task'])
+    # Facebook rotates the cookies as it goes, save the new ones straight away and then every so often
+    session_store.save_client(facebook_puppet)
+    awaitables.append(session_store.autosave(facebook_puppet, session_save_interval))
+    account_logger.info("Logged in to Facebook")
+
+    return awaitables
+
+
+# However long the rest of the shutdown's taken, each step of it still gets at least this long
+SHUTDOWN_STEP_MIN = 2
+# A listener part way through a poll isn't worth waiting on for longer than this, what it gets is journaled anyway
+SHUTDOWN_LISTENER_WAIT = 2
+
+
+async def shutdown(running_accounts, dispatcher, request_executor, mx_state_store, session_store, timeout, logger):
+    """
+    Stop taking in new work, give whatever's already in flight until the deadline to finish, then save everything.
+    Anything that doesn't make it in time is still in the journal & checkpoints, so the next run picks it up.
+    """
+    deadline = time.monotonic() + timeout
+
+    def remaining():
+        # One slow step mustn't leave nothing for the ones after it
+        return max(SHUTDOWN_STEP_MIN, deadline - time.monotonic())
+
+    clients = [a['client'] for a in running_accounts.values() if 'client' in a]
+    logger.info(f"Shutting down, waiting up to {timeout}s for {len(clients)} account(s) to finish what they're doing")
+
+    # The listeners stop after their current poll, and hand whatever it got over to the request executor.
+    # Don't hang around for a poll that's still waiting on Facebook though.
+    for client in clients:
+        client.stop()
+    listen_tasks = [a['listen_task'] for a in running_accounts.values() if 'listen_task' in a]
+    if listen_tasks:
+        _, pending = await asyncio.wait(listen_tasks, timeout=min(SHUTDOWN_LISTENER_WAIT, remaining()))
+        if pending:
+            logger.warning(f"{len(pending)} listener(s) still mid-poll, the next run will catch up after them")
+
+    # Matrix events that have already been received, but not handled yet
+    try:
+        await asyncio.wait_for(dispatcher.drain(), timeout=remaining())
+    except asyncio.TimeoutError:
+        logger.warning(f"Dropped {dispatcher.queued} unhandled Matrix event(s)")
+
+    # Messages still being bridged, and anything else queued up for Facebook, like catch-ups or profile syncs
+    drain_until = time.monotonic() + remaining()
+    while (request_executor.queued or request_executor.stats['running']) and time.monotonic() < drain_until:
+        await asyncio.sleep(0.1)
+
+    # Whatever's still waiting to go into the protocol rooms
+    for uid, account in running_accounts.items():
+        if 'log_handler' not in account:
+            continue
+        try:
+            await asyncio.wait_for(account['log_handler'].queue.join(), timeout=remaining())
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropped {account['log_handler'].queue.qsize()} log message(s) for {uid}")
+
+    # Room state changes still waiting out their debounce window
+    for client in clients:
+        try:
+            await asyncio.wait_for(client.state_debouncer.flush(), timeout=remaining())
+        except asyncio.TimeoutError:
+            logger.warning(f"Gave up waiting on room state changes for {client.uid}")
+
+    for client in clients:
+        client.flush()
+        session_store.save_client(client)
+    mx_state_store.close()
+
+
 async def main(
         matrix_baseurl,
         as_token,
         hs_token,
         sender_localpart,
         matrix_domain,
-        matrix_user_localpart,
-        fbchat_username,
-        fbchat_uid,
-        fbchat_session,
         url,
         namespaces,
+        accounts,
         verbose,
+        shard=None,
+        port=None,
+        fbchat_request_threads=4,
+        tracing_export=None,
+        client_class=None,
+        fbchat_capture_dir=None,
+        fbchat_session_dir='.',
+        fbchat_session_save_interval=10 * 60,
+        shutdown_timeout=30,
+        matrix_event_concurrency=16,
+        matrix_intent_pool_size=1024,
         **kwargs):
 
-    log_handler = asyncLogger()
     logging.basicConfig(
-        format='%(levelname)s:%(name)s:%(funcName)s:%(message)s',
-        handlers=(log_handler, logging.StreamHandler(None)),
+        format=LOG_FORMAT,
+        handlers=(logging.StreamHandler(None),),
     )
     logger = logging.getLogger(__name__)
     logger.setLevel(max(30 - (10 * verbose), logging.DEBUG))
 
-    protocol_room_alias = f"fbchat_{fbchat_uid}_protocol"
+    # Per-message traces go to a file or an OpenTelemetry collector, if configured
+    tracing.configure(tracing_export)
+
+    if shard:
+        # Running as a worker behind the coordinator, only look after this worker's share of the accounts
+        index, shards = shard
+        accounts = [a for a in accounts if coordinator.shard_of(a['fbchat_uid'], shards) == index]
+        logger.info(f"Running as worker {index}/{shards} with {len(accounts)} account(s)")
 
     async def default_query_handler(query):
         logger.warning(f"query made for {query}")
 
+    # Every worker needs its own state file, they'd just clobber each other's cached rows otherwise
+    mx_state_store = state_store.SQLiteStateStore(db_file=f'mx-state.shard{shard[0]}.db' if shard else 'mx-state.db')
+
     matrix_appservice = mautrix.AppService(
         server=matrix_baseurl,
         domain=matrix_domain,
@@ -129,11 +416,59 @@ async def main(
         query_user=default_query_handler,
         query_alias=default_query_handler,
         # log=logger,
-        state_store=PickleStateStore(autosave_file='mx-state.p')
+        state_store=mx_state_store,
     )
 
+    # One pool of connections to Facebook for all the accounts,
+    # the Matrix side already shares the appservice's single aiohttp session between all intents.
+    http_adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, 2 * len(accounts)))
+    # Likewise one pool of threads for the blocking fbchat requests, each account's listener gets its own thread
+    request_executor = executors.InstrumentedExecutor(
+        max_workers=fbchat_request_threads, thread_name_prefix='fbchat-request')
+
+    session_store = sessions.SessionStore(directory=fbchat_session_dir)
+
+    # Matrix events are handled in per-room queues, with a cap on how many are handled at once overall
+    dispatcher = dispatch.Dispatcher(log=logger, max_concurrent=matrix_event_concurrency)
+    # And every message sent into Matrix goes through the one rate limiter, so they all share the same budgets
+    matrix_sender = ratelimit.Sender()
+
+    # Everything that gets reported on /metrics but has to be looked up at scrape time
+    running_accounts = {}
+
+    def _executors():
+        return [request_executor] + [a['client'].listen_executor for a in running_accounts.values() if 'client' in a]
+
+    metrics.Gauge('bridge_queue_depth', "Items waiting in the bridge's internal queues", ('queue',), callback=lambda: {
+        **{(f"log:{uid}",): a['log_handler'].queue.qsize()
+           for uid, a in running_accounts.items() if 'log_handler' in a},
+        **{(f"executor:{e.name}",): e.queued for e in _executors()},
+        **{(f"messages:{uid}",): a['client'].message_queues.queued
+           for uid, a in running_accounts.items() if 'client' in a},
+        ('matrix_events',): dispatcher.queued,
+    })
+    metrics.Gauge('bridge_executor_saturation', "Fraction of an executor's threads that are busy", ('executor',),
+                  callback=lambda: {(e.name,): e.saturation for e in _executors()})
+    # Only ever go up, except when the watchdog swaps in a new listener executor, which rate() sees as a reset
+    metrics.Counter('bridge_executor_wait_seconds_total', "Total time jobs have spent waiting for a thread",
+                    ('executor',), callback=lambda: {(e.name,): e.stats['wait_total'] for e in _executors()})
+    metrics.Counter('bridge_executor_run_seconds_total', "Total time jobs have spent running", ('executor',),
+                    callback=lambda: {(e.name,): e.stats['run_total'] for e in _executors()})
+    metrics.Gauge('bridge_listener_phase_seconds', "How long each Facebook listener has been in its current phase",
+                  ('account', 'phase'), callback=lambda: {
+                      (uid, a['client'].listener_phase): time.monotonic() - a['client'].listener_phase_since
+                      for uid, a in running_accounts.items() if 'client' in a})
+    metrics.Gauge('bridge_accounts', "Facebook accounts logged in",
+                  callback=lambda: sum(a['logged_in'].done() and not a['logged_in'].exception() for a in running_accounts.values()))
+    metrics.add_route(matrix_appservice.app)
+
     url_parsed = urllib.parse.urlsplit(url)
-    async with matrix_appservice.run(host=url_parsed.hostname, port=url_parsed.port) as server:
+    if port:
+        # Workers only ever talk to the coordinator on the same machine
+        host = '127.0.0.1'
+    else:
+        host, port = url_parsed.hostname, url_parsed.port
+    async with matrix_appservice.run(host=host, port=port) as server:
         awaitables = []
 
         matrix_bot = matrix_appservice.intent
@@ -143,6 +478,13 @@ async def main(
         # So, instead, I have added the matrix user to the appservice's regexes,
         # and am treating it as another child of the appservice
 
+        # Only the recently active puppets' intents are kept around, for all the accounts together
+        intent_pool = intents.IntentPool(matrix_bot, maxsize=matrix_intent_pool_size)
+
+        # mautrix only knows about this one handler, which passes each event on to just the handlers that want it
+        matrix_appservice.matrix_event_handler(dispatcher.dispatch)
+        dispatcher.filter_transactions(matrix_appservice)
+
         # Before creating any rooms, or doing anything really,
         # set up an event handler to autoaccept invites to & from appservice users.
         autoaccepter = invite_acceptor(
@@ -151,60 +493,52 @@ async def main(
             user_regexes=(ns['regex'] for ns in namespaces['users']),
             room_regexes=(ns['regex'] for ns in namespaces['aliases']),
         )
-        matrix_appservice.matrix_event_handler(autoaccepter.handle_event)
+        dispatcher.add(metrics.counted('matrix.invite_acceptor', autoaccepter.handle_event),
+                       event_types=(mautrix.types.EventType.ROOM_MEMBER,))
+
+        # Start accepting transactions before logging in to anything,
+        # they're queued up in the dispatcher until the account they're for is ready for them.
+        for account in accounts:
+            route_account(dispatcher=dispatcher, matrix_appservice=matrix_appservice, matrix_sender=matrix_sender,
+                          logger=logger, running_accounts=running_accounts, **account)
+        await (await server).start_serving()
+
+        # SIGTERM (or ^C) starts a graceful shutdown, so a restart doesn't lose anything that's in flight
+        stopping = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(sig, stopping.set)
+
+        # All the accounts log in at the same time, rather than one after the other
+        for account_awaitables in await asyncio.gather(*(start_account(
+                matrix_appservice=matrix_appservice,
+                matrix_sender=matrix_sender,
+                intent_pool=intent_pool,
+                logger=logger,
+                http_adapter=http_adapter,
+                request_executor=request_executor,
+                running_accounts=running_accounts,
+                client_class=client_class,  # Only ever changed for benchmarks/tests, see fakes.py
+                capture_dir=fbchat_capture_dir,
+                session_store=session_store,
+                session_save_interval=fbchat_session_save_interval,
+                **account,
+        ) for account in accounts)):
+            awaitables.extend(account_awaitables)
 
-        # Make sure the protocol room exists and the bot is a member, for debugging/etc
+        # Let the user know we've started the things, then wait for all the things (forever)
+        logger.info(f"Ready! Bridging {len(accounts)} Facebook account(s)")
+        everything = asyncio.gather(*awaitables)
         try:
-            # A lot of functions (such as send_text) don't support room aliases, so save the room ID
-            protocol_roomid = (await matrix_bot.get_room_alias(f"#{protocol_room_alias}:{matrix_appservice.domain}")).room_id
-        except mautrix.errors.request.MNotFound:
-            protocol_roomid = await matrix_bot.create_room(
-                alias_localpart=protocol_room_alias,
-                visibility=mautrix.client.api.types.RoomDirectoryVisibility.PRIVATE,
-                name="Facebook",
-                topic="Protocol & debug info for fbchat appservice",
-                is_direct=False,
-                invitees=[f"@{matrix_user_localpart}:{matrix_appservice.domain}"],
-                # initial_state=,
-                # room_version=,
-                # creation_content=,
-            )
+            await asyncio.wait([everything, asyncio.ensure_future(stopping.wait())],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if everything.done():
+                everything.result()  # Something died, raise whatever killed it
         finally:
-            ## Don't need to join the rooms manually because they'll be joined by the autoaccepter above
-            # awaitables.append(matrix_bot.ensure_joined(protocol_roomid))
-            # awaitables.append(matrix_puppet.ensure_joined(protocol_roomid))
-            awaitables.append(log_handler.log_to_matrix(matrix_intent=matrix_bot, matrix_roomid=protocol_roomid))
-
-        # Log into Facebook
-        # The only reason this isn't done earlier is because I want any errors logged into the protocol room
-        facebook_puppet = fbchat_bridge.Client(
-            email=fbchat_username,
-            password='?',
-            session_cookies=fbchat_session,
-            max_tries=2,
-            matrix_bot=matrix_bot,
-            matrix_user_localpart=matrix_user_localpart,
-            log=logger,
-        )
-        assert facebook_puppet.isLoggedIn()
-        matrix_appservice.matrix_event_handler(facebook_puppet.handle_matrix_event)
-
-        # Set up an event handler for custom commands
-        # FIXME: Should this be done earlier to handle Facebook 2FA/etc?
-        cmd_hdlr = commands.command_handler(
-            protocol_roomid=protocol_roomid,
-            matrix_bot=matrix_bot,
-            matrix_user_localpart=matrix_user_localpart,
-        )
-        matrix_appservice.matrix_event_handler(cmd_hdlr.handle_event)
-
-        # Finally actually start the things
-        awaitables.append((await server).start_serving())
-        awaitables.append(facebook_puppet.listen())
-
-        # Let the user know we've started the things, then wait for all the things (forever)
-        logger.info("Ready!")
-        await asyncio.gather(*awaitables)
+            # Don't lose whatever's in flight, the last batch of state changes, or the latest session cookies
+            await shutdown(running_accounts=running_accounts, dispatcher=dispatcher, request_executor=request_executor,
+                           mx_state_store=mx_state_store, session_store=session_store,
+                           timeout=shutdown_timeout, logger=logger)
+            everything.cancel()
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(
@@ -218,9 +552,31 @@ if __name__ == '__main__':
         default=0,
         action='count',
         help="Print debug output")
+    argparser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=0,
+        help="Run as a coordinator, sharding the Facebook accounts across this many worker processes. "
+             "Accounts are assigned by a hash of their uid, SIGHUP picks up added or removed accounts "
+             "but keeps the same number of workers")
+    argparser.add_argument(
+        '--shard',
+        type=lambda s: tuple(int(i) for i in s.split('/')),
+        help=argparse.SUPPRESS)  # Only used by the coordinator when starting workers, as "index/count"
+    argparser.add_argument(
+        '--port',
+        type=int,
+        help=argparse.SUPPRESS)  # Only used by the coordinator when starting workers
 
     args = argparser.parse_args()
-    args.config = yaml.load(args.yaml_file)
+
+    if args.workers:
+        # The coordinator rereads the config file itself on every rebalance, so only pass it the filename
+        args.yaml_file.close()
+        coordinator.run(config_filename=args.yaml_file.name, workers=args.workers, verbose=args.verbose)
+        sys.exit()
+
+    args.config = config.load(args.yaml_file)
 
     # I could use argparse to get the filename then use the much safer & tider with..as syntax,
     # but I figure letting argparse open the file handle will give much better output when it fails.
@@ -228,4 +584,4 @@ if __name__ == '__main__':
     del args.yaml_file
 
     # FIXME: Is using **vars(...) safe?
-    asyncio.run(main(**args.config, verbose=args.verbose))
+    asyncio.run(main(**args.config, verbose=args.verbose, shard=args.shard, port=args.port))
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+import gc
+import tracemalloc
+
+
+# Objects the bridge makes lots of, and that would be the first suspects for a leak.
+# Matched by name so counting them doesn't need fbchat or mautrix imported.
+BRIDGE_TYPES = {
+    'Person': 'fbchat_bridge',
+    'Room': 'fbchat_bridge',
+    'IntentAPI': 'mautrix',
+    'LogRecord': 'logging',
+}
+
+
+def count_bridge_objects():
+    counts = dict.fromkeys(BRIDGE_TYPES, 0)
+    for o in gc.get_objects():
+        name = type(o).__name__
+        if name in counts and type(o).__module__.startswith(BRIDGE_TYPES[name]):
+            counts[name] += 1
+    return counts
+
+
+def take_snapshot():
+    """tracemalloc snapshot without tracemalloc's own (or the import system's) allocations cluttering it up"""
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+class SnapshotTracker(object):
+    """
+    Take tracemalloc snapshots on demand in a running bridge, and compare each one to the one before.
+
+    tracemalloc isn't started until the first snapshot, and can be stopped again afterwards,
+    because it slows everything down and uses a fair bit of memory itself.
+    """
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.previous = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def snapshot(self, top: int = 10):
+        """Blocking, returns the top growth since the last snapshot, or None if this is the first one"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = None
+        gc.collect()
+        snapshot = take_snapshot()
+        growth = snapshot.compare_to(self.previous, 'lineno')[:top] if self.previous else None
+        self.previous = snapshot
+        return growth
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
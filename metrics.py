@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+"""
+Just enough of a Prometheus client to expose the bridge's internals on the appservice's own HTTP server.
+
+I didn't want to pull in prometheus_client for a handful of counters,
+and this way everything shows up on the port the appservice already listens on.
+"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+import aiohttp.web
+
+
+_registry = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        """Total of every value matching the given labels, so leaving some (or all) out sums over them"""
+        wanted = {self.labelnames.index(name): str(value) for name, value in labels.items()}
+        with self._lock:
+            return sum(value for key, value in self._values.items()
+                       if all(key[i] == value for i, value in wanted.items()))
+
+    def samples(self):
+        if self.callback:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [(self.name, self.labelnames, key, (), value) for key, value in values.items()]
+        with self._lock:
+            return [(self.name, self.labelnames, key, (), value) for key, value in self._values.items()]
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labelnames, labelvalues, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, labelvalues, extra)} {value}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """
+    Either inc() directly, or given a callback that returns the running total when scraped,
+    for totals that are already kept somewhere else. Same dict of {labelvalues tuple: value} as Gauge for those.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Either set() directly, or given a callback that returns the current value when scraped.
+    The callback can return a dict of {labelvalues tuple: value} for labelled gauges.
+    """
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @property
+    def count(self):
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._values.values())
+
+    def means(self):
+        """{labelvalues: mean} for everything observed so far"""
+        with self._lock:
+            return {key: total / sum(counts) for key, (counts, total) in self._values.items() if sum(counts)}
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", self.labelnames, key, (('le', bound),), cumulative))
+                samples.append((f"{self.name}_sum", self.labelnames, key, (), total))
+                samples.append((f"{self.name}_count", self.labelnames, key, (), cumulative))
+        return samples
+
+
+def counted(handler_name: str, func):
+    """Wrap an event handler so every call to it is counted, and any exceptions it raises too"""
+    if getattr(func, '_counted', False):
+        return func
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            handler_events.inc(handler=handler_name)
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(handler=handler_name)
+                raise
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            handler_events.inc(handler=handler_name)
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(handler=handler_name)
+                raise
+    wrapper._counted = True
+    return wrapper
+
+
+def count_matrix_error(exception):
+    """Record a failed Matrix API call, picking out the rate limiting ones"""
+    errcode = getattr(exception, 'errcode', None) or type(exception).__name__
+    matrix_errors.inc(errcode=errcode)
+    if errcode == 'M_LIMIT_EXCEEDED':
+        matrix_rate_limited.inc()
+
+
+def expose():
+    return '\n'.join(metric.expose() for metric in _registry) + '\n'
+
+
+async def handle_metrics(request):
+    return aiohttp.web.Response(text=expose(), content_type='text/plain', charset='utf-8')
+
+
+def add_route(app):
+    """Add /metrics to the appservice's aiohttp application, has to be done before the server starts"""
+    app.router.add_get('/metrics', handle_metrics)
+
+
+## The bridge's metrics, everything else just imports these
+started = Gauge('bridge_start_time_seconds', "When the bridge was started")
+started.set(time.time())
+
+fb_to_mx_latency = Histogram('bridge_fb_to_mx_latency_seconds',
+                             "Time from Facebook's timestamp on a message until it was sent into Matrix")
+mx_to_fb_latency = Histogram('bridge_mx_to_fb_latency_seconds',
+                             "Time from Matrix's timestamp on an event until the bridge finished handling it")
+stage_latency = Histogram('bridge_stage_latency_seconds',
+                          "Time spent in each stage of bridging a message, see tracing.py", ('stage',))
+handler_events = Counter('bridge_handler_events_total', "Events handled, per handler", ('handler',))
+handler_errors = Counter('bridge_handler_errors_total', "Exceptions raised by event handlers", ('handler',))
+cache_lookups = Counter('bridge_cache_lookups_total', "Person/Room/intent cache lookups", ('cache', 'result'))
+matrix_errors = Counter('bridge_matrix_errors_total', "Failed Matrix API calls", ('errcode',))
+matrix_rate_limited = Counter('bridge_matrix_rate_limited_total', "Matrix API calls rejected with M_LIMIT_EXCEEDED")
+matrix_timeouts = Counter('bridge_matrix_timeouts_total', "Matrix calls from the Facebook listener that were given up on")
+listener_poll_duration = Histogram('bridge_listener_poll_seconds', "Time taken by each Facebook listener poll",
+                                   buckets=(0.5, 1, 5, 10, 30, 60, 120, 300))
+listener_callback_duration = Histogram('bridge_listener_callback_seconds',
+                                       "Time spent handling the events from each Facebook listener poll")
+listener_restarts = Counter('bridge_listener_restarts_total', "Facebook listeners restarted by the watchdog",
+                            ('account', 'cause'))
+matrix_send_wait = Histogram('bridge_matrix_send_wait_seconds', "Time sends, state changes & membership changes spent waiting on the bridge's own rate limits")
+state_updates = Counter('bridge_state_updates_total',
+                        "Room state changes from Facebook, sent or coalesced into a later one", ('result',))
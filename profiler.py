@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+import collections
+import os
+import sys
+import threading
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)})"
+
+
+class Sampler(object):
+    """
+    Poor man's sampling profiler, grabs the stacks of the chosen threads every interval seconds.
+
+    Works with threads that are blocked in C code (like the event loop waiting on epoll, or fbchat waiting on a socket),
+    which cProfile can't see, and doesn't slow down the threads being sampled.
+    The results are written out in the collapsed stack format used by flamegraph.pl, speedscope, etc.
+    """
+    def __init__(self, threads: dict, interval: float = 0.005):
+        # label -> thread ident, or a callable returning the ident for threads that might get replaced mid-sample
+        self.threads = threads
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frames = sys._current_frames()
+        for label, ident in self.threads.items():
+            frame = frames.get(ident() if callable(ident) else ident)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[(label,) + tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, filename: str):
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def top(self, count: int = 10):
+        """[(label, frame, self samples, total samples)] for the frames the most time was spent in, per thread"""
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, samples in self.stacks.items():
+            label, frames = stack[0], stack[1:]
+            own[(label, frames[-1])] += samples
+            for frame in set(frames):
+                total[(label, frame)] += samples
+        return [(label, frame, samples, total[(label, frame)]) for (label, frame), samples in own.most_common(count)]
+
+    def summary(self, count: int = 10):
+        per_thread = collections.Counter()
+        for stack, samples in self.stacks.items():
+            per_thread[stack[0]] += samples
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f}ms"]
+        for label, frame, samples, total in self.top(count):
+            lines.append(f"{samples / per_thread[label]:6.1%} self {total / per_thread[label]:6.1%} total "
+                         f"[{label}] {frame}")
+        return '\n'.join(lines)
+
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+import hashlib
+import mimetypes
+import os
+import pickle
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import fbchat
+
+import fbchat_bridge
+
+# Don't let a slow CDN hold up whichever thread's syncing the profile
+PHOTO_TIMEOUT = 30
+
+
+def _hash(value: str):
+    if not value:
+        return None
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+def _photo_hash(photo_url: str):
+    # Facebook's CDN URLs come with signing tokens in the query string that change even when the photo doesn't,
+    # so only the path is used to decide whether the photo is actually different.
+    if not photo_url:
+        return None
+    return _hash(urllib.parse.urlsplit(photo_url).path)
+
+
+class ProfileSync(object):
+    """
+    Keep the puppets' Matrix displaynames & avatars in sync with their Facebook profiles.
+
+    A hash of the last displayname & photo that was set for each puppet is kept on disk,
+    so the Matrix side is only touched when something actually changed on Facebook.
+    Uploaded avatars are remembered by photo hash so the same photo never gets uploaded twice.
+
+    sync() gets called from the listener, catch-up and command threads all at once,
+    so the hashes are only ever touched with the lock held. The Matrix & Facebook requests are done without it.
+    """
+    def __init__(self, fb_client, autosave_file: str = 'fb-profiles.p', refresh_interval: int = 24 * 60 * 60):
+        self.fb = fb_client
+        self.autosave_file = autosave_file
+        self.refresh_interval = refresh_interval
+
+        # fbid -> {'name': hash, 'photo': hash, 'checked': timestamp}
+        self.hashes = {}
+        # photo hash -> mxc URI
+        self.mxc_cache = {}
+        self._lock = threading.Lock()
+        # Held for the whole save, so an older copy can never be put in place after a newer one
+        self._save_lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+        if not self.autosave_file or not os.path.isfile(self.autosave_file):
+            return
+        with open(self.autosave_file, 'rb') as f:
+            data = pickle.load(f)
+        self.hashes = data.get('hashes', {})
+        self.mxc_cache = data.get('mxc_cache', {})
+
+    def save(self):
+        if not self.autosave_file:
+            return
+        with self._save_lock:
+            with self._lock:
+                data = pickle.dumps({'hashes': self.hashes, 'mxc_cache': self.mxc_cache})
+            # Write to a temporary file first so a crash mid-write doesn't lose all the hashes
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.autosave_file) or '.',
+                                            prefix=f".{os.path.basename(self.autosave_file)}.")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_file, self.autosave_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+
+    def clear(self):
+        """Forget every profile hash, so they're all checked against Facebook again. Uploaded avatars are kept."""
+        with self._lock:
+            self.hashes.clear()
+
+    def _needs_check(self, fbid: str):
+        with self._lock:
+            checked = self.hashes.get(fbid, {}).get('checked')
+        return not checked or time.time() - checked > self.refresh_interval
+
+    def _fetch_user_info(self, fbids):
+        try:
+            # One bulk request for everyone instead of one per person
+            return self.fb.fetchUserInfo(*fbids)
+        except fbchat.FBchatUserError:
+            # fbchat fails the whole lot if any of them is a Page rather than a person, so try them one at a time
+            user_infos = {}
+            for fbid in fbids:
+                try:
+                    user_infos.update(self.fb.fetchUserInfo(fbid))
+                except fbchat.FBchatUserError:
+                    self.fb.log.debug(f"{fbid} isn't a Facebook user, not syncing its profile")
+                    # No point asking again every time they turn up
+                    with self._lock:
+                        self.hashes.setdefault(fbid, {})['checked'] = time.time()
+            return user_infos
+
+    def sync(self, people, force: bool = False):
+        """
+        Update the Matrix profile of each of the given Person objects.
+
+        Blocking, this must be called from one of the Facebook threads, not from inside the event loop.
+        """
+        people = {p.fbid: p for p in people if p.fbid != self.fb.uid and (force or self._needs_check(p.fbid))}
+        if not people:
+            return
+
+        user_infos = self._fetch_user_info(list(people.keys()))
+
+        for fbid, user_info in user_infos.items():
+            person = people[fbid]
+            with self._lock:
+                stored = dict(self.hashes.get(fbid, {}))
+
+            name_hash = _hash(user_info.name)
+            if name_hash and name_hash != stored.get('name'):
+                self.fb.log.debug(f"Updating displayname for {person.mxid}")
+                fbchat_bridge.mx_coro(person.mx, person.mx.set_displayname(user_info.name))
+                stored['name'] = name_hash
+
+            photo_hash = _photo_hash(user_info.photo)
+            if photo_hash and photo_hash != stored.get('photo'):
+                self.fb.log.debug(f"Updating avatar for {person.mxid}")
+                mxc = self.mxc_for(person.mx, user_info.photo)
+                fbchat_bridge.mx_coro(person.mx, person.mx.set_avatar_url(mxc))
+                stored['photo'] = photo_hash
+
+            stored['checked'] = time.time()
+            with self._lock:
+                self.hashes[fbid] = stored
+
+        self.save()
+
+    def mxc_for(self, intent, photo_url: str):
+        """Upload a Facebook photo into Matrix, unless it's been uploaded before. Blocking."""
+        photo_hash = _photo_hash(photo_url)
+        with self._lock:
+            mxc = self.mxc_cache.get(photo_hash)
+        if not mxc:
+            # Two threads might both upload the same new photo, that's harmless and not worth holding the lock over
+            mxc = self._upload_photo(intent, photo_url)
+            with self._lock:
+                self.mxc_cache[photo_hash] = mxc
+        return mxc
+
+    def _upload_photo(self, intent, photo_url: str):
+        with urllib.request.urlopen(photo_url, timeout=PHOTO_TIMEOUT) as response:
+            data = response.read()
+            mime_type = (response.headers.get_content_type() or
+                         mimetypes.guess_type(urllib.parse.urlsplit(photo_url).path)[0])
+        return fbchat_bridge.mx_coro(intent, intent.upload_media(data, mime_type=mime_type))
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+import asyncio
+import collections
+import time
+
+import mautrix.api
+import mautrix.errors
+import mautrix.types
+
+import metrics
+
+
+class TokenBucket(object):
+    """
+    rate tokens a second, up to burst of them saved up.
+
+    The rate adapts to the homeserver: every time it says to slow down the rate is halved (and nothing more is sent
+    until its retry_after has passed), then it creeps back up towards the configured rate with each success.
+    """
+    def __init__(self, rate: float, burst: int, min_rate: float = 0.05):
+        self.max_rate = self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until a token is available"""
+        self._refill()
+        blocked = max(0, self.blocked_until - time.monotonic())
+        return max(blocked, (1 - self.tokens) / self.rate if self.tokens < 1 else 0)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def slow_down(self, retry_after: float):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def idle(self):
+        """Back to how a new bucket would start out, so there's nothing lost by forgetting it"""
+        self._refill()
+        return self.tokens >= self.burst and self.rate >= self.max_rate and self.blocked_until <= time.monotonic()
+
+
+class Sender(object):
+    """
+    Send Matrix events through a token bucket per sender and another per room,
+    so bursts get smoothed out instead of hitting M_LIMIT_EXCEEDED, and one busy group can't use up everyone's budget.
+    Room state changes, invites, joins & leaves count against the same buckets, through call().
+
+    When the homeserver does rate limit a send anyway, it's retried after the retry_after_ms it gave,
+    and the sender's bucket slows down to match. Homeservers rate limit per user, so the room's bucket is left alone.
+    Buckets that have filled back up are forgotten every evict_interval seconds, there's one for every puppet & room.
+    """
+    def __init__(self, sender_rate: float = 5, sender_burst: int = 10, room_rate: float = 2, room_burst: int = 10,
+                 max_retries: int = 5, evict_interval: float = 60):
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.evict_interval = evict_interval
+
+        self._senders = {}
+        self._rooms = {}
+        self._last_evict = time.monotonic()
+
+    def _buckets(self, mxid: str, room_id: str):
+        if time.monotonic() - self._last_evict > self.evict_interval:
+            self._evict()
+        sender = self._senders.get(mxid)
+        if sender is None:
+            sender = self._senders[mxid] = TokenBucket(self.sender_rate, self.sender_burst)
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = TokenBucket(self.room_rate, self.room_burst)
+        return sender, room
+
+    def _evict(self):
+        # Anything still waiting on a bucket has taken from it, so it can't be full
+        for buckets in (self._senders, self._rooms):
+            for key in [key for key, bucket in buckets.items() if bucket.idle()]:
+                del buckets[key]
+        self._last_evict = time.monotonic()
+
+    def __len__(self):
+        return len(self._senders) + len(self._rooms)
+
+    async def _acquire(self, buckets):
+        # No awaits between checking the buckets and taking from them, so nothing else can sneak in
+        while True:
+            delay = max(bucket.delay() for bucket in buckets)
+            if delay <= 0:
+                for bucket in buckets:
+                    bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _send_event(intent, room_id: str, event_type, content, txn_id: str = None, **kwargs):
+        if txn_id is None:
+            return await intent.send_message_event(room_id, event_type, content, **kwargs)
+        # mautrix always makes up its own transaction ID and won't take one in, so do the PUT it would have done
+        await intent.ensure_joined(room_id)
+        if isinstance(content, mautrix.types.Serializable):
+            content = content.serialize()
+        response = await intent.api.request(mautrix.api.Method.PUT,
+                                            mautrix.api.Path.rooms[room_id].send[event_type][txn_id],
+                                            content, **kwargs)
+        return response['event_id']
+
+    async def call(self, intent, room_id: str, func, *args, **kwargs):
+        """
+        Same as await func(*args, **kwargs), just politely.
+        func is something intent does in room_id, e.g. intent.send_state_event or intent.invite_user.
+        """
+        buckets = self._buckets(intent.mxid, room_id)
+        for attempt in range(self.max_retries + 1):
+            queued_at = time.monotonic()
+            await self._acquire(buckets)
+            metrics.matrix_send_wait.observe(time.monotonic() - queued_at)
+            try:
+                result = await func(*args, **kwargs)
+            except mautrix.errors.MatrixRequestError as e:
+                if getattr(e, 'errcode', None) != 'M_LIMIT_EXCEEDED' or attempt == self.max_retries:
+                    raise
+                metrics.count_matrix_error(e)
+                # Not every version of mautrix keeps the retry_after_ms from the response, so guess if it's missing
+                retry_after_ms = getattr(e, 'retry_after_ms', None) or 1000 * 2 ** attempt
+                buckets[0].slow_down(retry_after_ms / 1000)
+                continue
+            for bucket in buckets:
+                bucket.succeeded()
+            return result
+
+    async def send(self, intent, room_id: str, event_type, content, txn_id: str = None, **kwargs):
+        """
+        Same as intent.send_message_event(), just politely.
+        With a txn_id, sending the same thing again is a no-op for as long as the homeserver remembers it.
+        """
+        return await self.call(intent, room_id, self._send_event, intent, room_id, event_type, content,
+                               txn_id=txn_id, **kwargs)
+
+    async def send_text(self, intent, room_id: str, text: str, **kwargs):
+        content = mautrix.types.TextMessageEventContent(msgtype=mautrix.types.MessageType.TEXT, body=text)
+        return await self.send(intent, room_id, mautrix.types.EventType.ROOM_MESSAGE, content, **kwargs)
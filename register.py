@@ -16,8 +16,8 @@ argparser = argparse.ArgumentParser(
 argparser.add_argument(
     'yaml_filename',
     nargs="?",
-    help=("Filename to save the yaml config to."
-          "If file already exists, just refresh the Facebook session cookies"))
+    help=("Filename to save the yaml config to. "
+          "If file already exists, add this Facebook account to it or refresh its session cookies"))
 argparser.add_argument(
     '-m', '--matrix-user',
     required=True,
@@ -45,14 +45,19 @@ if args.yaml_filename and os.path.isfile(args.yaml_filename):
     with open(args.yaml_filename, 'r') as f:
         registration_data = yaml.load(f)
 
-    if args.fb_user and args.fb_user != registration_data['fbchat_username']:
-        raise Exception("Requested Facebook username doesn't match config")
-    elif not args.fb_user:
-        args.fb_user = registration_data['fbchat_username']
-    fb_session = registration_data['fbchat_session']
+    # Older config files only had a single account in the top level, move it into the list of accounts
+    if 'accounts' not in registration_data:
+        registration_data['accounts'] = [{key: registration_data.pop(key) for key in (
+            'fbchat_username', 'fbchat_uid', 'fbchat_session', 'matrix_user_localpart')}]
+
+    # If this Facebook user is already in the config, just refresh the session cookies
+    existing_account = next((a for a in registration_data['accounts'] if a['fbchat_username'] == args.fb_user), None)
+    fb_session = existing_account['fbchat_session'] if existing_account else {}
 else:
     registration_data = None
+    existing_account = None
 
+if not existing_account:
     print("If prompted for 2FA code, you can give an empty code after approving the login from a logged in session")
     fb_session = {}
 
@@ -76,50 +81,55 @@ except fbchat._exception.FBchatUserError as e:
     else:
         raise
 
-if registration_data:
-    if registration_data['fbchat_uid'] != fb.uid:
-        raise fbchat._exception.FBchatUserError("Logged in Facebook account doesn't match config")
-    hs_token = registration_data['hs_token']
-    as_token = registration_data['as_token']
-else:
-    hs_token = secrets.token_hex(),  # Does this follow the same spec as Matrix expects?
-    as_token = secrets.token_hex(),  # Perhaps it could be more random?
-
-registration_data = {
-    'id': f"mautrix-fbchat_{fb.uid}",
-    'url': f"http://127.0.0.1:{args.port}",
-    'hs_token': hs_token,
-    'as_token': as_token,
-    'namespaces': {
-        # Yes these are single-item lists, it's not a typo, Synapse actually needs it to work that way.
-        'users': [
-            {'exclusive': True, 'regex': f"@fbchat_{fb.uid}_.*"}
-            {'exclusive': False, 'regex': f"@{args.matrix_user}:{args.domain}"}  # FIXME: Is this incredibly evil?
-        ],
-        'aliases': [
-            {'exclusive': True, 'regex': f"#fbchat_{fb.uid}_.*"}
-        ],
-        'rooms': []  # FIXME: Can I get away with just removing this?
-    },
-    'sender_localpart': f"fbchat_{fb.uid}",
-    'rate_limited': True,
-    'protocols': ["fbchat"],
-
-    # I would like to avoid having multiple config files sharing some of the same secret tokens.
-    # So instead of copying the as/hs token values into another config file along with the Facebook auth tokens,
-    # I'm just going include the Facebook auth tokens in with the Synapse config and rely on Synapse ignoring it.
-    #
-    # FIXME: Can I store this info in Matrix somehow?
+if existing_account and existing_account['fbchat_uid'] != fb.uid:
+    raise fbchat._exception.FBchatUserError("Logged in Facebook account doesn't match config")
+
+account = {
     'fbchat_username': fb.email,  # fbchat library won't let me login with *just* the session cookies, so use the username too.
     'fbchat_uid': fb.uid,  # Just so we can later confirm who this config
     'fbchat_session': fb.getSession(),  # FIXME: Do I need all the session cookies? Is this yaml file stored securely?
-
-    'matrix_domain': args.domain,
-    'matrix_baseurl': args.baseurl,
     'matrix_user_localpart': args.matrix_user,
 }
 
-yaml_filename = args.yaml_filename if args.yaml_filename else f"fbchat_{fb.uid}_appservice.yaml"
+if registration_data:
+    # Adding another account to an existing appservice, everything except the accounts & namespaces stays the same
+    registration_data['accounts'] = [a for a in registration_data['accounts']
+                                     if a['fbchat_uid'] != fb.uid] + [account]
+else:
+    registration_data = {
+        'id': "mautrix-fbchat",
+        'url': f"http://127.0.0.1:{args.port}",
+        'hs_token': secrets.token_hex(),  # Does this follow the same spec as Matrix expects?
+        'as_token': secrets.token_hex(),  # Perhaps it could be more random?
+        'sender_localpart': "fbchat_bot",
+        'rate_limited': True,
+        'protocols': ["fbchat"],
+
+        # I would like to avoid having multiple config files sharing some of the same secret tokens.
+        # So instead of copying the as/hs token values into another config file along with the Facebook auth tokens,
+        # I'm just going include the Facebook auth tokens in with the Synapse config and rely on Synapse ignoring it.
+        #
+        # FIXME: Can I store this info in Matrix somehow?
+        'accounts': [account],
+
+        'matrix_domain': args.domain,
+        'matrix_baseurl': args.baseurl,
+    }
+
+# Each account gets its own namespace so the puppets & rooms of one account never collide with another's.
+# The namespaces are rebuilt from the list of accounts every time so adding/refreshing an account keeps them in sync.
+registration_data['namespaces'] = {
+    'users': (
+        [{'exclusive': True, 'regex': f"@fbchat_{a['fbchat_uid']}_.*"} for a in registration_data['accounts']] +
+        # FIXME: Is this incredibly evil?
+        [{'exclusive': False, 'regex': f"@{a['matrix_user_localpart']}:{registration_data['matrix_domain']}"}
+         for a in registration_data['accounts']]
+    ),
+    'aliases': [{'exclusive': True, 'regex': f"#fbchat_{a['fbchat_uid']}_.*"} for a in registration_data['accounts']],
+    'rooms': []  # FIXME: Can I get away with just removing this?
+}
+
+yaml_filename = args.yaml_filename if args.yaml_filename else "fbchat_appservice.yaml"
 with open(yaml_filename, 'w') as f:
     yaml.dump(registration_data, f)
     output_filename = f.name
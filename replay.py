@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import fbchat
+
+import benchmark
+import capture
+import fakes
+import metrics
+
+
+def as_mqtt(topic, content):
+    """
+    (topic, payload) the way fbchat's MQTT listener would hand it over.
+    Captures from before fbchat 1.9 are pull API payloads, their deltas are all that's kept.
+    """
+    if topic is not None:
+        return topic, content
+    return '/t_ms', {'deltas': [m['delta'] for m in content.get('ms', []) if m.get('type') == 'delta' and 'delta' in m]}
+
+
+def scan_threads(payloads):
+    """Work out which threads in a capture are 1:1 chats and which are groups (and who's in them)"""
+    users = set()
+    groups = {}
+    for uid, t, topic, content in payloads:
+        topic, content = as_mqtt(topic, content)
+        if topic != '/t_ms':
+            continue
+        for delta in content.get('deltas', []):
+            metadata = delta.get('messageMetadata', {})
+            thread_key = metadata.get('threadKey', {})
+            if 'threadFbId' in thread_key:
+                participants = groups.setdefault(str(thread_key['threadFbId']), set())
+                if metadata.get('actorFbId'):
+                    participants.add(str(metadata['actorFbId']))
+            elif 'otherUserFbId' in thread_key:
+                users.add(str(thread_key['otherUserFbId']))
+    return users, groups
+
+
+def restamp(content, now_ms: int):
+    """Make the replayed messages look like they were sent just now, so the latency numbers mean something"""
+    for delta in content.get('deltas', []):
+        metadata = delta.get('messageMetadata')
+        if metadata and 'timestamp' in metadata:
+            metadata['timestamp'] = str(now_ms)
+    return content
+
+
+class ReplayFacebookClient(fakes.FakeFacebookClient):
+    """
+    Feeds captured payloads through fbchat's own parser, exactly as if they'd just come in over MQTT.
+    One payload per doOneListen(), like the real listener, either at the captured pace (times speed) or as fast as possible.
+    """
+    def __init__(self, *args, payloads, speed: float, finished: threading.Event, **kwargs):
+        self.payloads = payloads
+        self.speed = speed
+        self.finished = finished
+        self.users, self.groups = scan_threads(payloads)
+        self._position = 0
+        self._started = None
+        super().__init__(*args, scenario=fakes.Scenario(), **kwargs)
+
+    def fetchThreadInfo(self, *thread_ids):
+        threads = {}
+        for thread_id in thread_ids:
+            if thread_id in self.groups:
+                threads[thread_id] = fbchat.Group(thread_id, name=f"Group {thread_id}",
+                                                  participants=self.groups[thread_id] | {self.uid})
+            else:
+                threads[thread_id] = fbchat.User(thread_id, name=f"Contact {thread_id}", is_friend=True)
+        return threads
+
+    def doOneListen(self):
+        if self._position >= len(self.payloads):
+            self.listening = False
+            self.finished.set()
+            return
+
+        uid, captured_at, topic, content = self.payloads[self._position]
+        self._position += 1
+
+        if self._started is None:
+            self._started = (time.monotonic(), captured_at)
+        elif self.speed:
+            started_at, first_captured_at = self._started
+            delay = started_at + (captured_at - first_captured_at) / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        topic, content = as_mqtt(topic, content)
+        self._parse_message(topic, restamp(content, int(time.time() * 1000)))
+
+
+async def run(filename: str, speed: float, port: int, timeout: float, verbose: int):
+    payloads = list(capture.read(filename))
+    if not payloads:
+        raise Exception(f"No payloads in {filename}")
+    uid = payloads[0][0]
+
+    config = benchmark.bridge_config(accounts=1, port=port)
+    config['accounts'][0].update({'fbchat_uid': uid, 'fbchat_session': {'c_user': uid}})
+
+    finished = threading.Event()
+    homeserver, bridge_task = await benchmark.start(
+        config,
+        client_class=functools.partial(ReplayFacebookClient, payloads=payloads, speed=speed, finished=finished),
+        verbose=verbose)
+    started = time.monotonic()
+    completed = await asyncio.get_event_loop().run_in_executor(None, finished.wait, timeout)
+    duration = time.monotonic() - started
+    await benchmark.stop(homeserver, bridge_task)
+
+    bridged = [r for r in homeserver.received if r[2].startswith('@fbchat_')]
+    results = {
+        'completed': completed,
+        'payloads': len(payloads),
+        'duration_s': duration,
+        'payloads_per_s': len(payloads) / duration,
+        'messages_bridged': len(bridged),
+        'homeserver_requests': homeserver.requests,
+    }
+    # Where the time went, averaged per stage
+    for (stage,), mean in metrics.stage_latency.means().items():
+        results[f"stage_mean_s.{stage}"] = mean
+    return results
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Replay captured Facebook listener payloads through the bridge, against a fake homeserver")
+    argparser.add_argument('capture_file', help="File written by the bridge with fbchat_capture_dir set")
+    argparser.add_argument('-s', '--speed', type=float, default=1,
+                           help="Replay speed multiplier, 1 for the captured pace, 0 for as fast as possible")
+    argparser.add_argument('--port', type=int, default=29330, help="Appservice port, the homeserver uses the next one")
+    argparser.add_argument('--timeout', type=float, default=None, help="Give up after this many seconds")
+    argparser.add_argument('-v', '--verbose', default=0, action='count', help="Print debug output")
+    args = argparser.parse_args()
+
+    capture_file = os.path.abspath(args.capture_file)
+    # The bridge writes its state & profile files into the working directory, keep them out of the way
+    os.chdir(tempfile.mkdtemp(prefix='fbchat-replay-'))
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+
+    results = asyncio.run(run(capture_file, speed=args.speed, port=args.port, timeout=args.timeout,
+                              verbose=args.verbose))
+    for key, value in results.items():
+        print(f"{key:>32}: {value:.4f}" if isinstance(value, float) else f"{key:>32}: {value}")
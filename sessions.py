@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+
+
+class SessionStore(object):
+    """
+    Keep each account's latest Facebook session cookies on disk, so a restart can reuse a warm session
+    instead of doing a full (slow, and often 2FA-prompting) login with the cookies register.py saved ages ago.
+
+    Files are only readable by the bridge's user, and are written to a temporary file then renamed into place,
+    so a crash mid-write leaves the previous cookies intact rather than a half written file.
+
+    Each file remembers which register.py cookies it grew out of,
+    so once register.py has been run again its fresh cookies take over from the saved ones.
+    """
+    def __init__(self, directory: str = '.'):
+        self.directory = directory
+        self._last_saved = {}
+        self._config_sessions = {}
+
+    def _filename(self, fbchat_uid):
+        return os.path.join(self.directory, f"fb-session_{fbchat_uid}.json")
+
+    @staticmethod
+    def _fingerprint(session):
+        return hashlib.sha256(json.dumps(session, sort_keys=True).encode()).hexdigest() if session else None
+
+    def load(self, fbchat_uid, config_session=None):
+        """
+        The saved cookies for an account, or None if there aren't any worth trying.
+        config_session is the account's cookies from the config file, if they've changed since the saved ones
+        were first saved then register.py has been run again, and the saved ones are thrown away.
+        """
+        self._config_sessions[fbchat_uid] = self._fingerprint(config_session)
+        try:
+            with open(self._filename(fbchat_uid), 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if 'cookies' in saved and 'config_session' in saved:
+            if config_session and saved['config_session'] != self._config_sessions[fbchat_uid]:
+                self.delete(fbchat_uid)
+                return None
+            session = saved['cookies']
+        else:
+            # Saved before the config cookies were being kept track of, nothing to compare against
+            session = saved
+        self._last_saved[fbchat_uid] = session
+        return session
+
+    def delete(self, fbchat_uid):
+        """Forget the saved cookies, e.g. because Facebook rejected them"""
+        self._last_saved.pop(fbchat_uid, None)
+        try:
+            os.unlink(self._filename(fbchat_uid))
+        except FileNotFoundError:
+            pass
+
+    def save(self, fbchat_uid, session):
+        """Returns whether anything was actually written"""
+        if not session or session == self._last_saved.get(fbchat_uid):
+            return False
+
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # mkstemp creates the file as 0600, so the cookies are never readable by anyone else, even briefly
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, prefix=f".fb-session_{fbchat_uid}.")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'cookies': session, 'config_session': self._config_sessions.get(fbchat_uid)}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self._filename(fbchat_uid))
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+        self._last_saved[fbchat_uid] = session
+        return True
+
+    def save_client(self, client):
+        return self.save(client.uid, client.getSession())
+
+    async def autosave(self, client, interval: float):
+        """Save the client's session every interval seconds, for as long as it's running"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.save_client(client):
+                    client.log.debug("Saved refreshed Facebook session cookies")
+            except Exception:
+                client.log.exception("Failed to save Facebook session cookies")
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import functools
+import gc
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import benchmark
+import fakes
+import memory
+
+
+def sample(homeserver, baseline_snapshot, top: int):
+    snapshot = memory.take_snapshot()
+    return {
+        'time': time.monotonic(),
+        'rss': benchmark.rss_bytes(),
+        'traced': tracemalloc.get_traced_memory()[0],
+        'messages': homeserver.bench_received,
+        'objects': memory.count_bridge_objects(),
+        'top': snapshot.compare_to(baseline_snapshot, 'lineno')[:top] if baseline_snapshot else [],
+        'snapshot': snapshot,
+    }
+
+
+def report(s, baseline):
+    mb = 1024 * 1024
+    print(f"[{s['time'] - baseline['time']:8.0f}s] {s['messages']} messages, "
+          f"RSS {s['rss'] / mb:.1f}MB ({(s['rss'] - baseline['rss']) / mb:+.1f}MB), "
+          f"traced {s['traced'] / mb:.1f}MB, "
+          f"Person {s['objects']['Person']}, Room {s['objects']['Room']}")
+    for stat in s['top']:
+        print(f"    {stat}")
+
+
+async def run(scenario, accounts: int, port: int, duration: float, warmup: float, sample_interval: float,
+              max_growth: float, top: int, verbose: int):
+    tracemalloc.start(10)
+    homeserver, bridge_task = await benchmark.start(
+        benchmark.bridge_config(accounts, port),
+        client_class=functools.partial(fakes.FakeFacebookClient, scenario=scenario),
+        verbose=verbose)
+
+    # Let the caches, connection pools, etc fill up before deciding what "normal" memory use is
+    await asyncio.sleep(warmup)
+    gc.collect()
+    baseline = sample(homeserver, None, top)
+    report(baseline, baseline)
+
+    failed = False
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(sample_interval, max(0, deadline - time.monotonic())))
+        if bridge_task.done():
+            bridge_task.result()  # Raise whatever killed it
+        gc.collect()
+        s = sample(homeserver, baseline['snapshot'], top)
+        report(s, baseline)
+        if s['rss'] - baseline['rss'] > max_growth * 1024 * 1024:
+            print(f"FAIL: RSS grew more than {max_growth}MB since warmup")
+            failed = True
+            break
+
+    await benchmark.stop(homeserver, bridge_task)
+    tracemalloc.stop()
+    return not failed
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Drive the bridge with endless synthetic traffic and fail if its memory use keeps growing")
+    argparser.add_argument('-a', '--accounts', type=int, default=1, help="Number of Facebook accounts")
+    argparser.add_argument('-t', '--threads', type=int, default=50, help="Facebook threads per account")
+    argparser.add_argument('-b', '--burst', type=int, default=10, help="Messages per doOneListen() call")
+    argparser.add_argument('-i', '--interval', type=float, default=0,
+                           help="Seconds between each burst, 0 to squeeze as much traffic as possible into the run")
+    argparser.add_argument('--new-contacts', type=float, default=0.01,
+                           help="Chance of each message coming from a contact the bridge hasn't seen before")
+    argparser.add_argument('--typing', type=float, default=0.5, help="Chance of a typing event with each message")
+    argparser.add_argument('--presence', type=float, default=0.5, help="Chance of a presence event with each message")
+    argparser.add_argument('-d', '--duration', type=float, default=3600, help="Seconds to run for after warmup")
+    argparser.add_argument('-w', '--warmup', type=float, default=60, help="Seconds to run before the baseline sample")
+    argparser.add_argument('-s', '--sample-interval', type=float, default=60, help="Seconds between samples")
+    argparser.add_argument('-g', '--max-growth', type=float, default=50,
+                           help="Fail if RSS grows by more than this many MB after warmup")
+    argparser.add_argument('--top', type=int, default=10, help="Number of top growing allocation sites to show")
+    argparser.add_argument('--port', type=int, default=29330, help="Appservice port, the homeserver uses the next one")
+    argparser.add_argument('-v', '--verbose', default=0, action='count', help="Print debug output")
+    args = argparser.parse_args()
+
+    # The bridge writes its state & profile files into the working directory, keep them out of the way
+    os.chdir(tempfile.mkdtemp(prefix='fbchat-soak-'))
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+
+    passed = asyncio.run(run(
+        fakes.Scenario(threads=args.threads, messages=None, burst=args.burst, interval=args.interval,
+                       typing_ratio=args.typing, presence_ratio=args.presence, new_contact_ratio=args.new_contacts),
+        accounts=args.accounts, port=args.port, duration=args.duration, warmup=args.warmup,
+        sample_interval=args.sample_interval, max_growth=args.max_growth, top=args.top, verbose=args.verbose))
+    sys.exit(0 if passed else 1)
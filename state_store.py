@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+import asyncio
+import collections
+import json
+import sqlite3
+import threading
+
+import mautrix.types
+from mautrix.appservice.state_store import StateStore
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Appservice state store that only writes what changed, instead of repickling everything like PickleStateStore does.
+
+    Writes are queued up and committed in a single transaction every flush_interval seconds (or batch_size writes),
+    and rows are only read from the database the first time they're needed.
+    Only the cache_size most recently used users, rooms' members & rooms' power levels are kept in memory.
+    SQLite's WAL mode means a crash mid-write loses at most the last uncommitted batch, never the whole file.
+    """
+    def __init__(self, db_file: str = 'mx-state.db', flush_interval: float = 1, batch_size: int = 500,
+                 cache_size: int = 10000):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        # The state store is mostly used from the event loop, but mx_coro() can end up here from the listener thread
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS registrations (user_id TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS members ('
+                        'room_id TEXT, user_id TEXT, member TEXT, PRIMARY KEY (room_id, user_id))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS power_levels (room_id TEXT PRIMARY KEY, content TEXT)')
+
+        # Anything read from or waiting to be written to the database, least recently used first
+        self._registrations = collections.OrderedDict()
+        self._members = collections.OrderedDict()  # room_id -> {user_id: Member}
+        self._power_levels = collections.OrderedDict()
+
+        self._pending = {'registrations': set(), 'members': set(), 'power_levels': set()}
+        self._flush_handle = None
+
+    ## Write batching
+    def _changed(self, table: str, key):
+        with self._lock:
+            self._pending[table].add(key)
+            if sum(len(p) for p in self._pending.values()) >= self.batch_size:
+                self.flush()
+            elif not self._flush_handle:
+                try:
+                    loop = asyncio.get_event_loop()
+                except RuntimeError:
+                    # No loop in this thread, the next write (or flush on shutdown) will catch it
+                    return
+                self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Commit all queued writes in one transaction"""
+        with self._lock:
+            if self._flush_handle:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            if not any(self._pending.values()):
+                return
+
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany('INSERT OR IGNORE INTO registrations (user_id) VALUES (?)',
+                                    ((user_id,) for user_id in self._pending['registrations']))
+                self.db.executemany('INSERT OR REPLACE INTO members (room_id, user_id, member) VALUES (?, ?, ?)',
+                                    ((room_id, user_id, json.dumps(self._members[room_id][user_id].serialize()))
+                                     for room_id, user_id in self._pending['members']))
+                self.db.executemany('INSERT OR REPLACE INTO power_levels (room_id, content) VALUES (?, ?)',
+                                    ((room_id, json.dumps(self._power_levels[room_id].serialize()))
+                                     for room_id in self._pending['power_levels']))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+            for pending in self._pending.values():
+                pending.clear()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def summary(self):
+        """How much is held in memory, for the 'memory' command"""
+        with self._lock:
+            return {
+                'registrations': len(self._registrations),
+                'members': sum(len(room) for room in self._members.values()),
+                'power_levels': len(self._power_levels),
+                'pending_writes': sum(len(p) for p in self._pending.values()),
+            }
+
+    ## Lazy loading
+    def _used(self, cache, key):
+        cache.move_to_end(key)
+        if len(cache) > self.cache_size:
+            # Queued writes are read back out of the caches, so they have to go first.
+            # Trimming a bit further than needed means that doesn't happen on every single new row.
+            self.flush()
+            while len(cache) > self.cache_size * 0.9:
+                cache.popitem(last=False)
+
+    def _load_member(self, room_id, user_id):
+        room = self._members.setdefault(room_id, {})
+        self._used(self._members, room_id)
+        if user_id not in room:
+            row = self.db.execute('SELECT member FROM members WHERE room_id=? AND user_id=?',
+                                  (room_id, user_id)).fetchone()
+            room[user_id] = (mautrix.types.Member.deserialize(json.loads(row[0])) if row
+                             else mautrix.types.Member(membership=mautrix.types.Membership.LEAVE))
+        return room[user_id]
+
+    def _load_power_levels(self, room_id):
+        if room_id not in self._power_levels:
+            row = self.db.execute('SELECT content FROM power_levels WHERE room_id=?', (room_id,)).fetchone()
+            self._power_levels[room_id] = (
+                mautrix.types.PowerLevelStateEventContent.deserialize(json.loads(row[0])) if row else None)
+        self._used(self._power_levels, room_id)
+        return self._power_levels[room_id]
+
+    ## StateStore API
+    def is_registered(self, user_id):
+        with self._lock:
+            if user_id not in self._registrations:
+                self._registrations[user_id] = self.db.execute(
+                    'SELECT 1 FROM registrations WHERE user_id=?', (user_id,)).fetchone() is not None
+            self._used(self._registrations, user_id)
+            return self._registrations[user_id]
+
+    def registered(self, user_id):
+        with self._lock:
+            if self._registrations.get(user_id):
+                return
+            self._registrations[user_id] = True
+            self._used(self._registrations, user_id)
+            self._changed('registrations', user_id)
+
+    def get_member(self, room_id, user_id):
+        with self._lock:
+            return self._load_member(room_id, user_id)
+
+    def set_member(self, room_id, user_id, member):
+        with self._lock:
+            if self._members.get(room_id, {}).get(user_id) == member:
+                return  # Nothing changed, don't bother writing it
+            self._members.setdefault(room_id, {})[user_id] = member
+            self._used(self._members, room_id)
+            self._changed('members', (room_id, user_id))
+
+    def set_membership(self, room_id, user_id, membership):
+        with self._lock:
+            member = self._load_member(room_id, user_id)
+            if member.membership == membership:
+                return
+            member.membership = membership
+            self._changed('members', (room_id, user_id))
+
+    def has_power_levels(self, room_id):
+        with self._lock:
+            return self._load_power_levels(room_id) is not None
+
+    def get_power_levels(self, room_id):
+        with self._lock:
+            return self._load_power_levels(room_id)
+
+    def set_power_level(self, room_id, user_id, level):
+        with self._lock:
+            power_levels = self._load_power_levels(room_id)
+            if not power_levels:
+                # Same as mautrix's own stores, start from nothing if the rest of them aren't known yet
+                power_levels = self._power_levels[room_id] = mautrix.types.PowerLevelStateEventContent()
+            elif power_levels.get_user_level(user_id) == level:
+                return
+            if power_levels.get_user_level(user_id) != level:
+                # mautrix's set_user_level() fails on setting the default level for someone who isn't listed
+                power_levels.set_user_level(user_id, level)
+            self._changed('power_levels', room_id)
+
+    def set_power_levels(self, room_id, content):
+        with self._lock:
+            self._power_levels[room_id] = content
+            self._used(self._power_levels, room_id)
+            self._changed('power_levels', room_id)
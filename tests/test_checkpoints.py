@@ -0,0 +1,66 @@
+import os
+import threading
+
+import checkpoints
+
+
+def test_advance_and_reload(tmp_path):
+    filename = str(tmp_path / 'checkpoints.json')
+    c = checkpoints.Checkpoints(filename)
+    assert c.last_seen is None
+    c.advance('thread1', 100, 'mid.1')
+    c.advance('thread1', 90, 'mid.0')  # Older timestamps don't move the high water mark back
+    c.advance('thread2', 200, 'mid.2')
+    c.save()
+
+    c = checkpoints.Checkpoints(filename)
+    assert c.since('thread1') == 100
+    assert c.since('thread3') is None
+    assert c.last_seen == 200
+    assert c.seen('thread1', 'mid.0')
+    assert not c.seen('thread2', 'mid.1')
+
+
+def test_only_remembers_recent_mids(tmp_path):
+    c = checkpoints.Checkpoints(str(tmp_path / 'checkpoints.json'), remember=3)
+    for i in range(5):
+        c.advance('thread', i, f"mid.{i}")
+    assert not c.seen('thread', 'mid.1')
+    assert c.seen('thread', 'mid.2')
+    assert c.seen('thread', 'mid.4')
+
+
+def test_unforced_saves_are_rate_limited(tmp_path):
+    filename = str(tmp_path / 'checkpoints.json')
+    c = checkpoints.Checkpoints(filename, save_interval=3600)
+    c.advance('thread', 1, 'mid.1')
+    c.save()
+    c.advance('thread', 2, 'mid.2')  # Too soon after the last save to save again
+    assert checkpoints.Checkpoints(filename).since('thread') == 1
+    c.save()
+    assert checkpoints.Checkpoints(filename).since('thread') == 2
+
+
+def test_concurrent_saves(tmp_path):
+    filename = str(tmp_path / 'checkpoints.json')
+    c = checkpoints.Checkpoints(filename, save_interval=0)
+
+    def advance(thread_id):
+        for i in range(200):
+            c.advance(thread_id, i + 1, f"{thread_id}.{i}")
+    threads = [threading.Thread(target=advance, args=(str(n),)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    c.save()
+
+    reloaded = checkpoints.Checkpoints(filename)
+    assert all(reloaded.since(str(n)) == 200 for n in range(8))
+    assert os.listdir(str(tmp_path)) == ['checkpoints.json']  # No temporary files left lying around
+
+
+def test_corrupt_file_is_ignored(tmp_path):
+    filename = tmp_path / 'checkpoints.json'
+    filename.write_text('{"high_water": {"thr')
+    assert checkpoints.Checkpoints(str(filename)).last_seen is None
@@ -0,0 +1,115 @@
+import asyncio
+import types
+
+import pytest
+
+import checkpoints
+import commands
+import executors
+
+
+async def _example(handler, fbid: str, count: int = 50):
+    pass
+
+
+async def _varargs(handler, *words):
+    pass
+
+
+def test_convert_uses_annotations():
+    assert commands._convert(_example, ['123']) == ['123']
+    assert commands._convert(_example, ['123', '7']) == ['123', 7]
+
+
+def test_convert_rejects_bad_values():
+    with pytest.raises(commands.CommandError, match="count must be an int"):
+        commands._convert(_example, ['123', 'lots'])
+
+
+def test_convert_rejects_wrong_number_of_arguments():
+    with pytest.raises(commands.CommandError, match="Wrong number"):
+        commands._convert(_example, [])
+    with pytest.raises(commands.CommandError, match="Wrong number"):
+        commands._convert(_example, ['1', '2', '3'])
+
+
+def test_convert_varargs():
+    assert commands._convert(_varargs, ['a', 'b']) == ['a', 'b']
+
+
+def test_usage():
+    assert commands._usage(('backfill',), _example) == "backfill <fbid> [count]"
+    assert commands._usage(('echo',), _varargs) == "echo [words...]"
+
+
+class _Bot(object):
+    domain = 'example.com'
+
+
+@pytest.fixture
+def handler():
+    return commands.command_handler(matrix_bot=_Bot(), matrix_user_localpart='user', protocol_roomid='!protocol')
+
+
+def test_find_longest_match(handler):
+    func, args = handler.find("cache flush people")
+    assert func is commands._cache_flush
+    assert args == ['people']
+
+    func, args = handler.find("cache info")
+    assert func is commands._cache_info
+    assert args == []
+
+
+def test_find_quoted_arguments(handler):
+    func, args = handler.find("echo 'hello world' again")
+    assert args == ['hello world', 'again']
+
+
+def test_find_partial_command_lists_usage(handler):
+    with pytest.raises(commands.CommandError, match=r"Usage: .*cache info.*cache flush"):
+        handler.find("cache")
+
+
+def test_find_unknown_command(handler):
+    with pytest.raises(commands.CommandError, match="Unknown command"):
+        handler.find("frobnicate")
+
+
+def test_find_bad_arguments_include_usage(handler):
+    with pytest.raises(commands.CommandError, match=r"usage: backfill <fbid> \[count\]"):
+        handler.find("backfill 123 lots")
+
+
+def test_find_unbalanced_quotes(handler):
+    with pytest.raises(commands.CommandError, match="Couldn't parse"):
+        handler.find("echo 'oops")
+
+
+class _BackfillClient(object):
+    def __init__(self, checkpoints, messages):
+        self.checkpoints = checkpoints
+        self.messages = messages
+        self.message_queues = executors.SerialQueues(executors.InstrumentedExecutor(1, 'test'))
+        self.bridged = []
+
+    def fetchThreadMessages(self, thread_id, limit):
+        return self.messages[-limit:][::-1]
+
+    def _bridge_message(self, mid, thread_id, message_object, ts):
+        self.bridged.append(mid)
+        self.checkpoints.advance(thread_id, ts, mid)
+
+
+def test_backfill_skips_everything_already_bridged(tmp_path):
+    messages = [types.SimpleNamespace(uid=f"mid.{n}", timestamp=str(1000 + n)) for n in range(200)]
+    c = checkpoints.Checkpoints(str(tmp_path / 'checkpoints.json'))
+    # More than the checkpoints remember the IDs of
+    for message in messages[:150]:
+        c.advance('100', message.timestamp, message.uid)
+    client = _BackfillClient(c, messages)
+    handler = types.SimpleNamespace(client=client)
+
+    reply = asyncio.run(commands._backfill(handler, '100', count=200))
+    assert client.bridged == [f"mid.{n}" for n in range(150, 200)]
+    assert reply == "Fetched 200 message(s) from 100, bridged 50 that hadn't been already"
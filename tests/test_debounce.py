@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+import debounce
+
+
+def test_only_latest_update_per_key_is_applied():
+    applied = []
+
+    async def update(key, value):
+        applied.append((key, value))
+
+    async def run():
+        d = debounce.Debouncer(asyncio.get_running_loop(), window=0.05)
+        for value in range(5):
+            d.submit('name', update, 'name', value)
+        d.submit('avatar', update, 'avatar', 'x')
+        await asyncio.sleep(0.1)
+        await d.flush()
+    asyncio.run(run())
+    assert sorted(applied) == [('avatar', 'x'), ('name', 4)]
+
+
+def test_flush_applies_everything_straight_away():
+    applied = []
+
+    async def update(value):
+        applied.append(value)
+
+    async def run():
+        d = debounce.Debouncer(asyncio.get_running_loop(), window=60)
+        d.submit('name', update, 1)
+        await asyncio.sleep(0)
+        await d.flush()
+        assert applied == [1]
+        assert not d._timers
+    asyncio.run(run())
+
+
+def test_flush_catches_submits_from_other_threads_not_scheduled_yet():
+    applied = []
+
+    async def update(value):
+        applied.append(value)
+
+    async def run():
+        d = debounce.Debouncer(asyncio.get_running_loop(), window=60)
+        # Straight into flush(), without giving the loop a chance to run the call_soon_threadsafe callbacks first
+        thread = threading.Thread(target=lambda: [d.submit(key, update, key) for key in ('a', 'b')])
+        thread.start()
+        thread.join()
+        await d.flush()
+        assert sorted(applied) == ['a', 'b']
+        # The late _schedule callbacks mustn't resurrect anything
+        await asyncio.sleep(0)
+        assert not d._timers
+    asyncio.run(run())
+
+
+def test_failed_update_doesnt_stop_the_others():
+    applied = []
+
+    async def update(value):
+        if value == 'bad':
+            raise RuntimeError("boom")
+        applied.append(value)
+
+    async def run():
+        d = debounce.Debouncer(asyncio.get_running_loop(), window=60)
+        d.submit('a', update, 'bad')
+        d.submit('b', update, 'good')
+        await asyncio.sleep(0)
+        await d.flush()
+    asyncio.run(run())
+    assert applied == ['good']
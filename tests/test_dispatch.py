@@ -0,0 +1,157 @@
+import asyncio
+import types
+
+import mautrix.types
+
+import dispatch
+
+
+def _event(room_id, sender='@user:example.com', event_type='m.room.message', n=0):
+    return types.SimpleNamespace(type=event_type, room_id=room_id, sender=sender, n=n)
+
+
+def test_handlers_for_filters_by_type_room_and_sender():
+    d = dispatch.Dispatcher()
+
+    async def a(ev):
+        pass
+
+    async def b(ev):
+        pass
+
+    async def c(ev):
+        pass
+    d.add(a, event_types=('m.room.message',), senders='@user:example.com')
+    d.add(b, event_types=('m.room.member',))
+    d.add(c, rooms=lambda room_id: room_id.startswith('!c'))
+
+    assert d.handlers_for('m.room.message', '!x', '@user:example.com') == [a]
+    assert d.handlers_for('m.room.message', '!x', '@other:example.com') == []
+    assert d.handlers_for('m.room.member', '!x', '@other:example.com') == [b]
+    assert d.handlers_for('m.room.message', '!c1', '@user:example.com') == [a, c]
+
+
+def test_wants_raw_always_lets_state_store_events_through():
+    d = dispatch.Dispatcher()
+    assert d.wants_raw({'type': 'm.room.member', 'room_id': '!x', 'sender': '@a'})
+    assert not d.wants_raw({'type': 'm.room.message', 'room_id': '!x', 'sender': '@a'})
+
+
+def test_events_in_a_room_are_handled_in_order():
+    handled = []
+
+    async def handler(ev):
+        # Later events finish quicker, so they'd overtake if the room wasn't handled in order
+        await asyncio.sleep((10 - ev.n) / 1000)
+        handled.append((ev.room_id, ev.n))
+
+    async def run():
+        d = dispatch.Dispatcher()
+        d.add(handler)
+        for n in range(10):
+            for room_id in ('!a', '!b'):
+                await d.dispatch(_event(room_id, n=n))
+        await d.drain()
+    asyncio.run(run())
+
+    for room_id in ('!a', '!b'):
+        assert [n for r, n in handled if r == room_id] == list(range(10))
+
+
+def test_rooms_are_handled_concurrently_up_to_the_limit():
+    running = 0
+    most_running = 0
+
+    async def handler(ev):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        d = dispatch.Dispatcher(max_concurrent=3)
+        d.add(handler)
+        for i in range(10):
+            await d.dispatch(_event(f"!{i}"))
+        await d.drain()
+    asyncio.run(run())
+    assert most_running == 3
+
+
+def test_waiting_for_ready_does_not_use_up_slots():
+    handled = []
+
+    async def slow_account(ev):
+        handled.append(ev.room_id)
+
+    async def other_account(ev):
+        handled.append(ev.room_id)
+
+    async def run():
+        logged_in = asyncio.get_running_loop().create_future()
+        d = dispatch.Dispatcher(max_concurrent=1)
+        d.add(slow_account, rooms=lambda room_id: room_id.startswith('!slow'), ready=logged_in)
+        d.add(other_account, rooms={'!other'})
+        for i in range(3):
+            await d.dispatch(_event(f"!slow{i}"))
+        await d.dispatch(_event('!other'))
+        await asyncio.sleep(0.01)
+        assert handled == ['!other']
+        assert d.queued == 3
+
+        logged_in.set_result(None)
+        await d.drain()
+    asyncio.run(run())
+    assert sorted(handled) == ['!other', '!slow0', '!slow1', '!slow2']
+
+
+def test_handler_errors_dont_stop_the_room():
+    handled = []
+
+    async def handler(ev):
+        if ev.n == 0:
+            raise RuntimeError("boom")
+        handled.append(ev.n)
+
+    async def run():
+        d = dispatch.Dispatcher()
+        d.add(handler)
+        for n in range(3):
+            await d.dispatch(_event('!a', n=n))
+        await d.drain()
+    asyncio.run(run())
+    assert handled == [1, 2]
+
+
+class _AppService(object):
+    def __init__(self):
+        self.handled = []
+
+    def handle_matrix_event(self, event):
+        self.handled.append(event)
+
+
+def test_filter_transactions_drops_unwanted_events_before_mautrix_fans_them_out():
+    d = dispatch.Dispatcher()
+
+    async def handler(ev):
+        pass
+    d.add(handler, event_types=('m.room.message',), rooms='!wanted:example.com')
+    appservice = _AppService()
+    d.filter_transactions(appservice)
+
+    def raw(event_type, room_id, **extra):
+        return {'type': event_type, 'room_id': room_id, 'sender': '@a:example.com', 'event_id': '$1',
+                'origin_server_ts': 0, 'content': {'body': "hi", 'msgtype': 'm.text'}, **extra}
+    wanted = raw('m.room.message', '!wanted:example.com')
+    member = raw('m.room.member', '!other:example.com', state_key='@a:example.com',
+                 content={'membership': 'join'})
+    # Older mautrix hands over the raw JSON, newer ones parse it first
+    for event in (wanted, raw('m.room.message', '!other:example.com'), member):
+        appservice.handle_matrix_event(event)
+        appservice.handle_matrix_event(mautrix.types.Event.deserialize(event))
+
+    assert appservice.handled[0::2] == [wanted, member]
+    assert [(str(e.type), e.room_id) for e in appservice.handled[1::2]] == [
+        ('m.room.message', '!wanted:example.com'), ('m.room.member', '!other:example.com')]
@@ -0,0 +1,91 @@
+import random
+import threading
+import time
+
+import pytest
+
+import executors
+
+
+@pytest.fixture
+def executor():
+    executor = executors.InstrumentedExecutor(max_workers=4, thread_name_prefix='test')
+    yield executor
+    executor.shutdown()
+
+
+def test_serial_queues_keep_order_per_key(executor):
+    queues = executors.SerialQueues(executor)
+    results = {key: [] for key in range(5)}
+
+    def job(key, i):
+        time.sleep(random.random() / 1000)
+        results[key].append(i)
+    futures = [queues.submit(key, job, key, i) for i in range(50) for key in results]
+    for future in futures:
+        future.result()
+    assert all(r == list(range(50)) for r in results.values())
+    assert queues.queued == 0
+
+
+def test_serial_queues_run_keys_concurrently(executor):
+    queues = executors.SerialQueues(executor)
+    started = threading.Barrier(2, timeout=5)
+    # Would deadlock if the second key had to wait for the first
+    futures = [queues.submit(key, started.wait) for key in ('a', 'b')]
+    for future in futures:
+        future.result()
+
+
+def test_serial_queues_pass_back_results_and_errors(executor):
+    queues = executors.SerialQueues(executor)
+    assert queues.submit('a', lambda: 42).result() == 42
+    with pytest.raises(ZeroDivisionError):
+        queues.submit('a', lambda: 1 / 0).result()
+    # A failed job doesn't stop the rest of the key's queue
+    assert queues.submit('a', lambda: 'still going').result() == 'still going'
+
+
+def test_serial_queues_block_when_full(executor):
+    queues = executors.SerialQueues(executor, max_queued=2)
+    release = threading.Event()
+    queues.submit('a', release.wait)
+    queues.submit('a', lambda: None)
+
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (queues.submit('b', lambda: None), submitted.set()))
+    thread.start()
+    assert not submitted.wait(0.05)
+    # Unless told not to wait
+    queues.submit('c', lambda: None, wait=False).cancel()
+
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+
+
+def test_executor_stats(executor):
+    executor.submit(time.sleep, 0.01).result()
+    assert executor.stats['completed'] == 1
+    assert executor.stats['run_total'] > 0
+    assert executor.queued == 0
+
+
+def test_cancelled_jobs_dont_count_as_queued():
+    executor = executors.InstrumentedExecutor(max_workers=1, thread_name_prefix='test')
+    started, release = threading.Event(), threading.Event()
+    running = executor.submit(lambda: (started.set(), release.wait()))
+    started.wait()
+    waiting = [executor.submit(time.sleep, 0) for _ in range(3)]
+    assert executor.queued == 3
+
+    assert all(future.cancel() for future in waiting[:2])
+    assert executor.queued == 1
+    assert executor.stats['cancelled'] == 2
+
+    release.set()
+    running.result()
+    waiting[2].result()
+    executor.shutdown()
+    assert executor.queued == 0
+    assert executor.stats['completed'] == 2
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+import journal
+
+
+def test_pending_survives_a_restart(tmp_path):
+    filename = str(tmp_path / 'journal.log')
+    j = journal.Journal(filename)
+    j.append('mid.1', thread_id='t', text='one')
+    j.append('mid.2', thread_id='t', text='two')
+    j.done('mid.1')
+    j.close()
+
+    j = journal.Journal(filename)
+    assert [r['id'] for r in j.pending()] == ['mid.2']
+    assert j.pending()[0]['text'] == 'two'
+    j.close()
+
+
+def test_appending_twice_is_a_replay(tmp_path):
+    filename = str(tmp_path / 'journal.log')
+    j = journal.Journal(filename)
+    j.append('mid.1', text='first')
+    j.append('mid.1', text='second')
+    assert [r['text'] for r in j.pending()] == ['first']
+    j.close()
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    filename = tmp_path / 'journal.log'
+    j = journal.Journal(str(filename))
+    j.append('mid.1')
+    j.close()
+    with open(str(filename), 'a') as f:
+        f.write('{"op": "event", "id": "mid.2"')
+
+    j = journal.Journal(str(filename))
+    assert [r['id'] for r in j.pending()] == ['mid.1']
+    j.close()
+
+
+def test_compaction_keeps_only_pending(tmp_path):
+    filename = tmp_path / 'journal.log'
+    j = journal.Journal(str(filename), compact_every=10)
+    for i in range(50):
+        j.append(f"mid.{i}")
+        if i != 25:
+            j.done(f"mid.{i}")
+    assert [r['id'] for r in j.pending()] == ['mid.25']
+    j.close()
+
+    # The file's been rewritten along the way, rather than growing a line per append & done
+    assert len(filename.read_text().splitlines()) < 20
+    j = journal.Journal(str(filename))
+    assert [r['id'] for r in j.pending()] == ['mid.25']
+    j.close()
+
+
+def test_concurrent_appends(tmp_path):
+    filename = str(tmp_path / 'journal.log')
+    j = journal.Journal(filename, compact_every=50)
+
+    def work(n):
+        for i in range(100):
+            j.append(f"{n}.{i}")
+            if i % 2:
+                j.done(f"{n}.{i}")
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    j.close()
+
+    j = journal.Journal(filename)
+    assert len(j.pending()) == 200
+    j.close()
+
+
+def test_close_stops_the_syncer(tmp_path):
+    j = journal.Journal(str(tmp_path / 'journal.log'))
+    j.append('mid.1')
+    j.close()
+    assert not j._syncer.is_alive()
+    with pytest.raises(ValueError):
+        j.append('mid.2')
+    j.done('mid.1')  # Just ignored
+    j.close()
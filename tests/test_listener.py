@@ -0,0 +1,70 @@
+import logging
+import threading
+
+import fbchat_bridge
+
+
+class _Capture(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, topic, content):
+        self.written.append((topic, content))
+
+
+class _Mqtt(object):
+    def __init__(self):
+        self.disconnected_from = None
+
+    def disconnect(self):
+        self.disconnected_from = threading.get_ident()
+
+
+def _client():
+    # Skip __init__, it'd go and log in to Facebook
+    client = object.__new__(fbchat_bridge.Client)
+    client.log = logging.getLogger(__name__)
+    client.capture = _Capture()
+    client._needs_catch_up = False
+    client._listen_thread = threading.get_ident()
+    client.listener_phase = 'poll'
+    client.listener_phase_since = 0
+    return client
+
+
+def test_payloads_from_the_listener_thread_are_parsed():
+    client = _client()
+    client._parse_message('/t_ms', {'deltas': []})
+    assert client.capture.written == [('/t_ms', {'deltas': []})]
+    assert client.listener_phase == 'poll'
+    assert not client._needs_catch_up
+
+
+def test_payloads_from_an_abandoned_listener_thread_are_dropped():
+    client = _client()
+    thread = threading.Thread(target=client._parse_message, args=('/t_ms', {'deltas': []}))
+    thread.start()
+    thread.join()
+    assert client.capture.written == []
+    # Whatever it had will never come over MQTT again, so it has to be fetched
+    assert client._needs_catch_up
+
+
+def test_reset_listener_disconnects_the_stale_connection_on_its_own_thread():
+    client = _client()
+    client._uid = '1'
+    client.listen_executor = fbchat_bridge.executors.InstrumentedExecutor(max_workers=1, thread_name_prefix='test')
+    stale_executor = client.listen_executor
+    stuck = threading.Event()
+    stale_executor.submit(stuck.wait)
+    stale_mqtt = client._mqtt = _Mqtt()
+
+    client.reset_listener()
+    assert client._mqtt is None
+    assert client._listen_thread is None
+    assert stale_mqtt.disconnected_from is None
+
+    stuck.set()
+    stale_executor.shutdown(wait=True)
+    assert stale_mqtt.disconnected_from not in (None, threading.get_ident())
+    client.listen_executor.shutdown()
@@ -0,0 +1,21 @@
+import metrics
+
+
+def test_counter_with_callback_is_exposed_as_a_counter():
+    totals = {('fbchat-request',): 1.5}
+    counter = metrics.Counter('test_executor_wait_seconds_total', "Total wait", ('executor',),
+                              callback=lambda: totals)
+    totals[('fbchat-request',)] = 2.5
+    assert counter.expose().splitlines() == [
+        "# HELP test_executor_wait_seconds_total Total wait",
+        "# TYPE test_executor_wait_seconds_total counter",
+        'test_executor_wait_seconds_total{executor="fbchat-request"} 2.5',
+    ]
+
+
+def test_counter_without_callback():
+    counter = metrics.Counter('test_events_total', "Events", ('handler',))
+    counter.inc(handler='a')
+    counter.inc(2, handler='a')
+    assert counter.get(handler='a') == 3
+    assert counter.expose().splitlines()[-1] == 'test_events_total{handler="a"} 3'
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import socket
+
+import aiohttp
+import mautrix.appservice
+import mautrix.errors
+import pytest
+
+import fakes
+import ratelimit
+import state_store
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_burst_then_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.delay() == 0
+
+
+def test_tokens_dont_build_up_past_burst(clock):
+    bucket = ratelimit.TokenBucket(rate=2, burst=3)
+    clock.now += 60
+    for _ in range(3):
+        bucket.take()
+    assert bucket.delay() > 0
+
+
+def test_slow_down_halves_rate_and_blocks(clock):
+    bucket = ratelimit.TokenBucket(rate=4, burst=10)
+    bucket.slow_down(retry_after=2)
+    assert bucket.rate == 2
+    assert bucket.delay() == pytest.approx(2)
+
+    clock.now += 1.9
+    assert bucket.delay() == pytest.approx(0.1)
+    clock.now += 0.1
+    assert bucket.delay() == 0
+
+
+def test_slow_down_never_goes_below_min_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=1, burst=1, min_rate=0.25)
+    for _ in range(10):
+        bucket.slow_down(retry_after=0)
+    assert bucket.rate == 0.25
+
+
+def test_succeeded_creeps_back_up_to_max_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=10, burst=10)
+    bucket.slow_down(retry_after=0)
+    assert bucket.rate == 5
+    bucket.succeeded()
+    assert bucket.rate == pytest.approx(5.5)
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 10
+
+
+
+class _Intent(object):
+    def __init__(self, mxid):
+        self.mxid = mxid
+
+
+def test_full_idle_buckets_are_forgotten(clock):
+    sender = ratelimit.Sender(evict_interval=60)
+    busy, quiet = _Intent('@busy:example.com'), _Intent('@quiet:example.com')
+
+    async def noop():
+        pass
+    asyncio.run(sender.call(quiet, '!quiet', noop))
+    for _ in range(5):
+        asyncio.run(sender.call(busy, '!busy', noop))
+    assert len(sender) == 4
+
+    # Long enough for them all to fill back up, but the busy ones have been used again since
+    clock.now += 61
+    busy_buckets = (sender._senders['@busy:example.com'], sender._rooms['!busy'])
+    for bucket in busy_buckets:
+        bucket.take()
+    assert sender._buckets('@busy:example.com', '!busy') == busy_buckets
+    assert set(sender._senders) == {'@busy:example.com'}
+    assert set(sender._rooms) == {'!busy'}
+
+
+def test_call_retries_when_rate_limited(clock, monkeypatch):
+    async def no_sleep(delay):
+        clock.now += delay
+    monkeypatch.setattr(ratelimit.asyncio, 'sleep', no_sleep)
+    sender = ratelimit.Sender()
+    attempts = []
+
+    async def invite(room_id, user_id):
+        attempts.append(user_id)
+        if len(attempts) == 1:
+            e = mautrix.errors.MatrixRequestError("Too many requests")
+            e.errcode = 'M_LIMIT_EXCEEDED'
+            raise e
+        return 'invited'
+
+    intent = _Intent('@puppet:example.com')
+    assert asyncio.run(sender.call(intent, '!room', invite, '!room', '@someone:example.com')) == 'invited'
+    assert attempts == ['@someone:example.com'] * 2
+    assert sender._senders['@puppet:example.com'].rate < sender.sender_rate
+
+class _RecordingHomeserver(fakes.FakeHomeserver):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.paths = []
+
+    async def handle(self, request):
+        self.paths.append((request.method, request.path))
+        return await super().handle(request)
+
+
+def test_send_with_txn_id_through_real_intent(tmp_path):
+    # Goes through mautrix's own IntentAPI & AppServiceAPI, so it breaks if they stop taking what's passed in
+    async def run():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        homeserver = _RecordingHomeserver('example.com', 'bot', 'http://127.0.0.1:1', 'hs_token')
+        await homeserver.start('127.0.0.1', port)
+        try:
+            async with aiohttp.ClientSession() as session:
+                store = state_store.SQLiteStateStore(db_file=str(tmp_path / 'mx-state.db'))
+                api = mautrix.appservice.AppServiceAPI(f"http://127.0.0.1:{port}", '@bot:example.com', 'as_token',
+                                                       log=logging.getLogger('test'), state_store=store,
+                                                       client_session=session)
+                bot = mautrix.appservice.IntentAPI('@bot:example.com', api, state_store=store)
+                puppet = bot.user('@fbchat_1_2:example.com')
+                sender = ratelimit.Sender()
+                for _ in range(2):
+                    event_id = await sender.send_text(puppet, '!room:example.com', "hello", txn_id='fbchat_abc')
+                    assert event_id
+        finally:
+            await homeserver.stop()
+        return homeserver
+
+    homeserver = asyncio.run(run())
+    sends = [path for method, path in homeserver.paths if '/send/' in path]
+    assert sends == ['/_matrix/client/r0/rooms/!room:example.com/send/m.room.message/fbchat_abc'] * 2
+    assert all(method == 'PUT' for method, path in homeserver.paths if '/send/' in path)
+    assert [body['body'] for _, _, _, body in homeserver.received] == ["hello", "hello"]
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+
+import pytest
+
+import fbchat_bridge
+import intents
+import ratelimit
+
+
+class _Intent(object):
+    def __init__(self, mxid, calls):
+        self.mxid = mxid
+        self.calls = calls
+
+    async def ensure_registered(self):
+        pass
+
+    async def ensure_joined(self, room_id):
+        self.calls.append(('join', self.mxid))
+
+    async def invite_user(self, room_id, user_id):
+        self.calls.append(('invite', user_id))
+
+    async def leave_room(self, room_id):
+        self.calls.append(('leave', self.mxid))
+
+    async def get_joined_members(self, room_id):
+        return self.calls.joined
+
+
+class _Calls(list):
+    joined = {}
+
+
+class _Bot(object):
+    domain = 'example.com'
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def user(self, mxid):
+        return _Intent(mxid, self.calls)
+
+
+class _Profiles(object):
+    def sync(self, people):
+        pass
+
+
+class _Client(object):
+    """Just the bits of fbchat_bridge.Client that Room & Person use"""
+    uid = '1'
+    mx_puppet_id = '@user:example.com'
+
+    def __init__(self):
+        self.calls = _Calls()
+        self.mx = _Bot(self.calls)
+        self.intents = intents.IntentPool(self.mx)
+        self.log = logging.getLogger(__name__)
+        self.profiles = _Profiles()
+        self.sender = ratelimit.Sender()
+        self._fb_people_cache = {}
+        self._mx_people_cache = {}
+
+
+@pytest.fixture(autouse=True)
+def run_coroutines_here(monkeypatch):
+    # There's no event loop running in another thread to hand things off to, so just run them to completion
+    monkeypatch.setattr(fbchat_bridge, 'mx_coro', lambda mx, coro, timeout=None: asyncio.run(coro))
+
+
+def _room(client, participants, mx_members):
+    # Skip __init__, it'd go and ask Facebook about the thread
+    room = object.__new__(fbchat_bridge.Room)
+    room.fb = client
+    room.fbid = '100'
+    room.mxid = '!room:example.com'
+    room.fb_participants = tuple(participants)
+    room.mx_members = mx_members
+    return room
+
+
+def _puppet(fbid):
+    return f"@fbchat_1_{fbid}:example.com"
+
+
+def test_update_members_only_changes_the_difference():
+    client = _Client()
+    room = _room(client, ['1', '2', '3'], mx_members={'2', '3'})
+    room.update_members({'1', '3', '4'})
+
+    assert sorted(client.calls) == [('invite', _puppet('4')), ('join', _puppet('4')), ('leave', _puppet('2'))]
+    assert room.mx_members == {'3', '4'}
+    assert sorted(room.fb_participants) == ['1', '3', '4']
+
+
+def test_update_members_nothing_to_do():
+    client = _Client()
+    room = _room(client, ['1', '2'], mx_members={'2'})
+    room.update_members({'1', '2'})
+    assert client.calls == []
+
+
+def test_update_members_failed_invites_are_retried_next_time():
+    client = _Client()
+
+    async def broken_invite(room_id, user_id):
+        raise RuntimeError("M_FORBIDDEN")
+    client.intents.get(client.mx_puppet_id).invite_user = broken_invite
+
+    room = _room(client, ['1'], mx_members=set())
+    room.update_members({'1', '2'})
+    assert room.mx_members == set()
+
+
+def test_update_members_syncs_first_without_losing_new_participants():
+    client = _Client()
+    client.calls.joined = {client.mx_puppet_id: {}, _puppet('2'): {}}
+    # e.g. a room that was only resolved from the Matrix side, so who's in it was never worked out
+    room = _room(client, ['1', '2'], mx_members=None)
+    room.update_members({'1', '2', '3'})
+
+    assert ('invite', _puppet('3')) in client.calls
+    assert room.mx_members == {'2', '3'}
+
+
+def test_fbid_from_mxid():
+    client = _Client()
+    room = _room(client, [], mx_members=set())
+    assert room._fbid_from_mxid(_puppet('42')) == '42'
+    assert room._fbid_from_mxid(client.mx_puppet_id) == '1'
+    assert room._fbid_from_mxid('@someone:elsewhere.com') is None
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import types
+
+import mautrix.types
+
+import dispatch
+import main
+
+
+class _AppService(object):
+    domain = 'example.com'
+    intent = object()
+
+
+class _Handler(object):
+    def __init__(self):
+        self.handled = []
+
+    async def handle_event(self, mx_ev):
+        self.handled.append(mx_ev.event_id)
+
+    async def handle_matrix_event(self, mx_ev):
+        self.handled.append(mx_ev.event_id)
+
+
+class _Sender(object):
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, intent, room_id, text):
+        self.sent.append((room_id, text))
+
+
+def _message(room_id, n, sender='@user:example.com'):
+    return types.SimpleNamespace(type=mautrix.types.EventType.ROOM_MESSAGE, room_id=room_id, sender=sender,
+                                 event_id=f"${n}")
+
+
+def _route(running_accounts, sender=None):
+    dispatcher = dispatch.Dispatcher()
+    main.route_account(dispatcher=dispatcher, matrix_appservice=_AppService(), matrix_sender=sender or _Sender(),
+                       logger=logging.getLogger(__name__), running_accounts=running_accounts, fbchat_uid='1',
+                       matrix_user_localpart='user')
+    return dispatcher
+
+
+def test_events_before_login_are_queued_then_routed():
+    client, commands = _Handler(), _Handler()
+
+    async def run():
+        running_accounts = {}
+        dispatcher = _route(running_accounts)
+        # Before the protocol room's even known
+        for n, room_id in enumerate(('!protocol:example.com', '!chat:example.com', '!chat:example.com')):
+            await dispatcher.dispatch(_message(room_id, n))
+        await dispatcher.dispatch(_message('!chat:example.com', 3, sender='@someone:example.com'))
+        await asyncio.sleep(0.01)
+        assert client.handled == commands.handled == []
+
+        account = running_accounts['1']
+        account['protocol_roomid'] = '!protocol:example.com'
+        account['command_handler'] = commands
+        account['logged_in'].set_result(client)
+        await dispatcher.drain()
+    asyncio.run(run())
+
+    assert commands.handled == ['$0']
+    assert client.handled == ['$1', '$2']
+
+
+def test_events_are_answered_or_dropped_when_login_fails():
+    sender = _Sender()
+
+    async def run():
+        running_accounts = {}
+        dispatcher = _route(running_accounts, sender)
+        await dispatcher.dispatch(_message('!protocol:example.com', 0))
+        await dispatcher.dispatch(_message('!chat:example.com', 1))
+
+        account = running_accounts['1']
+        account['protocol_roomid'] = '!protocol:example.com'
+        account['logged_in'].set_exception(RuntimeError("Not logged in to Facebook"))
+        await dispatcher.drain()
+    asyncio.run(run())
+
+    assert [room_id for room_id, text in sender.sent] == ['!protocol:example.com']
@@ -0,0 +1,43 @@
+import json
+import os
+import stat
+
+import sessions
+
+
+def test_save_and_load(tmp_path):
+    store = sessions.SessionStore(str(tmp_path))
+    assert store.load('1', config_session={'c_user': '1'}) is None
+    assert store.save('1', {'c_user': '1', 'xs': 'new'})
+    assert not store.save('1', {'c_user': '1', 'xs': 'new'})  # Nothing changed
+
+    assert sessions.SessionStore(str(tmp_path)).load('1', config_session={'c_user': '1'}) == \
+        {'c_user': '1', 'xs': 'new'}
+    assert stat.S_IMODE(os.stat(store._filename('1')).st_mode) == 0o600
+
+
+def test_fresh_config_cookies_replace_saved_ones(tmp_path):
+    store = sessions.SessionStore(str(tmp_path))
+    store.load('1', config_session={'xs': 'from register.py'})
+    store.save('1', {'xs': 'rotated'})
+
+    # register.py has been run again since
+    store = sessions.SessionStore(str(tmp_path))
+    assert store.load('1', config_session={'xs': 'from register.py, again'}) is None
+    assert not os.path.exists(store._filename('1'))
+
+
+def test_files_from_before_config_tracking_still_load(tmp_path):
+    store = sessions.SessionStore(str(tmp_path))
+    with open(store._filename('1'), 'w') as f:
+        json.dump({'xs': 'old format'}, f)
+    assert store.load('1', config_session={'xs': 'anything'}) == {'xs': 'old format'}
+
+
+def test_delete(tmp_path):
+    store = sessions.SessionStore(str(tmp_path))
+    store.save('1', {'xs': 'rejected'})
+    store.delete('1')
+    store.delete('1')
+    assert store.load('1') is None
+    assert store.save('1', {'xs': 'rejected'})  # Not still remembered as the last thing saved
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import threading
+import time
+
+import dispatch
+import executors
+import main
+
+
+class _Debouncer(object):
+    def __init__(self):
+        self.flushed = False
+
+    async def flush(self):
+        self.flushed = True
+
+
+class _Client(object):
+    uid = '1'
+
+    def __init__(self):
+        self.stopped = False
+        self.flushed = False
+        self.state_debouncer = _Debouncer()
+
+    def stop(self):
+        self.stopped = True
+
+    def flush(self):
+        self.flushed = True
+
+
+class _SessionStore(object):
+    def save_client(self, client):
+        pass
+
+
+class _StateStore(object):
+    def close(self):
+        pass
+
+
+class _LogHandler(object):
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+
+def test_a_listener_stuck_mid_poll_doesnt_use_up_everyone_elses_time(monkeypatch):
+    monkeypatch.setattr(main, 'SHUTDOWN_LISTENER_WAIT', 0.1)
+    monkeypatch.setattr(main, 'SHUTDOWN_STEP_MIN', 1)
+    request_executor = executors.InstrumentedExecutor(max_workers=1, thread_name_prefix='test')
+    bridged = threading.Event()
+    client = _Client()
+
+    async def run():
+        stuck_polling = asyncio.get_event_loop().create_future()
+        running_accounts = {'1': {'client': client, 'listen_task': stuck_polling, 'log_handler': _LogHandler()}}
+        # A message the listener handed over just before the shutdown started
+        request_executor.submit(lambda: (time.sleep(0.3), bridged.set()))
+        started = time.monotonic()
+        await main.shutdown(running_accounts=running_accounts, dispatcher=dispatch.Dispatcher(),
+                            request_executor=request_executor, mx_state_store=_StateStore(),
+                            session_store=_SessionStore(), timeout=0, logger=logging.getLogger(__name__))
+        stuck_polling.cancel()
+        return time.monotonic() - started
+    took = asyncio.run(run())
+    request_executor.shutdown()
+
+    assert client.stopped
+    assert bridged.is_set()
+    assert client.state_debouncer.flushed and client.flushed
+    assert took < 1
@@ -0,0 +1,38 @@
+import mautrix.types
+
+import state_store
+
+
+def _store(tmp_path, **kwargs):
+    return state_store.SQLiteStateStore(db_file=str(tmp_path / 'mx-state.db'), **kwargs)
+
+
+def test_set_power_level_without_the_rest_of_them(tmp_path):
+    # Same as mautrix's JSON & pickle stores
+    store = _store(tmp_path)
+    store.set_power_level('!room:example.com', '@puppet:example.com', 100)
+    assert store.has_power_levels('!room:example.com')
+    assert store.get_power_levels('!room:example.com').get_user_level('@puppet:example.com') == 100
+    store.close()
+
+    store = _store(tmp_path)
+    assert store.get_power_levels('!room:example.com').get_user_level('@puppet:example.com') == 100
+    store.close()
+
+
+def test_caches_are_bounded_without_losing_writes(tmp_path):
+    store = _store(tmp_path, cache_size=10)
+    for n in range(100):
+        store.registered(f"@user{n}:example.com")
+        store.set_membership(f"!room{n}:example.com", '@user:example.com', mautrix.types.Membership.JOIN)
+        store.set_power_level(f"!room{n}:example.com", '@user:example.com', n)
+    summary = store.summary()
+    assert summary['registrations'] <= 10
+    assert len(store._members) <= 10
+    assert summary['power_levels'] <= 10
+
+    # Forgotten ones are read back from the database
+    assert store.is_registered('@user0:example.com')
+    assert store.get_member('!room0:example.com', '@user:example.com').membership == mautrix.types.Membership.JOIN
+    assert store.get_power_levels('!room0:example.com').get_user_level('@user:example.com') == 0
+    store.close()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+import contextlib
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+
+import metrics
+
+
+_current = threading.local()
+_exporter = None
+
+
+class Span(object):
+    def __init__(self, trace, name: str, parent=None, start: float = None, **attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent = parent
+        self.start = start or time.time()
+        self.end = None
+        self.attributes = attributes
+
+    def finish(self, end: float = None):
+        self.end = end or time.time()
+        metrics.stage_latency.observe(self.end - self.start, stage=self.name)
+
+    def to_otlp(self):
+        return {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent.span_id if self.parent else '',
+            'name': self.name,
+            'startTimeUnixNano': int(self.start * 1e9),
+            'endTimeUnixNano': int((self.end or self.start) * 1e9),
+            'attributes': [{'key': k, 'value': {'stringValue': str(v)}} for k, v in self.attributes.items()],
+        }
+
+
+class Trace(object):
+    """
+    Follows a single Facebook message through the bridge, one span per stage.
+
+    While a trace is active in a thread, tracing.span() anywhere further down the call stack adds to it,
+    so Room/Person don't need a trace object passed through every function.
+    """
+    def __init__(self, name: str, start: float = None, **attributes):
+        self.trace_id = secrets.token_hex(16)
+        self.root = Span(self, name, start=start, **attributes)
+        self.spans = [self.root]
+        self._stack = [self.root]
+
+    def add_span(self, name: str, start: float, end: float, **attributes):
+        """For stages that were already over before the bridge knew about them, like Facebook's own delivery"""
+        s = Span(self, name, parent=self._stack[-1], start=start, **attributes)
+        s.finish(end)
+        self.spans.append(s)
+        return s
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        s = Span(self, name, parent=self._stack[-1], **attributes)
+        self.spans.append(s)
+        self._stack.append(s)
+        try:
+            yield s
+        except Exception as e:
+            s.attributes['error'] = repr(e)
+            raise
+        finally:
+            self._stack.pop()
+            s.finish()
+
+    def __enter__(self):
+        self._previous = getattr(_current, 'trace', None)
+        _current.trace = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.trace = self._previous
+        if exc_value:
+            self.root.attributes['error'] = repr(exc_value)
+        self.root.finish()
+        if _exporter:
+            _exporter.export(self)
+
+
+def span(name: str, **attributes):
+    """Add a span to whatever trace is active in this thread, or do nothing if there isn't one"""
+    trace = getattr(_current, 'trace', None)
+    if not trace:
+        return contextlib.nullcontext()
+    return trace.span(name, **attributes)
+
+
+class Exporter(object):
+    """
+    Write finished traces out in OpenTelemetry's OTLP/JSON format, in the background so the listener never waits on it.
+    Given an http(s) URL it posts to a collector (e.g. http://127.0.0.1:4318/v1/traces),
+    otherwise it's a filename that gets one JSON document per line appended to it.
+    """
+    def __init__(self, destination: str, batch_size: int = 100, interval: float = 5):
+        self.destination = destination
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=10000)
+        self.thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+        self.thread.start()
+
+    def export(self, trace):
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            pass  # Dropping traces is better than slowing down the bridge
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logging.getLogger(__name__).warning(f"Failed to export {len(batch)} traces: {e!r}")
+
+    def _write(self, traces):
+        document = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'mautrix-fbchat'}}]},
+            'scopeSpans': [{
+                'scope': {'name': 'mautrix-fbchat'},
+                'spans': [s.to_otlp() for trace in traces for s in trace.spans],
+            }],
+        }]})
+        if self.destination.startswith(('http://', 'https://')):
+            request = urllib.request.Request(self.destination, data=document.encode(), method='POST',
+                                             headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request, timeout=10).close()
+        else:
+            with open(self.destination, 'a') as f:
+                f.write(document + '\n')
+
+
+def configure(destination: str = None):
+    global _exporter
+    _exporter = Exporter(destination) if destination else None
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+import asyncio
+import time
+
+import metrics
+
+
+class ListenerWatchdog(object):
+    """
+    Keep an eye on a Client's Facebook listener, and restart it if it gets stuck or dies.
+
+    The listener's thread can't actually be killed, so a stuck one is abandoned and a fresh thread takes over.
+    If it comes back to life later the worst it can do is bridge a message twice, which the checkpoints,
+    journal & transaction IDs all make harmless.
+    Restarts back off exponentially, so a Facebook outage doesn't turn into a restart loop.
+    """
+    def __init__(self, client, poll_timeout: float = 120, callback_timeout: float = 300,
+                 check_interval: float = 5, max_backoff: float = 300):
+        self.client = client
+        # Facebook's long-polls come back well within poll_timeout, even when there's nothing new
+        self.poll_timeout = poll_timeout
+        # Handling events & catching up can legitimately take a while, creating rooms and such
+        self.callback_timeout = callback_timeout
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+
+        self._restart = None
+        self._restart_reason = None
+
+    def stalled(self):
+        """Why the listener looks stuck, or None if it looks fine"""
+        phase = self.client.listener_phase
+        duration = time.monotonic() - self.client.listener_phase_since
+        limit = {'poll': self.poll_timeout, 'callback': self.callback_timeout, 'catch_up': self.callback_timeout}.get(phase)
+        if limit and duration > limit:
+            return phase, f"stuck in {phase} for {duration:.0f}s"
+        return None
+
+    def restart(self, reason: str = "restart requested"):
+        """Restart the listener on the next check, whether it's stuck or not"""
+        self._restart_reason = reason
+        if self._restart:
+            self._restart.set()
+
+    async def _watch(self, task):
+        """Wait until the listener task finishes or needs restarting, returns (cause, reason) for the latter"""
+        while not task.done():
+            restart_requested = asyncio.ensure_future(self._restart.wait())
+            await asyncio.wait([task, restart_requested], timeout=self.check_interval,
+                               return_when=asyncio.FIRST_COMPLETED)
+            restart_requested.cancel()
+            if self._restart.is_set():
+                return 'requested', self._restart_reason
+            stall = self.stalled()
+            if stall:
+                return stall
+
+        if not self.client.stopped and task.exception():
+            return 'crashed', f"crashed with {task.exception()!r}"
+        return None
+
+    async def run(self):
+        self._restart = asyncio.Event()
+        backoff = 1
+        while True:
+            self._restart.clear()
+            started = time.monotonic()
+            task = asyncio.ensure_future(self.client.listen())
+            restart = await self._watch(task)
+            if not restart or self.client.stopped:
+                return task.result() if task.done() else None
+
+            cause, reason = restart
+            metrics.listener_restarts.inc(account=self.client.uid, cause=cause)
+            if time.monotonic() - started > self.max_backoff:
+                # It was fine for a good while before this, so it's not a restart loop
+                backoff = 1
+            # This goes to the protocol room too, so the user knows why messages might have been slow
+            self.client.log.error(f"Facebook listener {reason}, restarting it in {backoff}s")
+
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.client.reset_listener()
+
+            # Sleep in small steps so a shutdown doesn't have to wait out the whole backoff
+            resume_at = time.monotonic() + backoff
+            while time.monotonic() < resume_at and not self.client.stopped:
+                await asyncio.sleep(min(1, resume_at - time.monotonic()))
+            if self.client.stopped:
+                return
+            backoff = min(backoff * 2, self.max_backoff)